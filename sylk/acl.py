@@ -0,0 +1,180 @@
+
+"""Access control lists for rooms and trusted networks"""
+
+import ipaddress
+import re
+import time
+
+from application.configuration import ConfigFile
+from functools import lru_cache
+
+
+__all__ = 'DomainSuffix', 'AccessPolicy', 'AccessPolicyCache', 'NetworkMatcher'
+
+
+class DomainSuffix(str):
+    """A domain policy item which also matches all the subdomains (*.example.com or .example.com)"""
+
+    domain_re = re.compile(r"^[a-zA-Z0-9\-_]+(\.[a-zA-Z0-9\-_]+)*$")
+
+    def __new__(cls, value):
+        value = str(value)
+        domain = value[2:] if value.startswith('*.') else value[1:]
+        if not value.startswith(('*.', '.')) or not cls.domain_re.match(domain):
+            raise ValueError("illegal domain suffix: %s" % value)
+        return str.__new__(cls, '.' + domain.lower())
+
+
+class AddressSet(object):
+    """The compiled form of a list of policy items (SIP addresses, domains and domain suffixes)"""
+
+    __slots__ = 'all', 'addresses', 'domains', 'suffixes'
+
+    def __init__(self, items):
+        self.all = 'all' in items
+        self.addresses = set()
+        self.domains = set()
+        suffixes = set()
+        for item in items:
+            if item in ('all', 'none'):
+                continue
+            elif isinstance(item, DomainSuffix):
+                suffixes.add(item)
+            elif '@' in item:
+                user, _, domain = item.rpartition('@')
+                self.addresses.add('%s@%s' % (user, domain.lower()))
+            else:
+                self.domains.add(item.lower())
+        self.suffixes = tuple(suffixes)
+
+    def __bool__(self):
+        return self.all or bool(self.addresses or self.domains or self.suffixes)
+
+    def match(self, address, domain):
+        if self.all:
+            return True
+        if address in self.addresses or domain in self.domains:
+            return True
+        return bool(self.suffixes) and domain.endswith(self.suffixes)
+
+
+class AccessPolicy(object):
+    """
+    An Apache style access policy (access_policy, allow and deny settings)
+    compiled into hash sets, so checking a URI against it does not need any
+    parsing besides splitting the URI into address and domain.
+    """
+
+    __slots__ = 'order', 'allow', 'deny'
+
+    def __init__(self, access_policy, allow, deny):
+        self.order = access_policy
+        self.allow = AddressSet(allow.items)
+        self.deny = AddressSet(deny.items)
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.access_policy, config.allow, config.deny)
+
+    @staticmethod
+    def split_uri(uri):
+        if hasattr(uri, 'host'):
+            user = uri.user.decode() if isinstance(uri.user, bytes) else uri.user or ''
+            domain = uri.host.decode() if isinstance(uri.host, bytes) else uri.host
+        else:
+            uri = str(uri)
+            if uri.startswith(('sip:', 'sips:')):
+                uri = uri.partition(':')[2]
+            user, _, domain = uri.rpartition('@')
+        domain = domain.lower()
+        return ('%s@%s' % (user, domain) if user else domain), domain
+
+    def allows(self, uri):
+        address, domain = self.split_uri(uri)
+        if self.order == 'allow,deny':
+            return self.allow.match(address, domain) and not self.deny.match(address, domain)
+        else:
+            return not self.deny.match(address, domain) or self.allow.match(address, domain)
+
+
+class AccessPolicyCache(object):
+    """
+    The compiled access policies of the rooms defined in a configuration
+    file. A policy is compiled once for every room section in the file and
+    once for the default policy shared by the rooms without a section, so
+    requests for arbitrary rooms do not grow the cache. Policies are discarded
+    when the configuration file changes, which is checked at most once every
+    check_interval seconds.
+    """
+
+    check_interval = 1
+
+    def __init__(self, config_section, get_config):
+        self.config_section = config_section
+        self.get_config = get_config
+        self._config_file = None
+        self._last_check = 0
+        self._policies = {}
+
+    def get(self, room):
+        now = time.monotonic()
+        if now - self._last_check >= self.check_interval:
+            self._last_check = now
+            config_file = ConfigFile(self.config_section.__cfgfile__)  # this returns the same object unless the files were modified
+            if config_file is not self._config_file:
+                self._config_file = config_file
+                self._policies = {}
+        section = room if self._config_file.get_section(room) is not None else None  # None is the default policy
+        try:
+            return self._policies[section]
+        except KeyError:
+            return self._policies.setdefault(section, AccessPolicy.from_config(self.get_config(room)))
+
+
+class NetworkMatcher(object):
+    """
+    Checks if an IPv4 or IPv6 address belongs to any of a set of networks.
+
+    The networks are compiled into a set of network addresses for every
+    prefix length in use, so a lookup takes one masked set lookup per
+    distinct prefix length instead of a scan of all the networks. The results of recent lookups are cached. A matcher is
+    immutable, a new one is built when the networks change.
+    """
+
+    cache_size = 1024
+
+    def __init__(self, networks):
+        tables = {4: {}, 6: {}}
+        for network in networks:
+            network = self._parse_network(network)
+            tables[network.version].setdefault(network.prefixlen, set()).add(int(network.network_address))
+        self.tables = {version: [(self._mask(version, prefix_length), addresses) for prefix_length, addresses in sorted(table.items())] for version, table in tables.items()}
+        self.size = sum(len(addresses) for table in self.tables.values() for mask, addresses in table)
+        self.match = lru_cache(maxsize=self.cache_size)(self._match)
+
+    def __len__(self):
+        return self.size
+
+    @staticmethod
+    def _parse_network(network):
+        if isinstance(network, tuple):  # a NetworkRange setting value: (network address, netmask) as integers
+            address, netmask = network
+            return ipaddress.ip_network((address, bin(netmask).count('1')), strict=False)
+        if isinstance(network, bytes):
+            network = network.decode()
+        return ipaddress.ip_network(network, strict=False)
+
+    @staticmethod
+    def _mask(version, prefix_length):
+        bits = 32 if version == 4 else 128
+        return ((1 << prefix_length) - 1) << (bits - prefix_length)
+
+    def _match(self, address):
+        try:
+            address = ipaddress.ip_address(address.decode() if isinstance(address, bytes) else address)
+        except ValueError:
+            return False
+        if address.version == 6 and address.ipv4_mapped is not None:
+            address = address.ipv4_mapped
+        value = int(address)
+        return any(value & mask in addresses for mask, addresses in self.tables[address.version])
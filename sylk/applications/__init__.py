@@ -1,24 +1,29 @@
 
 import abc
+import fnmatch
 import imp
 import logging
 import os
-import socket
-import struct
+import re
 import sys
+import time
 
 from application import log
-from application.configuration.datatypes import NetworkRange
+from application.configuration import ConfigFile
+from application.configuration.datatypes import StringList
 from application.notification import IObserver, NotificationCenter
 from application.python import Null
 from application.python.decorator import execute_once
 from application.python.types import Singleton
-from collections import defaultdict
+from collections import Counter, defaultdict
+from functools import lru_cache
 from itertools import chain
 from sipsimple.threading import run_in_twisted_thread
 from zope.interface import implementer
 
+from sylk.acl import NetworkMatcher
 from sylk.configuration import ServerConfig, SIPConfig, ThorNodeConfig
+from sylk.threadpool import defer_to_pool
 
 
 __all__ = 'ISylkApplication', 'ApplicationRegistry', 'SylkApplication', 'IncomingRequestHandler', 'ApplicationLogger'
@@ -145,6 +150,79 @@ class ApplicationNotLoadedError(Exception):
     pass
 
 
+class ApplicationRouter(object):
+    """
+    Maps request URIs to application names, according to the application_map
+    setting. The map entries are compiled into indexes for full addresses
+    (user@domain), domains and users, which are checked in this order,
+    followed by the entries with wildcards (* and ?) in the configured order.
+    Entries without a @ match either the domain or the user.
+    The routing decisions for recent request URIs are cached and the map is
+    recompiled when the configuration file changes, which is checked at most
+    once every reload_interval seconds.
+    """
+
+    cache_size = 4096
+    reload_interval = 5
+
+    def __init__(self):
+        self.application_map = {}
+        self.addresses = {}
+        self.domains = {}
+        self.users = {}
+        self.rules = []
+        self.hits = Counter()
+        self._config_file = None
+        self._last_check = 0
+        self._route = None
+
+    def load(self, application_map=None):
+        if application_map is None:
+            self._config_file = ConfigFile(ServerConfig.__cfgfile__)
+            application_map = self._config_file.get_setting(ServerConfig.__section__, 'application_map', type=StringList, default=ServerConfig.application_map)
+        self.application_map = dict(item.rpartition(':')[::2] for item in application_map if ':' in item)
+        self.addresses = {}
+        self.domains = {}
+        self.users = {}
+        self.rules = []
+        for key, application in self.application_map.items():
+            if '*' in key or '?' in key:
+                self.rules.append((re.compile(fnmatch.translate(key), re.IGNORECASE), application))
+            elif '@' in key:
+                user, _, domain = key.rpartition('@')
+                self.addresses['%s@%s' % (user, domain.lower())] = application
+            else:
+                self.domains[key.lower()] = application
+                self.users[key] = application
+        self._route = lru_cache(maxsize=self.cache_size)(self._lookup)
+
+    def reload(self):
+        if ConfigFile(ServerConfig.__cfgfile__) is not self._config_file:  # this returns the same object unless the files were modified
+            self.load()
+            log.info('Reloaded application map')
+
+    def route(self, user, domain):
+        """Return the name of the application for a request URI, or None if the application map does not have an entry for it"""
+        now = time.monotonic()
+        if now - self._last_check >= self.reload_interval:
+            self._last_check = now
+            self.reload()
+        application = self._route(user, domain.lower())
+        self.hits[application or ServerConfig.default_application] += 1
+        return application
+
+    def _lookup(self, user, domain):
+        address = '%s@%s' % (user, domain)
+        application = self.addresses.get(address) or self.domains.get(domain) or self.users.get(user)
+        if application is None:
+            application = next((application for rule, application in self.rules if rule.match(address) or rule.match(domain)), None)
+        return application
+
+    @property
+    def statistics(self):
+        return dict(map_size=len(self.application_map), hits=dict(self.hits), cache=self._route.cache_info()._asdict() if self._route is not None else None)
+
+
 @implementer(IObserver)
 class IncomingRequestHandler(object, metaclass=Singleton):
     """Handle incoming requests and match them to applications"""
@@ -158,11 +236,12 @@ class IncomingRequestHandler(object, metaclass=Singleton):
             ServerConfig.default_application = 'conference'
         else:
             log.info('Default application: %s' % ServerConfig.default_application)
-        self.application_map = dict((item.split(':')) for item in ServerConfig.application_map)
-        if self.application_map:
+        self.router = ApplicationRouter()
+        self.router.load()
+        if self.router.application_map:
             txt = 'Application map:\n'
             inverted_app_map = defaultdict(list)
-            for url, app in self.application_map.items():
+            for url, app in self.router.application_map.items():
                 inverted_app_map[app].append(url)
             for app, urls in inverted_app_map.items():
                 txt += '  {}: {}\n'.format(app, ', '.join(urls))
@@ -199,13 +278,9 @@ class IncomingRequestHandler(object, metaclass=Singleton):
         if SYLK_APP_HEADER in headers:
             application_name = headers[SYLK_APP_HEADER].body.strip()
         else:
-            application_name = ServerConfig.default_application
-            if self.application_map:
-                prefixes = ("%s@%s" % (ruri.user, ruri.host), ruri.host, ruri.user)
-                for prefix in prefixes:
-                    if prefix in self.application_map:
-                        application_name = self.application_map[prefix]
-                        break
+            user = ruri.user.decode() if isinstance(ruri.user, bytes) else ruri.user or ''
+            host = ruri.host.decode() if isinstance(ruri.host, bytes) else ruri.host
+            application_name = self.router.route(user, host) or ServerConfig.default_application
         try:
             return self.application_registry[application_name]
         except KeyError:
@@ -286,8 +361,8 @@ class AuthorizationHandler(object):
 
     def __init__(self):
         self.state = None
-        self.trusted_peers = SIPConfig.trusted_peers
-        self.thor_nodes = []
+        self.trusted_peers = NetworkMatcher(SIPConfig.trusted_peers)
+        self.thor_nodes = NetworkMatcher([])
 
     @property
     def trusted_parties(self):
@@ -306,9 +381,8 @@ class AuthorizationHandler(object):
     def authorize_source(self, ip_address):
         if self.state != 'started':
             raise UnauthorizedRequest
-        for range in self.trusted_parties:
-            if struct.unpack('!L', socket.inet_aton(ip_address.decode()))[0] & range[1] == range[0]:
-                return True
+        if self.trusted_parties.match(ip_address):
+            return True
         raise UnauthorizedRequest
 
     @run_in_twisted_thread
@@ -317,7 +391,13 @@ class AuthorizationHandler(object):
         handler(notification)
 
     def _NH_ThorNetworkGotUpdate(self, notification):
-        self.thor_nodes = [NetworkRange(node.decode()) for node in chain.from_iterable(n.nodes for n in list(notification.data.networks.values()))]
+        nodes = list(chain.from_iterable(n.nodes for n in list(notification.data.networks.values())))
+        deferred = defer_to_pool('housekeeping', NetworkMatcher, nodes)  # the matcher is built outside the reactor thread
+        deferred.addCallback(self._thor_nodes_updated)
+        deferred.addErrback(lambda failure: log.error('Could not update the SIP Thor trusted nodes: %s' % failure.getErrorMessage()))
+
+    def _thor_nodes_updated(self, matcher):
+        self.thor_nodes = matcher
 
 
 class ApplicationLogger(object):
@@ -2,23 +2,30 @@
 import os
 import re
 import shutil
+import time
+
+from functools import partial
 
 from application.notification import IObserver, NotificationCenter
 from application.python import Null
 from sipsimple.account.bonjour import BonjourPresenceState
 from sipsimple.configuration.settings import SIPSimpleSettings
 from sipsimple.core import SIPURI, SIPCoreError
-from sipsimple.core import Header, FromHeader, ToHeader, SubjectHeader
+from sipsimple.core import ContactHeader, Header, FromHeader, ToHeader, RouteHeader, SubjectHeader, Request, Route
 from sipsimple.lookup import DNSLookup
 from sipsimple.streams import MediaStreamRegistry
+from sipsimple.threading import run_in_twisted_thread
 from sipsimple.threading.green import run_in_green_thread
 from twisted.internet import reactor
 from zope.interface import implementer
 
 from sylk.accounts import DefaultAccount
 from sylk.applications import SylkApplication
-from sylk.applications.conference.configuration import get_room_config, ConferenceConfig
+from sylk.applications.conference.admission import AdmissionController
+from sylk.applications.conference.configuration import get_room_access_policy, ConferenceConfig
+from sylk.applications.conference.history import ConferenceHistory
 from sylk.applications.conference.logger import log
+from sylk.applications.conference.placement import RoomPlacement
 from sylk.applications.conference.room import Room
 from sylk.applications.conference.web import ConferenceWeb
 from sylk.bonjour import BonjourService
@@ -32,15 +39,32 @@ class ACLValidationError(Exception): pass
 class RoomNotFoundError(Exception): pass
 
 
+class RoomStatistics(object):
+    def __init__(self):
+        self.started = 0
+        self.reused = 0
+        self.expired = 0
+        self.total_setup_time = 0.0
+        self.max_setup_time = 0.0
+
+    @property
+    def average_setup_time(self):
+        return self.total_setup_time / self.started if self.started else 0.0
+
+
 @implementer(IObserver)
 class ConferenceApplication(SylkApplication):
 
     def __init__(self):
         self._rooms = {}
+        self._idle_rooms = {}  # room uri -> timer which stops the idle room
+        self._room_statistics = RoomStatistics()
+        self.placement = RoomPlacement()
         self.invited_participants_map = {}
         self.bonjour_focus_service = Null
         self.bonjour_room_service = Null
         self.web = Null
+        self.admission_controller = None
 
     def start(self):
         self.web = ConferenceWeb(self)
@@ -53,6 +77,12 @@ class ConferenceApplication(SylkApplication):
             except EnvironmentError:
                 pass
 
+        ConferenceHistory().start()
+        self.admission_controller = AdmissionController()
+        if ThorNodeConfig.enabled:
+            NotificationCenter().add_observer(self, name='ThorNetworkGotUpdate')
+            NotificationCenter().add_observer(self, name='ThorNetworkGotConferenceRooms')
+
         if ServerConfig.enable_bonjour and ServerConfig.default_application == 'conference':
             self.bonjour_focus_service = BonjourService(service='sipfocus')
             self.bonjour_focus_service.start()
@@ -65,6 +95,15 @@ class ConferenceApplication(SylkApplication):
     def stop(self):
         self.bonjour_focus_service.stop()
         self.bonjour_room_service.stop()
+        ConferenceHistory().stop()
+        self.admission_controller.stop()
+        if ThorNodeConfig.enabled:
+            NotificationCenter().remove_observer(self, name='ThorNetworkGotUpdate')
+            NotificationCenter().remove_observer(self, name='ThorNetworkGotConferenceRooms')
+        for timer in self._idle_rooms.values():
+            if timer.active():
+                timer.cancel()
+        self._idle_rooms.clear()
 
     def get_room(self, uri, create=False):
         room_uri = '%s@%s' % (uri.user, uri.host)
@@ -72,28 +111,96 @@ class ConferenceApplication(SylkApplication):
             room = self._rooms[room_uri]
         except KeyError:
             if create:
-                room = Room(room_uri)
+                room = Room(room_uri, setup_time_callback=self.add_room_setup_time)
                 self._rooms[room_uri] = room
+                if not self.placement.is_local(room_uri):
+                    self._publish_rooms()
                 return room
             else:
                 raise RoomNotFoundError
         else:
+            if create and room_uri in self._idle_rooms:
+                timer = self._idle_rooms.pop(room_uri)
+                if timer.active():
+                    timer.cancel()
+                self._room_statistics.reused += 1
+                log.debug('Room %s - reused while idle' % room_uri)
             return room
 
+    def start_room(self, uri):
+        room = self.get_room(uri, True)
+        if not room.started:
+            start_time = time.monotonic()
+            room.start()
+            setup_time = time.monotonic() - start_time
+            self._room_statistics.started += 1
+            room.setup_time = 0.0
+            self.add_room_setup_time(room, setup_time)
+            log.debug('Room %s - started in %.1f ms' % (room.uri, setup_time * 1000))
+        return room
+
+    def add_room_setup_time(self, room, setup_time):
+        # the audio conference of a room is started when the first audio stream joins, which is part of its setup time too
+        room.setup_time += setup_time
+        self._room_statistics.total_setup_time += setup_time
+        self._room_statistics.max_setup_time = max(self._room_statistics.max_setup_time, room.setup_time)
+
     def remove_room(self, uri):
         room_uri = '%s@%s' % (uri.user, uri.host)
-        self._rooms.pop(room_uri, None)
+        room = self._rooms.pop(room_uri, None)
+        timer = self._idle_rooms.pop(room_uri, None)
+        if timer is not None and timer.active():
+            timer.cancel()
+        if room is not None and not self.placement.is_local(room_uri):
+            self._publish_rooms()
+
+    def _publish_rooms(self):
+        self.placement.publish([room_uri for room_uri in self._rooms if not self.placement.is_local(room_uri)])
+
+    def hosting_node(self, uri):
+        """Return the node which hosts the room of a request received here, None if the request is handled here"""
+        room_uri = '%s@%s' % (uri.user, uri.host)
+        if room_uri in self._rooms or uri.parameters.get('maddr') == self.placement.local_node:
+            # requests which were already sent here by another node are accepted, so they are never redirected in a loop
+            return None
+        return self.placement.lookup(room_uri)
+
+    def release_room(self, uri):
+        # empty rooms are kept for room_idle_timeout seconds, so they can be reused if participants come back quickly
+        room_uri = '%s@%s' % (uri.user, uri.host)
+        room = self._rooms.get(room_uri)
+        if room is None or room.stopping or not room.empty:
+            return
+        if ConferenceConfig.room_idle_timeout <= 0 or not self.placement.is_local(room_uri):
+            self.remove_room(uri)
+            room.stop()
+        elif room_uri not in self._idle_rooms:
+            self._idle_rooms[room_uri] = reactor.callLater(ConferenceConfig.room_idle_timeout, self._expire_room, uri)
+
+    def _expire_room(self, uri):
+        room_uri = '%s@%s' % (uri.user, uri.host)
+        self._idle_rooms.pop(room_uri, None)
+        room = self._rooms.get(room_uri)
+        if room is not None and not room.stopping and room.empty:
+            self.remove_room(uri)
+            room.stop()
+            self._room_statistics.expired += 1
+
+    @property
+    def room_statistics(self):
+        statistics = self._room_statistics
+        return dict(rooms=len(self._rooms),
+                    idle_rooms=len(self._idle_rooms),
+                    started=statistics.started,
+                    reused=statistics.reused,
+                    expired=statistics.expired,
+                    average_setup_time=round(statistics.average_setup_time, 6),
+                    max_setup_time=round(statistics.max_setup_time, 6))
 
     def validate_acl(self, room_uri, from_uri):
         room_uri = '%s@%s' % (room_uri.user, room_uri.host)
-        cfg = get_room_config(room_uri)
-        if cfg.access_policy == 'allow,deny':
-            if cfg.allow.match(from_uri) and not cfg.deny.match(from_uri):
-                return
+        if not get_room_access_policy(room_uri).allows(from_uri):
             raise ACLValidationError
-        else:
-            if cfg.deny.match(from_uri) and not cfg.allow.match(from_uri):
-                raise ACLValidationError
 
     def incoming_session(self, session):
         peer = '%s:%s' % (session.transport, session.peer_address)
@@ -118,6 +225,19 @@ class ConferenceApplication(SylkApplication):
             session.reject(403)
             return
 
+        room_uri = '%s@%s' % (session.request_uri.user, session.request_uri.host)
+        node = self.hosting_node(session.request_uri)
+        if node is not None:
+            # the request URI is kept, so the room is the same on all nodes, only the destination changes
+            log.info('Session redirected: room %s is hosted by %s' % (room_uri, node))
+            host, port = self.placement.node_address(node, session.transport)
+            contact_uri = SIPURI.new(session.request_uri)
+            contact_uri.port = port
+            contact_uri.parameters['maddr'] = host
+            contact_uri.parameters['transport'] = session.transport
+            session.reject(302, contact_header=ContactHeader(contact_uri))
+            return
+
         if transfer_stream is not None:
             try:
                 room = self.get_room(session.request_uri)
@@ -127,9 +247,8 @@ class ConferenceApplication(SylkApplication):
                 return
             if transfer_stream.direction == 'sendonly':
                 # file transfer 'pull'
-                try:
-                    file = next(file for file in room.files if file.hash == transfer_stream.file_selector.hash)
-                except StopIteration:
+                file = room.get_file(transfer_stream.file_selector.hash)
+                if file is None:
                     log.info('Session rejected: requested file not found')
                     session.reject(404)
                     return
@@ -142,11 +261,16 @@ class ConferenceApplication(SylkApplication):
             else:
                 transfer_stream.handler.save_directory = os.path.join(settings.file_transfer.directory.normalized, room.uri)
 
+        streams = [stream for stream in (audio_stream, chat_stream, transfer_stream) if stream]
+        # the session can be accepted by admit, so its notifications must be observed before
         NotificationCenter().add_observer(self, sender=session)
-        if audio_stream:
+        admission = self.admission_controller.admit(room_uri, session, partial(self.accept_session, session, streams))
+        if admission == 'rejected':
+            log.warning('Session rejected: too many sessions waiting to join')
+            session.reject(480)
+            return
+        if admission == 'queued' and audio_stream:
             session.send_ring_indication()
-        streams = [stream for stream in (audio_stream, chat_stream, transfer_stream) if stream]
-        reactor.callLater(4 if audio_stream is not None else 0, self.accept_session, session, streams)
 
     def incoming_subscription(self, subscribe_request, data):
         from_header = data.headers.get('From', Null)
@@ -203,6 +327,12 @@ class ConferenceApplication(SylkApplication):
             log.info('Room %s - invite participant request rejected: unauthorized by access list' % data.request_uri)
             refer_request.reject(403)
             return
+        node = self.hosting_node(data.request_uri)
+        if node is not None:
+            # participants can only be added by the node which hosts the room
+            log.info('Room %s - join request forwarded to %s' % ('%s@%s' % (data.request_uri.user, data.request_uri.host), node))
+            ForwardedReferralHandler(refer_request, data, node).start()
+            return
         referral_handler = IncomingReferralHandler(refer_request, data)
         referral_handler.start()
 
@@ -226,8 +356,7 @@ class ConferenceApplication(SylkApplication):
         d.setdefault(str(session.remote_identity.uri), 0)
         d[str(session.remote_identity.uri)] += 1
         NotificationCenter().add_observer(self, sender=session)
-        room = self.get_room(room_uri, True)
-        room.start()
+        room = self.start_room(room_uri)
         room.add_session(session)
 
     def remove_participant(self, participant_uri, room_uri):
@@ -243,10 +372,25 @@ class ConferenceApplication(SylkApplication):
         handler = getattr(self, '_NH_%s' % notification.name, Null)
         handler(notification)
 
+    @run_in_twisted_thread
+    def _NH_ThorNetworkGotUpdate(self, notification):
+        self.placement.update(notification.data.networks)
+        moved_rooms = [room_uri for room_uri in self._rooms if not self.placement.is_local(room_uri)]
+        for room_uri in moved_rooms:
+            if room_uri in self._idle_rooms:
+                self._expire_room(SIPURI.parse('sip:%s' % room_uri))
+        if moved_rooms:
+            log.info('%d rooms now belong to other nodes, they will move once they become empty' % len(moved_rooms))
+        # nodes which just joined do not know where the moved rooms are hosted
+        self._publish_rooms()
+
+    @run_in_twisted_thread
+    def _NH_ThorNetworkGotConferenceRooms(self, notification):
+        self.placement.update_remote_rooms(notification.data.node, notification.data.rooms)
+
     def _NH_SIPSessionDidStart(self, notification):
         session = notification.sender
-        room = self.get_room(session.request_uri, True)
-        room.start()
+        room = self.start_room(session.request_uri)
         room.add_session(session)
 
     @run_in_green_thread
@@ -270,9 +414,7 @@ class ConferenceApplication(SylkApplication):
             return
         if session in room.sessions:
             room.remove_session(session)
-        if not room.stopping and room.empty:
-            self.remove_room(room_uri)
-            room.stop()
+        self.release_room(room_uri)
 
     def _NH_SIPSessionDidFail(self, notification):
         session = notification.sender
@@ -280,6 +422,55 @@ class ConferenceApplication(SylkApplication):
         log.info('Session from %s failed: %s (%s)' % (session.remote_identity.uri, notification.data.reason, notification.data.failure_reason))
 
 
+@implementer(IObserver)
+class ForwardedReferralHandler(object):
+    """Forwards a request to add a participant to the node which hosts the room"""
+
+    def __init__(self, refer_request, data, node):
+        self._refer_request = refer_request
+        self._refer_headers = data.headers
+        self.room_uri = data.request_uri
+        self.node = node
+        self._request = None
+
+    def start(self):
+        account = DefaultAccount()
+        transport = SIPSimpleSettings().sip.transport_list[0]
+        host, port = ConferenceApplication().placement.node_address(self.node, transport)
+        route = Route(host, port=port, transport=transport)
+        try:
+            contact_uri = account.contact[route]
+        except KeyError:
+            self._refer_request.reject(500)
+            return
+        request_uri = SIPURI.new(self.room_uri)
+        request_uri.parameters['maddr'] = host
+        from_header = self._refer_headers.get('From')
+        extra_headers = [Header.new(self._refer_headers.get('Refer-To'))]
+        if self._refer_headers.get('Referred-By', None) is not None:
+            extra_headers.append(Header.new(self._refer_headers.get('Referred-By')))
+        self._request = Request('REFER', request_uri, FromHeader(from_header.uri, from_header.display_name), ToHeader(SIPURI.new(self.room_uri)),
+                                RouteHeader(route.uri), contact_header=ContactHeader(contact_uri), extra_headers=extra_headers)
+        NotificationCenter().add_observer(self, sender=self._request)
+        self._request.send(timeout=5)
+
+    def handle_notification(self, notification):
+        handler = getattr(self, '_NH_%s' % notification.name, Null)
+        handler(notification)
+
+    def _NH_SIPRequestDidSucceed(self, notification):
+        self._refer_request.accept()
+        self._refer_request.end(200)
+
+    def _NH_SIPRequestDidFail(self, notification):
+        code = notification.data.code
+        self._refer_request.reject(code if 300 <= code < 700 else 500)
+
+    def _NH_SIPRequestDidEnd(self, notification):
+        notification.center.remove_observer(self, sender=notification.sender)
+        self._request = None
+
+
 @implementer(IObserver)
 class IncomingReferralHandler(object):
 
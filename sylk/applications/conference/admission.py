@@ -0,0 +1,178 @@
+
+"""Admission control for the sessions joining conference rooms"""
+
+import time
+
+from collections import deque
+from twisted.internet import reactor
+
+from sylk.applications.conference.configuration import ConferenceConfig
+from sylk.applications.conference.logger import log
+from sylk.session import IllegalStateError
+
+
+__all__ = 'AdmissionController', 'TokenBucket'
+
+
+class TokenBucket(object):
+    """A token bucket which allows rate operations per second on average, with bursts of up to burst operations"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.timestamp = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.tokens + (now - self.timestamp) * self.rate, self.burst)
+        self.timestamp = now
+
+    @property
+    def available(self):
+        if self.rate <= 0:
+            return True
+        self._refill()
+        return self.tokens >= 1
+
+    @property
+    def full(self):
+        return self.rate <= 0 or self.available and self.tokens >= self.burst
+
+    def consume(self):
+        if self.rate > 0:
+            self.tokens -= 1
+
+    def delay(self):
+        """The time until a token is available"""
+        if self.rate <= 0:
+            return 0
+        self._refill()
+        return max((1 - self.tokens) / self.rate, 0)
+
+
+class QueuedJoin(object):
+    __slots__ = 'room_uri', 'session', 'accept', 'timestamp'
+
+    def __init__(self, room_uri, session, accept):
+        self.room_uri = room_uri
+        self.session = session
+        self.accept = accept
+        self.timestamp = time.monotonic()
+
+
+class AdmissionStatistics(object):
+    def __init__(self):
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.abandoned = 0
+        self.total_queue_time = 0.0
+        self.max_queue_time = 0.0
+
+    @property
+    def average_queue_time(self):
+        return self.total_queue_time / self.queued if self.queued else 0.0
+
+
+class AdmissionController(object):
+    """
+    Limits the rate at which sessions join the conference rooms, both per room
+    and for the whole server, using token buckets. Sessions are accepted right
+    away while the rate allows it, otherwise they are queued (and get a ring
+    indication) and are accepted in order as soon as the rate allows it. Sessions
+    are rejected when the queue is full.
+    """
+
+    def __init__(self):
+        self._statistics = AdmissionStatistics()
+        self._global_bucket = TokenBucket(ConferenceConfig.join_rate, ConferenceConfig.join_burst)
+        self._room_buckets = {}
+        self._queue = deque()
+        self._timer = None
+
+    def stop(self):
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        for item in self._queue:
+            if item.session.state == 'incoming':
+                try:
+                    item.session.reject(503)
+                except IllegalStateError:
+                    pass
+        self._queue.clear()
+
+    def admit(self, room_uri, session, accept):
+        """
+        Call accept when the session can join the room. Returns 'accepted' if
+        accept was called right away, 'queued' if it will be called later and
+        'rejected' if the session must be rejected.
+        """
+        if not self._queue and self._try_accept(room_uri, session, accept):
+            return 'accepted'
+        if len(self._queue) >= ConferenceConfig.join_queue_size:
+            self._statistics.rejected += 1
+            return 'rejected'
+        self._queue.append(QueuedJoin(room_uri, session, accept))
+        log.info('Session %s queued for joining room %s (%d sessions waiting)' % (session.call_id, room_uri, len(self._queue)))
+        self._schedule()
+        return 'queued'
+
+    def _get_room_bucket(self, room_uri):
+        try:
+            return self._room_buckets[room_uri]
+        except KeyError:
+            if len(self._room_buckets) > 1000:
+                self._room_buckets = {uri: bucket for uri, bucket in self._room_buckets.items() if not bucket.full}
+            bucket = self._room_buckets[room_uri] = TokenBucket(ConferenceConfig.room_join_rate, ConferenceConfig.room_join_burst)
+            return bucket
+
+    def _try_accept(self, room_uri, session, accept):
+        room_bucket = self._get_room_bucket(room_uri)
+        if not self._global_bucket.available or not room_bucket.available:
+            return False
+        self._global_bucket.consume()
+        room_bucket.consume()
+        self._statistics.admitted += 1
+        accept()
+        return True
+
+    def _schedule(self):
+        if self._queue and (self._timer is None or not self._timer.active()):
+            delay = max(self._global_bucket.delay(), min(self._get_room_bucket(item.room_uri).delay() for item in self._queue))
+            self._timer = reactor.callLater(max(delay, 0.01), self._process_queue)
+
+    def _process_queue(self):
+        self._timer = None
+        blocked_rooms = set()
+        for item in list(self._queue):
+            if item.session.state != 'incoming':
+                self._queue.remove(item)
+                self._statistics.abandoned += 1
+                continue
+            if item.room_uri in blocked_rooms:
+                continue  # keep the order of the sessions joining the same room
+            if not self._global_bucket.available:
+                break
+            if self._try_accept(item.room_uri, item.session, item.accept):
+                self._queue.remove(item)
+                queue_time = time.monotonic() - item.timestamp
+                self._statistics.queued += 1
+                self._statistics.total_queue_time += queue_time
+                self._statistics.max_queue_time = max(self._statistics.max_queue_time, queue_time)
+                log.info('Session %s accepted for room %s after %.2f seconds in the join queue' % (item.session.call_id, item.room_uri, queue_time))
+            else:
+                blocked_rooms.add(item.room_uri)
+        self._schedule()
+
+    @property
+    def statistics(self):
+        statistics = self._statistics
+        return dict(admitted=statistics.admitted,
+                    queued=statistics.queued,
+                    rejected=statistics.rejected,
+                    abandoned=statistics.abandoned,
+                    queue_size=len(self._queue),
+                    average_queue_time=round(statistics.average_queue_time, 3),
+                    max_queue_time=round(statistics.max_queue_time, 3))
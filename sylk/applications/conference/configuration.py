@@ -5,11 +5,12 @@ import re
 from application.configuration import ConfigFile, ConfigSection, ConfigSetting
 from application.configuration.datatypes import StringList
 
+from sylk.acl import AccessPolicyCache, DomainSuffix
 from sylk.configuration import ServerConfig
 from sylk.configuration.datatypes import Path, URL
 
 
-__all__ = 'ConferenceConfig', 'get_room_config'
+__all__ = 'ConferenceConfig', 'get_room_config', 'get_room_access_policy'
 
 
 # Datatypes
@@ -24,6 +25,16 @@ class AccessPolicyValue(str):
         return str.__new__(cls, value)
 
 
+class HistoryStorageValue(str):
+    allowed_values = ('memory', 'file', 'cassandra')
+
+    def __new__(cls, value):
+        value = value.strip().lower()
+        if value not in cls.allowed_values:
+            raise ValueError('invalid value, allowed values are: %s' % ' | '.join(cls.allowed_values))
+        return str.__new__(cls, value)
+
+
 class Domain(str):
     domain_re = re.compile(r"^[a-zA-Z0-9\-_]+(\.[a-zA-Z0-9\-_]+)*$")
 
@@ -55,6 +66,8 @@ class PolicyItem(object):
             return 'all'
         elif '@' in item:
             return SIPAddress(item)
+        elif item.startswith(('*.', '.')):
+            return DomainSuffix(item)
         else:
             return Domain(item)
 
@@ -90,6 +103,21 @@ class ConferenceConfig(ConfigSection):
     __section__ = 'Conference'
 
     history_size = 20
+    history_storage = ConfigSetting(type=HistoryStorageValue, value=HistoryStorageValue('file'))
+    history_dir = ConfigSetting(type=Path, value=Path(os.path.join(ServerConfig.spool_dir.normalized, 'conference', 'history')))
+    history_cache_size = 10000
+    history_replay_size = 20
+    history_replay_max_age = 0
+    history_replay_batch_size = 10
+    history_replay_interval = 0.5
+
+    join_rate = 20
+    join_burst = 50
+    room_join_rate = 5
+    room_join_burst = 20
+    join_queue_size = 500
+
+    room_idle_timeout = 30
 
     access_policy = ConfigSetting(type=AccessPolicyValue, value=AccessPolicyValue('allow, deny'))
     allow = ConfigSetting(type=PolicySettingValue, value=PolicySettingValue('all'))
@@ -97,8 +125,10 @@ class ConferenceConfig(ConfigSection):
 
     file_transfer_dir = ConfigSetting(type=Path, value=Path(os.path.join(ServerConfig.spool_dir.normalized, 'conference', 'files')))
     push_file_transfer = False
+    max_outgoing_file_transfers = 5
 
     screensharing_images_dir = ConfigSetting(type=Path, value=Path(os.path.join(ServerConfig.spool_dir.normalized, 'conference', 'screensharing')))
+    save_screensharing_images = False
 
     advertise_xmpp_support = False
     pstn_access_numbers = ConfigSetting(type=StringList, value='')
@@ -106,6 +136,8 @@ class ConferenceConfig(ConfigSection):
 
     zrtp_auto_verify = True
 
+    conference_info_interval = 1.0
+
 
 class RoomConfig(ConfigSection):
     __cfgfile__ = 'conference.ini'
@@ -139,3 +171,9 @@ def get_room_config(room):
         config = Configuration(dict(RoomConfig))
     return config
 
+
+_room_access_policies = AccessPolicyCache(RoomConfig, get_room_config)
+
+
+def get_room_access_policy(room):
+    return _room_access_policies.get(room)
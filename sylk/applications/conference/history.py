@@ -0,0 +1,281 @@
+
+"""Chat history of the conference rooms"""
+
+import base64
+import datetime
+import json
+import os
+
+from application.python.types import Singleton
+from application.system import makedirs
+from collections import OrderedDict, deque
+from eventlib.twistedutil import block_on
+from itertools import islice
+from sipsimple.core import SIPURI
+from sipsimple.streams.msrp.chat import ChatIdentity
+from sipsimple.threading import run_in_thread
+from sipsimple.util import ISOTimestamp
+from twisted.internet import defer, reactor
+from twisted.python.failure import Failure
+
+from sylk.applications.conference.configuration import ConferenceConfig
+from sylk.applications.conference.logger import log
+from sylk.threadpool import run_in_pool
+
+
+__all__ = 'ConferenceHistory', 'HistoryMessage'
+
+
+class HistoryMessage(object):
+    """A chat message kept in the history of a room"""
+
+    __slots__ = 'content', 'content_type', 'sender', 'timestamp'
+
+    def __init__(self, content, content_type, sender, timestamp):
+        self.content = content
+        self.content_type = content_type
+        self.sender = sender
+        self.timestamp = timestamp
+
+    @classmethod
+    def from_message(cls, message):
+        return cls(message.content, message.content_type, message.sender, message.timestamp)
+
+    @classmethod
+    def from_record(cls, record):
+        data = json.loads(record)
+        content = data['content']
+        if data.get('encoding') == 'base64':
+            content = base64.b64decode(content)
+        sender = ChatIdentity(SIPURI.parse(data['sender']), display_name=data.get('display_name'))
+        return cls(content, data['content_type'], sender, ISOTimestamp(data['timestamp']))
+
+    def to_record(self):
+        data = dict(sender=str(self.sender.uri), display_name=self.sender.display_name, content_type=self.content_type, timestamp=str(self.timestamp))
+        if isinstance(self.content, bytes):
+            data.update(content=base64.b64encode(self.content).decode(), encoding='base64')
+        else:
+            data.update(content=self.content)
+        return json.dumps(data)
+
+
+class MemoryHistoryStorage(object):
+    """Keeps no history besides the in-memory cache"""
+
+    persistent = False
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def add(self, room_uri, message):
+        pass
+
+    def load(self, room_uri, count):
+        return defer.succeed([])
+
+
+class FileHistoryStorage(object):
+    """
+    Keeps the history of every room in a file with one record per line. New
+    messages are appended, and the file is rewritten with only the newest
+    history_size messages when it grows to twice that size, so it works as
+    a ring buffer which never holds more than 2 * history_size messages.
+    """
+
+    persistent = True
+
+    def __init__(self):
+        self._records = {}  # room uri -> number of records in the file
+
+    @property
+    def directory(self):
+        return ConferenceConfig.history_dir.normalized
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def _get_path(self, room_uri):
+        return os.path.join(self.directory, '%s.history' % room_uri.replace('/', '_'))
+
+    @run_in_pool('storage', key='room_uri')
+    def add(self, room_uri, message):
+        path = self._get_path(room_uri)
+        try:
+            records = self._records.get(room_uri)
+            if records is None:
+                records = self._records[room_uri] = len(self._read(path))
+            makedirs(self.directory)
+            with open(path, 'a') as f:
+                f.write(message.to_record() + '\n')
+            records += 1
+            if records >= 2 * ConferenceConfig.history_size:
+                records = self._compact(path)
+            self._records[room_uri] = records
+        except (OSError, IOError) as e:
+            log.warning('Could not save history for room %s: %s' % (room_uri, e))
+
+    def load(self, room_uri, count):
+        deferred = defer.Deferred()
+        self._load(room_uri, count, deferred)
+        return deferred
+
+    @run_in_pool('storage', key='room_uri')
+    def _load(self, room_uri, count, deferred):
+        try:
+            records = self._read(self._get_path(room_uri))
+            messages = [HistoryMessage.from_record(record) for record in records[-count:]] if count > 0 else []
+        except Exception:
+            reactor.callFromThread(deferred.errback, Failure())
+        else:
+            reactor.callFromThread(deferred.callback, messages)
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path, 'r') as f:
+                return [line for line in f if line.endswith('\n')]  # skip a partially written last line
+        except FileNotFoundError:
+            return []
+
+    def _compact(self, path):
+        records = self._read(path)[-ConferenceConfig.history_size:]
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as f:
+            f.writelines(records)
+        os.replace(temp_path, path)
+        return len(records)
+
+
+class CassandraHistoryStorage(object):
+    """Keeps the history of the rooms in Cassandra, using the WebRTC gateway Cassandra configuration"""
+
+    persistent = True
+
+    def start(self):
+        self._connect()
+
+    def stop(self):
+        pass
+
+    @run_in_thread('cassandra')
+    def _connect(self):
+        from sylk.applications.webrtcgateway.storage import CassandraConnection
+        CassandraConnection()
+
+    @run_in_thread('cassandra')
+    def add(self, room_uri, message):
+        from cassandra import InvalidRequest
+        from cassandra.cqlengine import CQLEngineException
+        from sylk.applications.webrtcgateway.models.storage.cassandra import ConferenceMessage
+        try:
+            ConferenceMessage.create(room=room_uri, record=message.to_record())
+        except (CQLEngineException, InvalidRequest) as e:
+            log.warning('Could not save history for room %s: %s' % (room_uri, e))
+
+    def load(self, room_uri, count):
+        deferred = defer.Deferred()
+
+        @run_in_thread('cassandra')
+        def query_messages():
+            from sylk.applications.webrtcgateway.models.storage.cassandra import ConferenceMessage
+            try:
+                rows = ConferenceMessage.objects(ConferenceMessage.room == room_uri).limit(count) if count > 0 else []
+                messages = [HistoryMessage.from_record(row.record) for row in rows]
+            except Exception:
+                reactor.callFromThread(deferred.errback, Failure())
+            else:
+                messages.reverse()  # rows are sorted newest first
+                reactor.callFromThread(deferred.callback, messages)
+
+        query_messages()
+        return deferred
+
+
+class ConferenceHistory(object, metaclass=Singleton):
+    """
+    Chat history shared by all the conference rooms. The newest messages of
+    recently used rooms are cached in memory, up to history_cache_size
+    messages in total; the least recently used rooms are dropped from the
+    cache when the limit is exceeded and their history is loaded from the
+    storage again when needed.
+    """
+
+    storage_types = dict(memory=MemoryHistoryStorage, file=FileHistoryStorage, cassandra=CassandraHistoryStorage)
+
+    def __init__(self):
+        self.storage = MemoryHistoryStorage()
+        self._cache = OrderedDict()  # room uri -> deque of HistoryMessage, least recently used first
+        self._cached_messages = 0
+        self._loading = {}  # room uri -> list of the messages added while the history of the room is loaded
+
+    def start(self):
+        storage_type = ConferenceConfig.history_storage
+        if storage_type == 'cassandra':
+            from sylk.applications.webrtcgateway.storage import CASSANDRA_MODULES_AVAILABLE
+            if not CASSANDRA_MODULES_AVAILABLE:
+                log.warning('Cassandra modules are not available, conference history will be stored in files')
+                storage_type = 'file'
+        self.storage = self.storage_types[storage_type]()
+        self.storage.start()
+
+    def stop(self):
+        self.storage.stop()
+        self._cache.clear()
+        self._cached_messages = 0
+        self._loading.clear()
+
+    def add(self, room_uri, message):
+        message = HistoryMessage.from_message(message)
+        history = self._cache.get(room_uri)
+        if history is None and room_uri in self._loading:
+            self._loading[room_uri].append(message)  # the storage may have been read already
+        elif history is None and not self.storage.persistent:
+            history = self._cache[room_uri] = deque(maxlen=ConferenceConfig.history_size)
+        if history is not None:
+            self._cached_messages -= len(history)
+            history.append(message)
+            self._cached_messages += len(history)
+            self._cache.move_to_end(room_uri)
+            self._evict()
+        self.storage.add(room_uri, message)
+
+    def get(self, room_uri, max_count, max_age=0):
+        """Return the most recent messages of a room, at most max_count of them and not older than max_age seconds (if not 0), oldest first"""
+        # should only be called from a green thread.
+        history = self._cache.get(room_uri)
+        if history is None:
+            added_messages = self._loading.setdefault(room_uri, [])
+            try:
+                messages = block_on(self.storage.load(room_uri, ConferenceConfig.history_size))
+            except Exception as e:
+                log.warning('Could not load history for room %s: %s' % (room_uri, e))
+                messages = []
+            history = self._cache.get(room_uri)  # the room may have been loaded by another green thread in the meantime
+            if history is None:
+                self._loading.pop(room_uri, None)
+                loaded = set((message.timestamp, message.content) for message in messages)
+                messages.extend(message for message in added_messages if (message.timestamp, message.content) not in loaded)
+                history = self._cache[room_uri] = deque(messages, maxlen=ConferenceConfig.history_size)
+                self._cached_messages += len(history)
+                self._evict()
+        self._cache.move_to_end(room_uri)
+        oldest_timestamp = ISOTimestamp.utcnow() - datetime.timedelta(seconds=max_age) if max_age else None
+        messages = []
+        for message in islice(reversed(history), max_count):
+            if oldest_timestamp is not None and message.timestamp < oldest_timestamp:
+                break
+            messages.append(message)
+        messages.reverse()
+        return messages
+
+    def _evict(self):
+        # the most recently used room is always kept
+        while self._cached_messages > ConferenceConfig.history_cache_size and len(self._cache) > 1:
+            room_uri, history = self._cache.popitem(last=False)
+            self._cached_messages -= len(history)
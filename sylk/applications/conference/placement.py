@@ -0,0 +1,73 @@
+
+"""Placement of the conference rooms on the SIP Thor nodes"""
+
+from sylk.configuration import SIPConfig, ThorNodeConfig
+
+
+__all__ = 'RoomPlacement',
+
+
+class RoomPlacement(object):
+    """
+    Decides which SIP Thor node hosts a conference room. Rooms are placed
+    using the consistent hashing of the conference_server Thor network, so
+    every node agrees on the owner of a room, and when nodes join or leave
+    only the rooms of the affected part of the ring change owner. Rooms which
+    are still hosted by their previous owner after such a change are announced
+    to the other nodes, so new participants join them there instead of in a
+    second instance of the room. Without SIP Thor (or before the first
+    network update) all rooms are local.
+    """
+
+    role = 'conference_server'
+
+    def __init__(self):
+        self.local_node = SIPConfig.local_ip.normalized
+        self.network = None
+        self.remote_rooms = {}  # node -> set of room uris it hosts, which the hash ring places on other nodes
+
+    @property
+    def enabled(self):
+        return ThorNodeConfig.enabled and self.network is not None
+
+    def update(self, networks):
+        self.network = networks.get(self.role)
+        if self.network is not None:
+            nodes = set(node.decode() if isinstance(node, bytes) else node for node in self.network.nodes)
+            self.remote_rooms = {node: rooms for node, rooms in self.remote_rooms.items() if node in nodes}
+
+    def update_remote_rooms(self, node, rooms):
+        if rooms:
+            self.remote_rooms[node] = rooms
+        else:
+            self.remote_rooms.pop(node, None)
+
+    def publish(self, rooms):
+        """Announce the rooms hosted here which the hash ring places on other nodes"""
+        if self.enabled:
+            from sylk.interfaces.sipthor import ConferenceNode
+            ConferenceNode().publish_rooms(rooms)
+
+    def owner(self, room_uri):
+        """Return the address of the node which owns the room on the hash ring, None if it is this node"""
+        if not self.enabled:
+            return None
+        node = self.network.lookup_node(room_uri.encode())
+        if isinstance(node, bytes):
+            node = node.decode()
+        return None if node in (None, self.local_node) else node
+
+    def lookup(self, room_uri):
+        """Return the address of the node which hosts the room, None if it is this node"""
+        for node, rooms in self.remote_rooms.items():
+            if room_uri in rooms:
+                return node
+        return self.owner(room_uri)
+
+    def is_local(self, room_uri):
+        return self.owner(room_uri) is None
+
+    @staticmethod
+    def node_address(node, transport):
+        """Return the (host, port) on which a node accepts requests over transport, all nodes use the same SIP ports"""
+        return node, getattr(SIPConfig, 'local_%s_port' % transport)
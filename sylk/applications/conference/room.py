@@ -3,15 +3,21 @@ import os
 import random
 import shutil
 import string
+import time
 import weakref
 import base64
+import hashlib
+import mimetypes
+import mmap
 
 from collections import Counter, deque
 from glob import glob
-from itertools import chain, count, cycle
+from itertools import chain, cycle
+from threading import Lock
 
 from application.notification import IObserver, NotificationCenter
 from application.python import Null
+from application.python.types import Singleton
 from application.system import makedirs
 from eventlib import api, coros, proc
 from sipsimple.account.bonjour import BonjourPresenceState
@@ -25,7 +31,7 @@ from sipsimple.payloads import conference
 from sipsimple.streams import MediaStreamRegistry
 from sipsimple.streams.msrp.chat import ChatIdentity, CPIMHeader, CPIMNamespace
 from sipsimple.streams.msrp.filetransfer import FileSelector
-from sipsimple.threading import run_in_thread, run_in_twisted_thread
+from sipsimple.threading import run_in_twisted_thread
 from sipsimple.threading.green import run_in_green_thread
 from sipsimple.util import ISOTimestamp
 from twisted.internet import reactor
@@ -33,12 +39,16 @@ from zope.interface import implementer
 
 from sylk.accounts import DefaultAccount
 from sylk.applications.conference.configuration import get_room_config, ConferenceConfig
+from sylk.applications.conference.history import ConferenceHistory
 from sylk.applications.conference.logger import log
+from sylk.audio import AudioFileCache
 from sylk.bonjour import BonjourService
 from sylk.configuration import ServerConfig, ThorNodeConfig
 from sylk.configuration.datatypes import URL
 from sylk.resources import Resources
 from sylk.session import Session, IllegalStateError
+from sylk.streams import EncodedMessage
+from sylk.threadpool import run_in_pool
 from sylk.web import server as web_server
 
 
@@ -55,16 +65,28 @@ def format_identity(identity):
 
 
 class ScreenImage(object):
+    """
+    The screen shared by a participant. Only the latest frame is kept, in
+    memory, along with its ETag; it is also written to disk if configured.
+    Screen images are kept for as long as the room exists, so their URLs stay
+    valid when the sender shares the screen again; only the frame and the
+    viewers are released when the sender stops sharing the screen.
+    """
+
     def __init__(self, room, sender):
         self.room = weakref.ref(room)
         self.room_uri = room.uri
         self.sender = sender
         self.filename = os.path.join(ConferenceConfig.screensharing_images_dir, room.uri, '%s@%s_%s.jpg' % (sender.uri.user.decode(), sender.uri.host.decode(), ''.join(random.sample(string.ascii_letters+string.digits, 10))))
+        self.name = os.path.basename(self.filename)
         url = web_server.url + '/conference/' + room.uri + '/screensharing'        
         self.url = URL(url)
-        self.url.query_items['image'] = os.path.basename(self.filename)
+        self.url.query_items['image'] = self.name
         self.state = None
         self.timer = None
+        self.frame = None
+        self.etag = None
+        self.viewers = set()
 
     @property
     def active(self):
@@ -74,7 +96,26 @@ class ScreenImage(object):
     def idle(self):
         return self.state == 'idle'
 
-    @run_in_thread('file-io')
+    def update(self, image):
+        if image != self.frame:
+            self.frame = image
+            self.etag = '"%s"' % hashlib.sha1(image).hexdigest()
+            for viewer in list(self.viewers):
+                viewer.send(image)
+            if ConferenceConfig.save_screensharing_images:
+                self.save(image)
+        self.advertise()
+
+    def close(self):
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+        for viewer in list(self.viewers):
+            viewer.close()
+        self.viewers.clear()
+        self.frame = self.etag = None
+
+    @run_in_pool('screenshots', key='self')
     def save(self, image):
         makedirs(os.path.dirname(self.filename))
         tmp_filename = self.filename + '.tmp'
@@ -88,7 +129,6 @@ class ScreenImage(object):
                 os.rename(tmp_filename, self.filename)
             except EnvironmentError:
                 pass
-            self.advertise()
 
     @run_in_twisted_thread
     def advertise(self):
@@ -100,7 +140,7 @@ class ScreenImage(object):
             self.state = 'active'
             self.timer = reactor.callLater(10, self.stop_advertising)
             room = self.room() or Null
-            room.dispatch_conference_info()
+            room.update_screen_image(self)
             txt = 'Room %s - %s is sharing the screen at %s' % (self.room_uri, format_identity(self.sender), self.url)
             room.dispatch_server_message(txt)
             log.info(txt)
@@ -113,7 +153,8 @@ class ScreenImage(object):
             self.state = 'idle'
             self.timer = None
             room = self.room() or Null
-            room.dispatch_conference_info()
+            room.update_screen_image(self)
+            self.close()
             txt = '%s stopped sharing the screen' % format_identity(self.sender)
             room.dispatch_server_message(txt)
             log.info(txt)
@@ -126,11 +167,13 @@ class Room(object):
     among all the participants.
     """
 
-    def __init__(self, uri):
+    def __init__(self, uri, setup_time_callback=Null):
         self.config = get_room_config(uri)
         self.uri = uri
         self.identity = ChatIdentity(SIPURI.parse('sip:%s' % self.uri), display_name='Conference Room')
-        self.files = []
+        self.files = {}  # hash -> RoomFile
+        self.outgoing_file_transfers = set()
+        self.file_transfer_queue = deque()
         self.screen_images = {}
         self.subject = ''
         self.sessions = []
@@ -140,13 +183,21 @@ class Room(object):
         self.message_dispatcher = None
         self.audio_conference = None
         self.moh_player = None
+        self.setup_time = 0.0
+        self.setup_time_callback = setup_time_callback  # called with the room and the time it took to start its audio conference
         self.conference_info_payload = None
-        self.conference_info_version = count(1)
+        self.conference_info_version = 1
+        self.conference_users = {}  # entity -> conference.User in conference_info_payload
+        self.conference_info_changes = set()  # entities changed since the last notification
+        self.conference_description_changed = False
+        self.conference_info_timer = None
+        self.conference_info_sent = 0
+        self.participant_sessions = {}  # entity -> list of sessions
+        self.chat_streams = {}  # session -> chat stream
         self.bonjour_services = Null
         self.session_nickname_map = {}
         self.last_nicknames_map = {}
         self.participants_counter = Counter()
-        self.history = deque(maxlen=ConferenceConfig.history_size)
 
     @property
     def empty(self):
@@ -166,33 +217,66 @@ class Room(object):
 
     @property
     def conference_info(self):
+        """The full conference-info document, which is sent to new subscriptions"""
+        payload = self._get_conference_info_payload()
+        payload.version = self.conference_info_version
+        payload.conference_state = conference.ConferenceState(user_count=len(self.participants_counter), active=True)
+        return payload.toxml()
+
+    def build_conference_info_delta(self):
+        """Build a partial conference-info document (RFC 4575) with the changes since the last notification, this increments the version"""
+        self.conference_info_version += 1
+        payload = conference.Conference(self.identity.uri, state='partial', version=self.conference_info_version)
+        payload.conference_state = conference.ConferenceState(user_count=len(self.participants_counter), active=True)
+        if self.conference_description_changed:
+            payload.conference_description = self._build_conference_description()
+        if self.conference_info_changes:
+            users = conference.Users(state='partial')
+            for entity in self.conference_info_changes:
+                user = self._build_conference_user(entity)
+                users.add(user if user is not None else conference.User(entity, state='deleted'))
+            payload.users = users
+        return payload.toxml()
+
+    def _get_conference_info_payload(self):
         if self.conference_info_payload is None:
-            settings = SIPSimpleSettings()
-            conference_description = conference.ConferenceDescription(display_text='Ad-hoc conference', free_text='Hosted by %s' % settings.user_agent, subject=self.subject)
-            conference_description.conf_uris = conference.ConfUris()
-            conference_description.conf_uris.add(conference.ConfUrisEntry('sip:%s' % self.uri, purpose='participation'))
-            if self.config.advertise_xmpp_support:
-                conference_description.conf_uris.add(conference.ConfUrisEntry('xmpp:%s' % self.uri, purpose='participation'))
-                # TODO: add grouptextchat service uri
-            for number in self.config.pstn_access_numbers:
-                conference_description.conf_uris.add(conference.ConfUrisEntry('tel:%s' % number, purpose='participation'))
             host_info = conference.HostInfo(web_page=conference.WebPage('http://sylkserver.com'))
-            self.conference_info_payload = conference.Conference(self.identity.uri, conference_description=conference_description, host_info=host_info, users=conference.Users())
-        self.conference_info_payload.version = next(self.conference_info_version)
-        user_count = len(self.participants_counter)
-        self.conference_info_payload.conference_state = conference.ConferenceState(user_count=user_count, active=True)
-        users = conference.Users()
-        for session in (session for session in self.sessions if not (len(session.streams) == 1 and session.streams[0].type == 'file-transfer')):
-            try:
-                user = next(user for user in users if user.entity == str(session.remote_identity.uri))
-            except StopIteration:
-                display_text = self.last_nicknames_map.get(str(session.remote_identity.uri), session.remote_identity.display_name)
-                user = conference.User(str(session.remote_identity.uri), display_text=display_text)
-                user_uri = '%s@%s' % (session.remote_identity.uri.user, session.remote_identity.uri.host)
-                screen_image = self.screen_images.get(user_uri, None)
-                if screen_image is not None and screen_image.active:
-                    user.screen_image_url = screen_image.url
-                users.add(user)
+            self.conference_info_payload = conference.Conference(self.identity.uri, conference_description=self._build_conference_description(), host_info=host_info, users=conference.Users())
+            self.conference_users = {}
+            for entity in self.participant_sessions:
+                user = self._build_conference_user(entity)
+                if user is not None:
+                    self.conference_info_payload.users.add(user)
+                    self.conference_users[entity] = user
+        return self.conference_info_payload
+
+    def _build_conference_description(self):
+        settings = SIPSimpleSettings()
+        conference_description = conference.ConferenceDescription(display_text='Ad-hoc conference', free_text='Hosted by %s' % settings.user_agent, subject=self.subject)
+        conference_description.conf_uris = conference.ConfUris()
+        conference_description.conf_uris.add(conference.ConfUrisEntry('sip:%s' % self.uri, purpose='participation'))
+        if self.config.advertise_xmpp_support:
+            conference_description.conf_uris.add(conference.ConfUrisEntry('xmpp:%s' % self.uri, purpose='participation'))
+            # TODO: add grouptextchat service uri
+        for number in self.config.pstn_access_numbers:
+            conference_description.conf_uris.add(conference.ConfUrisEntry('tel:%s' % number, purpose='participation'))
+        if self.files:
+            files = conference.FileResources(conference.FileResource(os.path.basename(file.name), file.hash, file.size, file.sender, 'OK') for file in self.files.values())
+            conference_description.resources = conference.Resources(files=files)
+        return conference_description
+
+    def _build_conference_user(self, entity):
+        sessions = [session for session in self.participant_sessions.get(entity, ()) if not (len(session.streams) == 1 and session.streams[0].type == 'file-transfer')]
+        if not sessions:
+            return None
+        remote_identity = sessions[0].remote_identity
+        display_text = self.last_nicknames_map.get(entity, remote_identity.display_name)
+        user = conference.User(entity, display_text=display_text)
+        user_uri = '%s@%s' % (remote_identity.uri.user, remote_identity.uri.host)
+        screen_image = self.screen_images.get(user_uri, None)
+        if screen_image is not None and screen_image.active:
+            user.screen_image_url = screen_image.url
+        for session in sessions:
             joining_info = conference.JoiningInfo(when=session.start_time)
             holdable_streams = [stream for stream in session.streams if stream.hold_supported]
             session_on_hold = holdable_streams and all(stream.on_hold_by_remote for stream in holdable_streams)
@@ -204,11 +288,32 @@ class Room(object):
                     continue
                 endpoint.add(conference.Media(id(stream), media_type=self.format_conference_stream_type(stream)))
             user.add(endpoint)
-        self.conference_info_payload.users = users
-        if self.files:
-            files = conference.FileResources(conference.FileResource(os.path.basename(file.name), file.hash, file.size, file.sender, 'OK') for file in self.files)
-            self.conference_info_payload.conference_description.resources = conference.Resources(files=files)
-        return self.conference_info_payload.toxml()
+        return user
+
+    def update_conference_user(self, entity):
+        """Rebuild the conference-info entry for the participant with the given entity URI"""
+        payload = self._get_conference_info_payload()
+        old_user = self.conference_users.pop(entity, None)
+        if old_user is not None:
+            payload.users.remove(old_user)
+        user = self._build_conference_user(entity)
+        if user is not None:
+            payload.users.add(user)
+            self.conference_users[entity] = user
+        if old_user is not None or user is not None:
+            self.conference_info_changes.add(entity)
+
+    def update_conference_description(self):
+        self._get_conference_info_payload().conference_description = self._build_conference_description()
+        self.conference_description_changed = True
+
+    def update_screen_image(self, screen_image):
+        sender_uri = screen_image.sender.uri
+        for entity, sessions in list(self.participant_sessions.items()):
+            uri = sessions[0].remote_identity.uri
+            if (uri.user, uri.host) == (sender_uri.user, sender_uri.host):
+                self.update_conference_user(entity)
+        self.dispatch_conference_info()
 
     def start(self):
         if self.started:
@@ -218,11 +323,21 @@ class Room(object):
             self.bonjour_services = BonjourService(service='sipuri', name='Conference Room %s' % room_user, uri_user=room_user)
             self.bonjour_services.start()
         self.message_dispatcher = proc.spawn(self._message_dispatcher)
+        self.state = 'started'
+
+    def start_audio(self):
+        # the audio conference is only created when the first audio stream joins the room
+        if self.audio_conference is not None or not self.started:
+            return 0.0
+        start_time = time.monotonic()
         self.audio_conference = AudioConference()
         self.audio_conference.hold()
         self.moh_player = MoHPlayer(self.audio_conference)
         self.moh_player.start()
-        self.state = 'started'
+        setup_time = time.monotonic() - start_time
+        log.debug('Room %s - audio conference started in %.1f ms' % (self.uri, setup_time * 1000))
+        self.setup_time_callback(self, setup_time)
+        return setup_time
 
     def stop(self):
         if not self.started:
@@ -234,7 +349,8 @@ class Room(object):
         self.incoming_message_queue = None
         self.message_dispatcher.kill(proc.ProcExit)
         self.message_dispatcher = None
-        self.moh_player.stop()
+        if self.moh_player is not None:
+            self.moh_player.stop()
         self.moh_player = None
         self.audio_conference = None
         notification_center = NotificationCenter()
@@ -242,11 +358,21 @@ class Room(object):
             notification_center.remove_observer(self, sender=subscription)
             subscription.end()
         self.subscriptions = []
+        for screen_image in self.screen_images.values():
+            screen_image.close()
+        self.screen_images = {}
+        self.file_transfer_queue.clear()
         self.cleanup_files()
+        if self.conference_info_timer is not None and self.conference_info_timer.active():
+            self.conference_info_timer.cancel()
+        self.conference_info_timer = None
         self.conference_info_payload = None
+        self.conference_users = {}
+        self.conference_info_changes.clear()
+        self.conference_description_changed = False
         self.state = 'stopped'
 
-    @run_in_thread('file-io')
+    @run_in_pool('housekeeping')
     def cleanup_files(self):
         path = os.path.join(ConferenceConfig.file_transfer_dir, self.uri)
         try:
@@ -282,7 +408,7 @@ class Room(object):
                 if private:
                     self.dispatch_private_message(session, message)
                 else:
-                    self.history.append(message)
+                    ConferenceHistory().add(self.uri, message)
                     self.dispatch_message(session, message)
             elif message_type == 'composing_indication':
                 if data.sender.uri != session.remote_identity.uri:
@@ -295,56 +421,79 @@ class Room(object):
                     self.dispatch_iscomposing(session, data)
 
     def dispatch_message(self, session, message):
-        for s in (s for s in self.sessions if s is not session):
-            try:
-                chat_stream = next(stream for stream in s.streams if stream.type == 'chat')
-            except StopIteration:
+        encoded_message = None
+        for s, chat_stream in self.chat_streams.items():
+            if s is session:
                 continue
-            chat_stream.send_message(message.content, message.content_type, sender=message.sender, recipients=[self.identity], timestamp=message.timestamp, additional_headers=message.additional_headers)
+            if encoded_message is None:
+                encoded_message = EncodedMessage(message.content, message.content_type, sender=message.sender, recipients=[self.identity], timestamp=message.timestamp, additional_headers=message.additional_headers)
+            chat_stream.send_encoded_message(encoded_message)
 
     def dispatch_private_message(self, session, message):
         # Private messages are delivered to all sessions matching the recipient but also to the sender,
         # for replication in clients
         recipient = message.recipients[0]
-        for s in (s for s in self.sessions if s is not session and s.remote_identity.uri in (recipient.uri, session.remote_identity.uri)):
-            try:
-                chat_stream = next(stream for stream in s.streams if stream.type == 'chat')
-            except StopIteration:
+        encoded_message = None
+        for s in self._get_sessions(recipient.uri, session.remote_identity.uri):
+            chat_stream = self.chat_streams.get(s)
+            if s is session or chat_stream is None:
                 continue
-            chat_stream.send_message(message.content, message.content_type, sender=message.sender, recipients=[recipient], timestamp=message.timestamp, additional_headers=message.additional_headers)
+            if encoded_message is None:
+                encoded_message = EncodedMessage(message.content, message.content_type, sender=message.sender, recipients=[recipient], timestamp=message.timestamp, additional_headers=message.additional_headers)
+            chat_stream.send_encoded_message(encoded_message)
 
     def dispatch_iscomposing(self, session, data):
         identity = ChatIdentity(session.remote_identity.uri, session.remote_identity.display_name)
-        for s in (s for s in self.sessions if s is not session):
-            try:
-                chat_stream = next(stream for stream in s.streams if stream.type == 'chat')
-            except StopIteration:
-                continue
-            chat_stream.send_composing_indication(data.state, data.refresh, sender=identity, recipients=[self.identity])
+        for s, chat_stream in self.chat_streams.items():
+            if s is not session:
+                chat_stream.send_composing_indication(data.state, data.refresh, sender=identity, recipients=[self.identity])
 
     def dispatch_private_iscomposing(self, session, data):
         identity = ChatIdentity(session.remote_identity.uri, session.remote_identity.display_name)
-        recipient_uri = data.recipients[0].uri
-        for s in (s for s in self.sessions if s is not session and s.remote_identity.uri == recipient_uri):
-            try:
-                chat_stream = next(stream for stream in s.streams if stream.type == 'chat')
-            except StopIteration:
-                continue
-            chat_stream.send_composing_indication(data.state, data.refresh, sender=identity)
+        for s in self._get_sessions(data.recipients[0].uri):
+            chat_stream = self.chat_streams.get(s)
+            if s is not session and chat_stream is not None:
+                chat_stream.send_composing_indication(data.state, data.refresh, sender=identity)
 
     def dispatch_server_message(self, content, content_type='text/plain', exclude=None):
         ns = CPIMNamespace('urn:ag-projects:xml:ns:cpim', prefix='agp')
         message_type = CPIMHeader('Message-Type', ns, 'status')
-        for session in (session for session in self.sessions if session is not exclude):
-            try:
-                chat_stream = next(stream for stream in session.streams if stream.type == 'chat')
-            except StopIteration:
+        encoded_message = None
+        for session, chat_stream in self.chat_streams.items():
+            if session is exclude:
                 continue
-            chat_stream.send_message(content, content_type, sender=self.identity, recipients=[self.identity], additional_headers=[message_type])
+            if encoded_message is None:
+                encoded_message = EncodedMessage(content, content_type, sender=self.identity, recipients=[self.identity], additional_headers=[message_type])
+            chat_stream.send_encoded_message(encoded_message)
+
+    def _get_sessions(self, *uris):
+        """Return the sessions of the participants with the given URIs"""
+        uris = set(str(uri) for uri in uris)
+        return [session for uri in uris for session in self.participant_sessions.get(uri, ())]
 
     def dispatch_conference_info(self):
-        data = self.conference_info
-        for subscription in (subscription for subscription in self.subscriptions if subscription.state.lower() == 'active'):
+        # Changes are coalesced, at most one notification is sent every conference_info_interval seconds
+        if self.conference_info_timer is not None and self.conference_info_timer.active():
+            return
+        delay = self.conference_info_sent + ConferenceConfig.conference_info_interval - reactor.seconds()
+        if delay > 0:
+            self.conference_info_timer = reactor.callLater(delay, self._send_conference_info)
+        else:
+            self._send_conference_info()
+
+    def _send_conference_info(self):
+        self.conference_info_timer = None
+        if not self.conference_info_changes and not self.conference_description_changed:
+            return
+        subscriptions = [subscription for subscription in self.subscriptions if subscription.state.lower() == 'active']
+        if subscriptions:
+            data = self.build_conference_info_delta()
+        else:
+            self.conference_info_version += 1
+        self.conference_info_changes.clear()
+        self.conference_description_changed = False
+        self.conference_info_sent = reactor.seconds()
+        for subscription in subscriptions:
             try:
                 subscription.push_content(conference.ConferenceDocument.content_type, data)
             except (SIPCoreError, SIPCoreInvalidStateError):
@@ -353,21 +502,38 @@ class Room(object):
     def dispatch_file(self, file):
         sender_uri = file.sender.uri
         for uri in set(session.remote_identity.uri for session in self.sessions if str(session.remote_identity.uri) != str(sender_uri)):
+            self.file_transfer_queue.append((uri, file))
+        self._start_file_transfers()
+
+    def _start_file_transfers(self):
+        while self.file_transfer_queue and len(self.outgoing_file_transfers) < ConferenceConfig.max_outgoing_file_transfers:
+            uri, file = self.file_transfer_queue.popleft()
             handler = FileTransferHandler(self)
+            self.outgoing_file_transfers.add(handler)
             handler.init_outgoing(uri, file)
 
+    def file_transfer_ended(self, handler):
+        self.outgoing_file_transfers.discard(handler)
+        if self.started:
+            self._start_file_transfers()
+
+    def get_file(self, hash):
+        return self.files.get(hash)
+
     def add_session(self, session):
         notification_center = NotificationCenter()
         notification_center.add_observer(self, sender=session)
         self.sessions.append(session)
         remote_uri = str(session.remote_identity.uri)
         self.participants_counter[remote_uri] += 1
+        self.participant_sessions.setdefault(remote_uri, []).append(session)
         try:
             chat_stream = next(stream for stream in session.streams if stream.type == 'chat')
         except StopIteration:
             pass
         else:
             notification_center.add_observer(self, sender=chat_stream)
+            self.chat_streams[session] = chat_stream
         try:
             audio_stream = next(stream for stream in session.streams if stream.type == 'audio')
         except StopIteration:
@@ -406,6 +572,7 @@ class Room(object):
 
         welcome_handler = WelcomeHandler(self, initial=True, session=session, streams=session.streams)
         welcome_handler.run()
+        self.update_conference_user(remote_uri)
         self.dispatch_conference_info()
 
         if len(self.sessions) == 1:
@@ -428,28 +595,35 @@ class Room(object):
         if self.participants_counter[remote_uri] == 0:
             del self.participants_counter[remote_uri]
             self.last_nicknames_map.pop(remote_uri, None)
+        participant_sessions = self.participant_sessions.get(remote_uri, [])
+        if session in participant_sessions:
+            participant_sessions.remove(session)
+        if not participant_sessions:
+            self.participant_sessions.pop(remote_uri, None)
         try:
             chat_stream = next(stream for stream in session.streams or [] if stream.type == 'chat')
         except StopIteration:
             pass
         else:
             notification_center.remove_observer(self, sender=chat_stream)
+        self.chat_streams.pop(session, None)
         try:
             audio_stream = next(stream for stream in session.streams or [] if stream.type == 'audio')
         except StopIteration:
             pass
         else:
             notification_center.remove_observer(self, sender=audio_stream)
-            try:
-                self.audio_conference.remove(audio_stream)
-            except ValueError:
-                # User may hangup before getting bridged into the conference
-                pass
-            if len(self.audio_conference.streams) == 0:
-                self.moh_player.pause()
-                self.audio_conference.hold()
-            elif len(self.audio_conference.streams) == 1 and not self.config.disable_music_on_hold:
-                self.moh_player.play()
+            if self.audio_conference is not None:
+                try:
+                    self.audio_conference.remove(audio_stream)
+                except ValueError:
+                    # User may hangup before getting bridged into the conference
+                    pass
+                if len(self.audio_conference.streams) == 0:
+                    self.moh_player.pause()
+                    self.audio_conference.hold()
+                elif len(self.audio_conference.streams) == 1 and not self.config.disable_music_on_hold:
+                    self.moh_player.play()
         try:
             next(stream for stream in session.streams if stream.type == 'file-transfer')
         except StopIteration:
@@ -458,6 +632,7 @@ class Room(object):
             if len(session.streams) == 1:
                 return
 
+        self.update_conference_user(remote_uri)
         self.dispatch_conference_info()
         log.info('Room %s - %s left conference after %s' % (self.uri, format_identity(session.remote_identity), self.format_session_duration(session)))
         if not self.sessions:
@@ -497,15 +672,28 @@ class Room(object):
 
     def add_file(self, file):
         self.dispatch_server_message('%s has uploaded file %s (%s)' % (format_identity(file.sender), os.path.basename(file.name), self.format_file_size(file.size)))
-        self.files.append(file)
+        self.files[file.hash] = file
+        self.update_conference_description()
         self.dispatch_conference_info()
         if ConferenceConfig.push_file_transfer:
             self.dispatch_file(file)
 
+    def get_history(self, max_count, max_age=0):
+        # should only be called from a green thread.
+        return ConferenceHistory().get(self.uri, max_count, max_age)
+
     def add_screen_image(self, sender, image):
         sender_uri = '%s@%s' % (sender.uri.user, sender.uri.host)
-        screen_image = self.screen_images.setdefault(sender_uri, ScreenImage(self, sender))
-        screen_image.save(image)
+        screen_image = self.screen_images.get(sender_uri)
+        if screen_image is None:
+            screen_image = self.screen_images[sender_uri] = ScreenImage(self, sender)
+        screen_image.update(image)
+
+    def get_screen_image(self, name):
+        try:
+            return next(screen_image for screen_image in self.screen_images.values() if screen_image.name == name)
+        except StopIteration:
+            return None
 
     def _update_bonjour_presence(self):
         num = len(self.sessions)
@@ -631,6 +819,7 @@ class Room(object):
             self.session_nickname_map.pop(session, None)
             self.last_nicknames_map.pop(str(session.remote_identity.uri), None)
         notification.sender.accept_nickname(chunk)
+        self.update_conference_user(str(session.remote_identity.uri))
         self.dispatch_conference_info()
 
     def _NH_SIPIncomingSubscriptionDidEnd(self, notification):
@@ -649,6 +838,7 @@ class Room(object):
                 log.info('Room %s - %s has put the audio session on hold' % (self.uri, format_identity(session.remote_identity)))
             else:
                 log.info('Room %s - %s has taken the audio session out of hold' % (self.uri, format_identity(session.remote_identity)))
+            self.update_conference_user(str(session.remote_identity.uri))
             self.dispatch_conference_info()
 
     def _NH_SIPSessionNewProposal(self, notification):
@@ -685,6 +875,8 @@ class Room(object):
         session = notification.sender
         for stream in notification.data.added_streams:
             notification.center.add_observer(self, sender=stream)
+            if stream.type == 'chat':
+                self.chat_streams[session] = stream
             txt = '%s has added %s' % (format_identity(session.remote_identity), stream.type)
             log.info('Room %s - %s' % (self.uri, txt))
             self.dispatch_server_message(txt, exclude=session)
@@ -710,10 +902,12 @@ class Room(object):
 
         for stream in notification.data.removed_streams:
             notification.center.remove_observer(self, sender=stream)
+            if stream.type == 'chat' and self.chat_streams.get(session) is stream:
+                del self.chat_streams[session]
             txt = '%s has removed %s' % (format_identity(session.remote_identity), stream.type)
             log.info('Room %s - %s' % (self.uri, txt))
             self.dispatch_server_message(txt, exclude=session)
-            if stream.type == 'audio':
+            if stream.type == 'audio' and self.audio_conference is not None:
                 try:
                     self.audio_conference.remove(stream)
                 except ValueError:
@@ -727,6 +921,7 @@ class Room(object):
             if not session.streams:
                 log.info('Room %s - %s has removed all streams, session will be terminated' % (self.uri, format_identity(session.remote_identity)))
                 session.end()
+        self.update_conference_user(str(session.remote_identity.uri))
         self.dispatch_conference_info()
 
     def _NH_SIPSessionTransferNewIncoming(self, notification):
@@ -790,15 +985,24 @@ class Room(object):
 
 
 @implementer(IObserver)
-class MoHPlayer(object):
+class MoHSource(object, metaclass=Singleton):
+    """
+    The music on hold source shared by all the rooms. A single player goes
+    through the playlist and it is bridged into the audio conferences of all
+    the rooms which play music on hold, so the files are read and resampled
+    once regardless of the number of rooms. It only plays while at least one
+    room uses it.
+    """
 
-    def __init__(self, conference):
-        self.conference = conference
+    def __init__(self):
         self.files = None
-        self.paused = None
+        self.conferences = set()
         self._player = None
+        self._state = 'stopped'  # stopped, playing or stopping; the player ends asynchronously
 
     def start(self):
+        if self._player is not None:
+            return
         files = glob('%s/*.wav' % Resources.get('sounds/moh'))
         if not files:
             log.error('No files found, MoH is disabled')
@@ -806,32 +1010,30 @@ class MoHPlayer(object):
         random.shuffle(files)
         self.files = cycle(files)
         self._player = WavePlayer(SIPApplication.voice_audio_mixer, '', pause_time=1, initial_delay=1, volume=20)
-        self.paused = True
-        self.conference.bridge.add(self._player)
         NotificationCenter().add_observer(self, sender=self._player)
 
-    def stop(self):
-        if self._player is None:
+    def add(self, conference):
+        if self._player is None or conference in self.conferences:
             return
-        NotificationCenter().remove_observer(self, sender=self._player)
-        self._player.stop()
-        self.paused = True
-        self.conference.bridge.remove(self._player)
-        self.conference = None
-
-    def play(self):
-        if self._player is not None and self.paused:
-            self.paused = False
+        self.conferences.add(conference)
+        conference.bridge.add(self._player)
+        if self._state == 'stopped':
             self._play_next_file()
+        # while stopping, playback restarts when the player ends
 
-    def pause(self):
-        if self._player is not None and not self.paused:
-            self.paused = True
+    def remove(self, conference):
+        if conference not in self.conferences:
+            return
+        self.conferences.remove(conference)
+        conference.bridge.remove(self._player)
+        if not self.conferences and self._state == 'playing':
+            self._state = 'stopping'
             self._player.stop()
 
     def _play_next_file(self):
         self._player.filename = next(self.files)
         self._player.play()
+        self._state = 'playing'
 
     @run_in_twisted_thread
     def handle_notification(self, notification):
@@ -839,12 +1041,39 @@ class MoHPlayer(object):
         handler(notification)
 
     def _NH_WavePlayerDidFail(self, notification):
-        if not self.paused:
+        # a file ended, or the player was stopped because no room used it, unless rooms were added meanwhile
+        self._state = 'stopped'
+        if self.conferences:
             self._play_next_file()
 
     _NH_WavePlayerDidEnd = _NH_WavePlayerDidFail
 
 
+class MoHPlayer(object):
+    """The music on hold of a room, played by the shared MoHSource"""
+
+    def __init__(self, conference):
+        self.conference = conference
+        self.paused = True
+
+    def start(self):
+        MoHSource().start()
+
+    def stop(self):
+        self.pause()
+        self.conference = None
+
+    def play(self):
+        if self.paused:
+            self.paused = False
+            MoHSource().add(self.conference)
+
+    def pause(self):
+        if not self.paused:
+            self.paused = True
+            MoHSource().remove(self.conference)
+
+
 @implementer(IObserver)
 class WelcomeHandler(object):
 
@@ -879,7 +1108,7 @@ class WelcomeHandler(object):
         finalize()
 
     def play_file_in_player(self, player, file, delay):
-        player.filename = file
+        player.filename = AudioFileCache().get(file, player.mixer.sample_rate)
         player.pause_time = delay
         try:
             player.play().wait()
@@ -920,6 +1149,7 @@ class WelcomeHandler(object):
             pass
         else:
             stream.bridge.remove(player)
+            self.room.start_audio()
             self.room.audio_conference.add(stream)
             self.room.audio_conference.unhold()
             if len(self.room.audio_conference.streams) == 1 and not self.room.config.disable_music_on_hold:
@@ -947,8 +1177,7 @@ class WelcomeHandler(object):
         if self.room.config.webrtc_gateway_url:
             message += 'WEB: {}\n'.format(str(self.room.config.webrtc_gateway_url).replace('$room', self.room.uri))
         stream.send_message(message.rstrip(), 'text/plain', sender=self.room.identity, recipients=[self.room.identity])
-        for msg in self.room.history:
-            stream.send_message(msg.content, msg.content_type, sender=msg.sender, recipients=[self.room.identity], timestamp=msg.timestamp)
+        self.replay_history(stream)
 
         # Send ZRTP SAS over the chat stream, if applicable
         if self.room.config.zrtp_auto_verify:
@@ -969,6 +1198,16 @@ class WelcomeHandler(object):
                         message_type = CPIMHeader('Message-Type', ns, 'status')
                         stream.send_message(message, 'text/plain', sender=self.room.identity, additional_headers=[message_type])
 
+    def replay_history(self, stream):
+        # History messages are sent in batches without delivery reports, pausing between batches
+        # so a new participant does not get a burst of chunks
+        batch_size = ConferenceConfig.history_replay_batch_size
+        for index, msg in enumerate(self.room.get_history(ConferenceConfig.history_replay_size, ConferenceConfig.history_replay_max_age), 1):
+            encoded_message = EncodedMessage(msg.content, msg.content_type, sender=msg.sender, recipients=[self.room.identity], timestamp=msg.timestamp)
+            stream.send_encoded_message(encoded_message, notify_progress=False)
+            if batch_size > 0 and index % batch_size == 0:
+                api.sleep(ConferenceConfig.history_replay_interval)
+
     def handle_notification(self, notification):
         handler = getattr(self, '_NH_%s' % notification.name, Null)
         handler(notification)
@@ -977,16 +1216,83 @@ class WelcomeHandler(object):
         self.procs.killall()
 
 
+class SharedFileReader(object):
+    """
+    A read-only file object over the memory map of a room file, every transfer
+    of the file gets its own reader. Reads return copies of the mapped data, as
+    the MSRP stack expects bytes, but the file is only opened and mapped once.
+    """
+
+    def __init__(self, name, map, release):
+        self.name = name
+        self.closed = False
+        self._map = map
+        self._position = 0
+        self._release = release
+
+    def read(self, size=-1):
+        start = self._position
+        end = len(self._map) if size is None or size < 0 else min(start + size, len(self._map))
+        self._position = max(start, end)
+        return self._map[start:end]
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += len(self._map)
+        if offset < 0:
+            raise ValueError('negative seek position %d' % offset)
+        self._position = offset
+        return offset
+
+    def tell(self):
+        return self._position
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._map = b''
+            self._release()
+
+
 class RoomFile(object):
+    """
+    A file uploaded to a room. The file is memory mapped the first time it is
+    requested and all the transfers of the file read it from the same map,
+    which is closed when the last of them closes its reader. Readers which are
+    never closed keep the map open until they are garbage collected.
+    """
+
     def __init__(self, name, hash, size, sender):
         self.name = name
         self.hash = hash
         self.size = size
         self.sender = sender
+        self._map = None
+        self._readers = 0
+        self._lock = Lock()  # readers are closed by the file transfer threads
 
     @property
     def file_selector(self):
-        return FileSelector.for_file(self.name, hash=self.hash)
+        with self._lock:
+            if self._map is None:
+                try:
+                    with open(self.name, 'rb') as file:
+                        self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                except (EnvironmentError, ValueError):  # empty files cannot be mapped
+                    return FileSelector.for_file(self.name, hash=self.hash)
+            self._readers += 1
+            reader = SharedFileReader(self.name, self._map, self._release_reader)
+        content_type = mimetypes.guess_type(self.name)[0] or 'application/octet-stream'
+        return FileSelector(name=self.name, type=content_type, size=self.size, hash=self.hash, fd=reader)
+
+    def _release_reader(self):
+        with self._lock:
+            self._readers -= 1
+            if self._readers == 0 and self._map is not None:
+                self._map.close()
+                self._map = None
 
 
 @implementer(IObserver)
@@ -1028,6 +1334,7 @@ class FileTransferHandler(object):
         try:
             route = lookup.lookup_sip_proxy(uri, settings.sip.transport_list).wait()[0]
         except (DNSLookupError, IndexError):
+            room.file_transfer_ended(self)
             return
 
         self.session = Session(account)
@@ -1036,6 +1343,7 @@ class FileTransferHandler(object):
         notification_center = NotificationCenter()
         notification_center.add_observer(self, sender=self.stream)
         notification_center.add_observer(self, sender=self.handler)
+        notification_center.add_observer(self, sender=self.session)
 
         from_header = FromHeader(SIPURI.new(room.identity.uri), 'Conference File Transfer')
         to_header = ToHeader(SIPURI.new(destination))
@@ -1047,9 +1355,13 @@ class FileTransferHandler(object):
         self.session.connect(from_header, to_header, route=route, streams=[self.stream], is_focus=True, extra_headers=extra_headers)
 
     def _terminate(self, failure_reason=None):
+        if self.stream is None:
+            return
         notification_center = NotificationCenter()
         notification_center.remove_observer(self, sender=self.stream)
         notification_center.remove_observer(self, sender=self.handler)
+        if self.direction == 'outgoing':
+            notification_center.remove_observer(self, sender=self.session)
 
         room = self.room()
         if room is not None:
@@ -1060,6 +1372,8 @@ class FileTransferHandler(object):
                     room.add_file(file)
             else:
                 room.dispatch_server_message('File transfer for %s failed: %s' % (os.path.basename(self.stream.file_selector.name), failure_reason))
+            if self.direction == 'outgoing':
+                room.file_transfer_ended(self)
 
         self.session = None
         self.stream = None
@@ -1073,6 +1387,9 @@ class FileTransferHandler(object):
     def _NH_MediaStreamDidNotInitialize(self, notification):
         self._terminate(failure_reason=notification.data.reason)
 
+    def _NH_SIPSessionDidFail(self, notification):
+        self._terminate(failure_reason=notification.data.reason)
+
     def _NH_FileTransferHandlerDidEnd(self, notification):
         if self.direction == 'incoming':
             if self.stream.direction == 'sendonly':
@@ -3,11 +3,12 @@ import os
 import urllib.request, urllib.parse, urllib.error
 
 from application.python.types import Singleton
+from twisted.internet import defer
+from twisted.internet.interfaces import IPushProducer
 from twisted.web.resource import ErrorPage, NoResource
-from twisted.web.static import File
+from zope.interface import implementer
 
-from sylk.applications.conference.configuration import ConferenceConfig
-from sylk.web import Klein
+from sylk.web import Klein, etag_matches
 
 
 class ConferenceWeb(object, metaclass=Singleton):
@@ -18,22 +19,9 @@ class ConferenceWeb(object, metaclass=Singleton):
         <head>
             <title>SylkServer Screen Sharing</title>
         </head>
-        <script type="text/javascript">
-            var today = new Date();
-            var c = today.getTime();
-
-            function reloadScreen() {
-                document.screenImage.src = "%(image)s" + "?" + c;
-                c = c + 1;
-            }
-
-            function startTimer() {
-                setTimeout('reloadScreen()', 1000);
-            }
-        </script>
         <body bgcolor="#999999">
             <div>
-                <img src='%(image)s' name='screenImage' onload='startTimer()' style='position: relative; top: 0px; margin: 0px 0px 0px 0px; clear: both; float: left; %(width)s' />
+                <img src='%(image)s' name='screenImage' style='position: relative; top: 0px; margin: 0px 0px 0px 0px; clear: both; float: left; %(width)s' />
             </div>
         </body>
         </html>
@@ -64,11 +52,10 @@ class ConferenceWeb(object, metaclass=Singleton):
         request.setHeader('Content-Type', 'text/html; charset=utf-8')
         if b'image' not in request.args or not request.args.get(b'image', [''])[0].endswith(b'jpg'):
             return ErrorPage(400, 'Bad Request', '\"image\" not provided')
-        images_path = os.path.join(ConferenceConfig.screensharing_images_dir, room.uri)
-        image_path = os.path.basename(urllib.parse.unquote(request.args[b'image'][0]))
-        if not os.path.isfile(os.path.join(images_path, image_path)):
+        image_name = os.path.basename(urllib.parse.unquote(request.args[b'image'][0].decode()))
+        if room.get_screen_image(image_name) is None:
             return NoResource('Image not found')
-        image = os.path.join('screensharing_img', image_path)
+        image = os.path.join('screensharing_stream', image_name)
         width = 'width: 100%' if 'fit' in request.args else ''
         return self.screensharing_template % dict(image=image, width=width)
 
@@ -78,6 +65,83 @@ class ConferenceWeb(object, metaclass=Singleton):
             room = self.conference._rooms[room_uri]
         except KeyError:
             return NoResource('Room not found')
-        images_path = os.path.join(ConferenceConfig.screensharing_images_dir, room.uri)
-        return File(os.path.join(images_path, os.path.basename(filename)))
+        screen_image = room.get_screen_image(os.path.basename(filename))
+        if screen_image is None or screen_image.frame is None:
+            return NoResource('Image not found')
+        request.setHeader('ETag', screen_image.etag)
+        request.setHeader('Cache-Control', 'no-cache')
+        if etag_matches(request, screen_image.etag):
+            request.setResponseCode(304)
+            return b''
+        request.setHeader('Content-Type', 'image/jpeg')
+        return screen_image.frame
+
+    @app.route('/<string:room_uri>/screensharing_stream/<string:filename>')
+    def screensharing_stream(self, request, room_uri, filename):
+        try:
+            room = self.conference._rooms[room_uri]
+        except KeyError:
+            return NoResource('Room not found')
+        screen_image = room.get_screen_image(os.path.basename(filename))
+        if screen_image is None:
+            return NoResource('Image not found')
+        return ScreenImageViewer(request, screen_image).start()
+
+
+@implementer(IPushProducer)
+class ScreenImageViewer(object):
+    """
+    Streams the frames of a screen sharing image to a browser as a
+    multipart/x-mixed-replace (MJPEG) response. Every new frame is pushed to
+    the viewer as soon as it arrives, frames which did not change are not sent.
+    The viewer is registered as the producer of the response, so while a slow
+    viewer's transport buffer is full frames are not written, only the latest
+    one is kept and sent when the transport asks for more data.
+    """
+
+    boundary = b'screensharing-frame'
+
+    def __init__(self, request, screen_image):
+        self.request = request
+        self.screen_image = screen_image
+        self.deferred = defer.Deferred()
+        self.paused = False
+        self.pending_frame = None
+
+    def start(self):
+        self.request.setHeader('Content-Type', 'multipart/x-mixed-replace; boundary=%s' % self.boundary.decode())
+        self.request.setHeader('Cache-Control', 'no-cache, no-store')
+        self.request.registerProducer(self, True)
+        self.screen_image.viewers.add(self)
+        self.request.notifyFinish().addBoth(lambda result: self.screen_image.viewers.discard(self))
+        if self.screen_image.frame is not None:
+            self.send(self.screen_image.frame)
+        return self.deferred
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        frame, self.pending_frame = self.pending_frame, None
+        if frame is not None:
+            self.send(frame)
+
+    def stopProducing(self):
+        self.pending_frame = None
+        self.screen_image.viewers.discard(self)
+
+    def send(self, frame):
+        if self.paused:
+            self.pending_frame = frame
+            return
+        self.request.write(b'--%s\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n' % (self.boundary, len(frame)))
+        self.request.write(frame)
+        self.request.write(b'\r\n')
 
+    def close(self):
+        self.screen_image.viewers.discard(self)
+        self.pending_frame = None
+        if not self.deferred.called:
+            self.request.unregisterProducer()
+            self.deferred.callback(b'--%s--\r\n' % self.boundary)
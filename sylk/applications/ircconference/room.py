@@ -24,7 +24,9 @@ from zope.interface import implementer
 
 from sylk.applications.ircconference.configuration import get_room_configuration
 from sylk.applications.ircconference.logger import log
+from sylk.audio import AudioFileCache
 from sylk.resources import Resources
+from sylk.streams import EncodedMessage
 
 
 def format_identity(identity):
@@ -157,31 +159,40 @@ class IRCRoom(object, metaclass=Singleton):
 
     def dispatch_message(self, session, message):
         identity = ChatIdentity.parse(format_identity(session.remote_identity))
+        encoded_message = None
         for s in (s for s in self.sessions if s is not session):
             try:
                 chat_stream = next(stream for stream in s.streams if stream.type == 'chat')
             except StopIteration:
                 pass
             else:
-                chat_stream.send_message(message.content, message.content_type, sender=identity, recipients=[self.identity], timestamp=message.timestamp)
+                if encoded_message is None:
+                    encoded_message = EncodedMessage(message.content, message.content_type, sender=identity, recipients=[self.identity], timestamp=message.timestamp)
+                chat_stream.send_encoded_message(encoded_message)
 
     def dispatch_irc_message(self, message):
+        encoded_message = None
         for session in self.sessions:
             try:
                 chat_stream = next(stream for stream in session.streams if stream.type == 'chat')
             except StopIteration:
                 pass
             else:
-                chat_stream.send_message(message.content, message.content_type, sender=message.sender, recipients=[self.identity])
+                if encoded_message is None:
+                    encoded_message = EncodedMessage(message.content, message.content_type, sender=message.sender, recipients=[self.identity])
+                chat_stream.send_encoded_message(encoded_message)
 
     def dispatch_server_message(self, content, content_type='text/plain', exclude=None):
+        encoded_message = None
         for session in (session for session in self.sessions if session is not exclude):
             try:
                 chat_stream = next(stream for stream in session.streams if stream.type == 'chat')
             except StopIteration:
                 pass
             else:
-                chat_stream.send_message(content, content_type, sender=self.identity, recipients=[self.identity])
+                if encoded_message is None:
+                    encoded_message = EncodedMessage(content, content_type, sender=self.identity, recipients=[self.identity])
+                chat_stream.send_encoded_message(encoded_message)
 
     def get_conference_info(self):
         # Send request to get participants list, we'll get a notification with it
@@ -487,7 +498,7 @@ class WelcomeHandler(object):
         self.proc = None
 
     def play_file_in_player(self, player, file, delay):
-        player.filename = file
+        player.filename = AudioFileCache().get(file, player.mixer.sample_rate)
         player.pause_time = delay
         try:
             player.play().wait()
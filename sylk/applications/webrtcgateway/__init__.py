@@ -1,23 +1,22 @@
 
-import os
-import time
+import signal
 import uuid
-import errno
 
 from application.notification import IObserver, NotificationCenter
+from application.process import process
 from application.python import Null
-from application.system import unlink
-from sipsimple.configuration.settings import SIPSimpleSettings
 from sipsimple.streams.msrp.chat import CPIMPayload, CPIMParserError
-from sipsimple.threading import run_in_thread
 from twisted.internet import defer, reactor
+from twisted.internet.task import LoopingCall
 from zope.interface import implementer
 
 from sylk.applications import SylkApplication
 from sylk.session import IllegalStateError
+from sylk.threadpool import run_in_pool
 
-from .configuration import GeneralConfig
+from .configuration import GeneralConfig, reload_configuration
 from .datatypes import FileTransferData
+from .housekeeper import FileTransferHousekeeper
 from .sip_handlers import FileTransferHandler, MessageHandler
 from .logger import log
 from .storage import TokenStorage, MessageStorage
@@ -29,8 +28,15 @@ class WebRTCGatewayApplication(SylkApplication):
     def __init__(self):
         self.web_handler = WebHandler()
         self.admin_web_handler = AdminWebHandler()
+        self.housekeeper = FileTransferHousekeeper()
+        self.config_reload_timer = LoopingCall(self._reload_configuration)
+        process.signals.add_handler(signal.SIGHUP, self._handle_sighup)
 
     def start(self):
+        # Load the room and authentication configuration and check it for changes from now on
+        reload_configuration()
+        if GeneralConfig.config_reload_interval > 0:
+            self.config_reload_timer.start(GeneralConfig.config_reload_interval, now=False)
         self.web_handler.start()
         self.admin_web_handler.start()
         # Load tokens from the storage
@@ -39,45 +45,22 @@ class WebRTCGatewayApplication(SylkApplication):
         # Setup message storage
         message_storage = MessageStorage()
         message_storage.load()
-        self.clean_filetransfers()
+        # Start removing expired file transfers
+        self.housekeeper.start()
 
     def stop(self):
         self.web_handler.stop()
         self.admin_web_handler.stop()
+        self.housekeeper.stop()
+        if self.config_reload_timer.running:
+            self.config_reload_timer.stop()
 
-    @run_in_thread('file-io')
-    def clean_filetransfers(self):
-        settings = SIPSimpleSettings()
-        top = settings.file_transfer.directory.normalized
-        removed_dirs = removed_files = 0
-        for root, dirs, files in os.walk(top, topdown=False):
-            for name in files:
-                file = os.path.join(root, name)
-                statinfo = os.stat(file)
-                current_time = time.time()
-                remove_after_days = GeneralConfig.filetransfer_expire_days
-                if (statinfo.st_size >= 1024 * 1024 * 50 and statinfo.st_mtime < current_time - 86400 * remove_after_days):
-                    log.info(f"[housekeeper] Removing expired filetransfer file: {file}")
-                    removed_files += 1
-                    unlink(file)
-                elif statinfo.st_mtime < current_time - 86400 * 2 * remove_after_days:
-                    log.info(f"[housekeeper] Removing expired file transfer file: {file}")
-                    removed_files += 1
-                    unlink(file)
-
-            for name in dirs:
-                dir = os.path.join(root, name)
-                try:
-                    os.rmdir(dir)
-                except OSError as ex:
-                    if ex.errno == errno.ENOTEMPTY:
-                        pass
-                else:
-                    removed_dirs += 1
-                    log.info(f"[housekeeper] Removing expired file transfer dir {dir}")
-
-        log.info(f"[housekeeper] Removed {removed_files} files, {removed_dirs} directories")
-        reactor.callLater(3600, self.clean_filetransfers)
+    def _handle_sighup(self, signum, frame):
+        reactor.callFromThread(self._reload_configuration)
+
+    @run_in_pool('housekeeping')
+    def _reload_configuration(self):
+        reload_configuration()
 
     def handle_notification(self, notification):
         handler = getattr(self, '_NH_%s' % notification.name, Null)
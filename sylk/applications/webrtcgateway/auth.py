@@ -1,13 +1,167 @@
+import hashlib
+import hmac
 import imaplib
-import socket
+import os
 import ssl
-from hashlib import md5
-from eventlib.twistedutil import deferToGreenThread
+import time
+
+from functools import lru_cache
+from application.python.types import Singleton
+from twisted.internet import defer
+
+from sylk.threadpool import defer_to_pool
 
 from .logger import log
 from .models import sylkrtc
 from .configuration import ExternalAuthConfig, get_auth_config
 
+
+__all__ = 'AuthHandler', 'CredentialCache'
+
+
+class AuthStatistics(object):
+    def __init__(self):
+        self.requests = 0
+        self.cache_hits = 0
+        self.negative_cache_hits = 0
+        self.coalesced = 0
+        self.verifications = 0
+        self.failures = 0
+        self.errors = 0
+        self.total_verification_time = 0.0
+        self.max_verification_time = 0.0
+
+    @property
+    def cache_hit_rate(self):
+        return (self.cache_hits + self.negative_cache_hits) / self.requests if self.requests else 0.0
+
+    @property
+    def average_verification_time(self):
+        return self.total_verification_time / self.verifications if self.verifications else 0.0
+
+
+class CredentialCacheEntry(object):
+    __slots__ = 'salt', 'digest', 'success', 'expire_time'
+
+    def __init__(self, password, success, ttl):
+        self.salt = os.urandom(16)
+        self.digest = self.hash(self.salt, password)
+        self.success = success
+        self.expire_time = time.monotonic() + ttl
+
+    @staticmethod
+    def hash(salt, password):
+        return hashlib.sha256(salt + password.encode()).digest()
+
+    @property
+    def expired(self):
+        return time.monotonic() >= self.expire_time
+
+    def matches(self, password):
+        return hmac.compare_digest(self.digest, self.hash(self.salt, password))
+
+
+class CredentialCache(object, metaclass=Singleton):
+    """
+    Remembers the outcome of external credential verifications, so accounts
+    which register again do not need a new round trip to the authentication
+    server. Passwords are only kept as salted hashes. Successful results are
+    kept for credential_cache_ttl seconds, failed ones for the shorter
+    credential_cache_negative_ttl, which also throttles repeated attempts with
+    a wrong password. Concurrent verifications of the same credentials share
+    a single request to the server.
+    """
+
+    def __init__(self):
+        self._statistics = AuthStatistics()
+        self._entries = {}  # (account, server) -> CredentialCacheEntry
+        self._pending = {}  # (account, server, password digest) -> [Deferred]
+
+    def verify(self, account, password, config):
+        """Return a Deferred which fires with True or False depending on the credentials being valid"""
+        self._statistics.requests += 1
+        key = account, config.imap_server
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry.expired:
+                del self._entries[key]
+            elif entry.matches(password):
+                if entry.success:
+                    self._statistics.cache_hits += 1
+                else:
+                    self._statistics.negative_cache_hits += 1
+                return defer.succeed(entry.success)
+        pending_key = key + (CredentialCacheEntry.hash(b'', password),)
+        deferred = defer.Deferred()
+        try:
+            self._pending[pending_key].append(deferred)
+        except KeyError:
+            self._pending[pending_key] = [deferred]
+            start_time = time.monotonic()
+            verification = defer_to_pool('authentication', self._verify_imap, account, password, config)
+            verification.addBoth(self._verification_finished, key, pending_key, password, start_time)
+        else:
+            self._statistics.coalesced += 1
+        return deferred
+
+    def _verification_finished(self, result, key, pending_key, password, start_time):
+        verification_time = time.monotonic() - start_time
+        self._statistics.verifications += 1
+        self._statistics.total_verification_time += verification_time
+        self._statistics.max_verification_time = max(self._statistics.max_verification_time, verification_time)
+        if isinstance(result, bool):
+            if result:
+                ttl = ExternalAuthConfig.credential_cache_ttl
+            else:
+                ttl = ExternalAuthConfig.credential_cache_negative_ttl
+                self._statistics.failures += 1
+            if ttl > 0:
+                self._entries[key] = CredentialCacheEntry(password, result, ttl)
+        else:
+            self._statistics.errors += 1
+            log.error('Could not verify credentials for {account}: {error}'.format(account=key[0], error=result.getErrorMessage()))
+            result = False  # do not cache, the server may be unavailable
+        for deferred in self._pending.pop(pending_key):
+            deferred.callback(result)
+
+    @property
+    def statistics(self):
+        statistics = self._statistics
+        return dict(requests=statistics.requests,
+                    cache_hits=statistics.cache_hits,
+                    negative_cache_hits=statistics.negative_cache_hits,
+                    cache_hit_rate=round(statistics.cache_hit_rate, 4),
+                    coalesced=statistics.coalesced,
+                    verifications=statistics.verifications,
+                    failures=statistics.failures,
+                    errors=statistics.errors,
+                    cached_accounts=len(self._entries),
+                    average_verification_time=round(statistics.average_verification_time, 6),
+                    max_verification_time=round(statistics.max_verification_time, 6))
+
+    @staticmethod
+    def _verify_imap(account, password, config):
+        user = account.partition('@')[0]
+        try:
+            imap_con = imaplib.IMAP4_SSL(config.imap_server, ssl_context=_get_imap_ssl_context(), timeout=ExternalAuthConfig.imap_timeout)
+        except ssl.SSLError:
+            log.error('SSL handshake failed for server {server}. Check your ca config!'.format(server=config.imap_server))
+            return False
+        try:
+            log.debug('trying imap login for {user}'.format(user=user))
+            try:
+                imap_con.login(user, password)
+            except imaplib.IMAP4.error:
+                log.info('imap auth failed for {user}'.format(user=user))
+                return False
+            return True
+        finally:
+            try:
+                imap_con.logout()
+            except (OSError, imaplib.IMAP4.error):
+                pass  # the server or the connection went away, logout closes the socket anyway and the result stands
+
+
 class AuthHandler(object):
     def __init__(self, account_info, connection):
         if ExternalAuthConfig.enable:
@@ -26,31 +180,15 @@ class AuthHandler(object):
             return 'SIP'
 
     def authenticate(self, proxy):
-        deferred = deferToGreenThread(self._authenticate, proxy)
-        deferred.addCallback(self._auth_finished)
-
-    def _authenticate(self, proxy):
         if self.auth_conf.auth_type == 'SIP':
             # for sip to continue we need to apply a ha1 hash
-            self.account_info.password = md5('{u}:{d}:{p}'.format(
-                    u=self.user,d=self.domain,p=self.password)).hexdigest()
-            return (True, proxy)
+            self.account_info.password = hashlib.md5('{u}:{d}:{p}'.format(u=self.user, d=self.domain, p=self.password).encode()).hexdigest()
+            self._auth_finished(True, proxy)
         elif self.auth_conf.auth_type == 'IMAP':
-            try:
-                imap_con = imaplib.IMAP4_SSL(self.auth_conf.imap_server)
-            except ssl.SSLError:
-                log.error('SSL handshake failed for server {server}. Check your ca config!'.format(server=self.auth_conf.imap_server))
-                return (False, None)
-            log.debug('trying imap login for {user}'.format(user=self.user))
-            try:
-                rv, data = imap_con.login(self.user, self.password)
-            except imaplib.IMAP4.error:
-                log.info('imap auth failed for {user}'.format(user=self.user))
-                return (False, None)
-            return (True, proxy)
+            deferred = CredentialCache().verify(self.account_info.id, self.password, self.auth_conf)
+            deferred.addCallback(self._auth_finished, proxy)
 
-    def _auth_finished(self, ret):
-        success, proxy = ret
+    def _auth_finished(self, success, proxy):
         if success:
             # callout to janus
             self.account_info.janus_handle.register(self.account_info, proxy=proxy)
@@ -63,17 +201,9 @@ class AuthHandler(object):
             log.info('registration for {account.id} failed: {reason}'.format(
                             account=self.account_info, reason=reason))
 
-# ca checks for imap4 ssl
-
-ca_cert_file = ExternalAuthConfig.imap_ca_cert_file
 
-def IMAP4SSL_open(self, host = '', port = imaplib.IMAP4_SSL_PORT):
-    self.host = host
-    self.port = port
-    self.sock = socket.create_connection((host, port))
-    self.sslobj = ssl.wrap_socket(self.sock, keyfile=self.keyfile, certfile=self.certfile,
-                                  server_side=False, cert_reqs=ssl.CERT_REQUIRED,
-                                  ca_certs=ca_cert_file)
-    self.file = self.sslobj.makefile('rb')
+# ca checks for imap4 ssl
 
-setattr(imaplib.IMAP4_SSL, 'open', IMAP4SSL_open)
+@lru_cache()
+def _get_imap_ssl_context():
+    return ssl.create_default_context(cafile=ExternalAuthConfig.imap_ca_cert_file)
@@ -0,0 +1,220 @@
+
+import time
+
+from application.python import limit
+from collections import Counter
+from twisted.internet import reactor
+from weakref import WeakKeyDictionary, WeakSet
+
+from .models import janus
+
+
+__all__ = 'BitrateController', 'VideoLayers'
+
+
+class LinkQuality(object):
+    """Congestion state of a publisher, derived from the slowlink reports for its own uplink and for its subscribers"""
+
+    decrease_factor = 0.75
+    recovery_step = 0.1
+    recovery_delay = 10  # seconds without slowlink reports before the bitrate starts to recover
+
+    def __init__(self):
+        self.factor = 1.0
+        self.last_reported = 0
+
+    def report(self, lost, weight=1.0):
+        # a subscriber report only counts for its share of the publisher's subscribers
+        decrease = 1 - (1 - self.decrease_factor) * weight
+        if lost > 100:
+            decrease = decrease ** 2
+        self.factor = max(self.factor * decrease, 0)
+        self.last_reported = time.monotonic()
+
+    def recover(self):
+        if self.factor < 1.0 and time.monotonic() - self.last_reported >= self.recovery_delay:
+            self.factor = min(self.factor + self.recovery_step, 1.0)
+            return True
+        return False
+
+    @property
+    def congested(self):
+        return self.factor < 1.0
+
+
+class VideoLayers(object):
+    """
+    Maps a quality level (0 = lowest, 2 = highest) to the VP8 simulcast
+    substream or VP9 SVC spatial layer, and the temporal layer, a subscriber
+    should receive. Other codecs have no layers.
+    """
+
+    max_level = 2
+    level_heights = ((540, 2), (270, 1))  # minimum viewport height for a level
+
+    @classmethod
+    def level_for_viewport(cls, height):
+        for min_height, level in cls.level_heights:
+            if height >= min_height:
+                return level
+        return 0
+
+    @classmethod
+    def options(cls, codec, level):
+        temporal = 2 if level > 0 else 1  # thumbnails do not need the full frame rate
+        if codec == 'vp8':
+            return dict(substream=level, temporal=temporal)
+        elif codec == 'vp9':
+            return dict(spatial_layer=level, temporal_layer=temporal)
+        else:
+            return {}
+
+
+class BitrateController(object):
+    """
+    Allocates the room bitrate to its publishers.
+
+    Active participants share the room bitrate and the others get the minimum
+    bitrate. If there are no active participants, the bitrate is split among
+    the publishers every participant receives. Publishers nobody subscribed
+    to get the minimum bitrate, and publishers with slow links get less until
+    the link recovers.
+
+    Subscribers receive the simulcast / SVC layer matching their viewport,
+    the highest one for active participants' feeds. If they did not declare
+    a viewport, feeds of other participants are treated as thumbnails when
+    there are active participants. Subscribers with slow links get one layer
+    less.
+
+    Updates are debounced, so a burst of joins, leaves, subscriptions and
+    slowlink reports results in a single allocation which sends at most one
+    message per publisher or subscriber whose settings actually changed.
+    """
+
+    min_bitrate = 100000
+    update_delay = 0.5     # seconds to wait for more changes before sending the updates
+    recovery_interval = 5  # seconds between bitrate recovery steps for congested publishers
+    change_threshold = 0.1  # minimum relative change for sending an update to janus
+
+    def __init__(self, room):
+        self.room = room
+        self.link_quality = WeakKeyDictionary()  # publisher session -> LinkQuality
+        self.subscribers = WeakSet()
+        self._update_timer = None
+        self._recovery_timer = None
+
+    def stop(self):
+        for timer in (self._update_timer, self._recovery_timer):
+            if timer is not None and timer.active():
+                timer.cancel()
+        self._update_timer = self._recovery_timer = None
+
+    def schedule_update(self):
+        if self._update_timer is None or not self._update_timer.active():
+            self._update_timer = reactor.callLater(self.update_delay, self._update)
+
+    def add_subscriber(self, session):
+        self.subscribers.add(session)
+        self.schedule_update()
+
+    def discard_subscriber(self, session):
+        self.subscribers.discard(session)
+        self.schedule_update()
+
+    def report_slowlink(self, session, lost):
+        """Process a slowlink report for a publisher or subscriber session"""
+        if session.type == 'publisher':
+            publisher, weight = session, 1.0
+        else:
+            try:
+                publisher = self.room[session.publisher_id]
+            except KeyError:
+                return
+            subscriber_count = sum(1 for participant in self.room if publisher in participant.feeds)
+            weight = 1.0 / max(subscriber_count, 1)
+        try:
+            link_quality = self.link_quality[publisher]
+        except KeyError:
+            link_quality = self.link_quality[publisher] = LinkQuality()
+        link_quality.report(lost, weight)
+        self.schedule_update()
+
+    def allocate(self):
+        """Return a mapping of publisher sessions to their bitrate"""
+        sessions = list(self.room)
+        if not sessions:
+            return {}
+        max_bitrate = self.room.config.max_bitrate
+        min_bitrate = min(self.min_bitrate, max_bitrate)
+        active_participants = set(self.room.active_participants)
+        subscriber_counts = Counter(publisher for session in sessions for publisher in session.feeds)
+        allocation = {}
+        for session in sessions:
+            if active_participants:
+                bitrate = max_bitrate // len(active_participants) if session.id in active_participants else min_bitrate
+            else:
+                bitrate = max_bitrate // limit(len(sessions) - 1, min=1)
+            if not subscriber_counts[session] and len(sessions) > 1:
+                bitrate = min_bitrate
+            link_quality = self.link_quality.get(session)
+            if link_quality is not None and link_quality.congested:
+                bitrate = int(bitrate * link_quality.factor)
+            allocation[session] = limit(bitrate, min=min_bitrate, max=max_bitrate)
+        return allocation
+
+    def select_layer(self, subscriber):
+        """Return the quality level for a subscriber session"""
+        active_participants = self.room.active_participants
+        if subscriber.publisher_id in active_participants:
+            level = VideoLayers.max_level
+        elif subscriber.viewport is not None:
+            level = VideoLayers.level_for_viewport(subscriber.viewport[1])
+        elif active_participants:
+            level = 0
+        else:
+            level = VideoLayers.max_level if len(self.room) <= 3 else 1
+        if subscriber.slow_download:
+            level = max(level - 1, 0)
+        return level
+
+    def _update(self):
+        self._update_timer = None
+        allocation = self.allocate()
+        updates = 0
+        for session, bitrate in allocation.items():
+            if self._significant_change(session.bitrate, bitrate):
+                session.bitrate = bitrate
+                session.janus_handle.message(janus.VideoroomUpdatePublisher(bitrate=bitrate), _async=True)
+                updates += 1
+        if updates:
+            self.room.log.debug('updated bitrate for {} of {} publishers'.format(updates, len(allocation)))
+        codec = self.room.config.video_codec
+        updates = 0
+        for subscriber in list(self.subscribers):
+            options = VideoLayers.options(codec, self.select_layer(subscriber))
+            if options and options != subscriber.video_layers:
+                subscriber.video_layers = options
+                subscriber.janus_handle.message(janus.VideoroomFeedUpdate(**options), _async=True)
+                updates += 1
+        if updates:
+            self.room.log.debug('updated video layers for {} of {} subscribers'.format(updates, len(self.subscribers)))
+        if any(quality.congested for quality in self.link_quality.values()):
+            if self._recovery_timer is None or not self._recovery_timer.active():
+                self._recovery_timer = reactor.callLater(self.recovery_interval, self._recover)
+
+    def _significant_change(self, current, bitrate):
+        if current is None:
+            return True
+        elif bitrate == current:
+            return False
+        elif bitrate in (self.min_bitrate, self.room.config.max_bitrate):
+            return True  # always reach the limits
+        else:
+            return abs(bitrate - current) >= current * self.change_threshold
+
+    def _recover(self):
+        self._recovery_timer = None
+        if any([quality.recover() for quality in self.link_quality.values()]):
+            self.schedule_update()
+        elif any(quality.congested for quality in self.link_quality.values()):
+            self._recovery_timer = reactor.callLater(self.recovery_interval, self._recover)
@@ -0,0 +1,195 @@
+
+from urllib.parse import urlparse
+
+from .configuration import JanusConfig
+from .janus import JanusError, JanusReplicaBackends, JanusSession, VideoroomPluginHandle
+from .logger import log
+from .models import janus
+
+
+__all__ = 'VideoroomCascade', 'VideoroomReplica'
+
+
+class VideoroomReplica(object):
+    """A copy of a videoroom on a secondary Janus instance, fed with the publishers forwarded from the primary instance"""
+
+    def __init__(self, cascade, backend):
+        self.cascade = cascade
+        self.backend = backend
+        self.remote_id = 'sylk-{}'.format(urlparse(backend.url).netloc)
+        self.subscribers = 0
+        self.publishers = set()  # IDs of the publishers which can be subscribed to on this replica
+        self.janus_session = None
+        self.janus_handle = None
+        self._pending = set()    # IDs of the publishers being forwarded
+
+    @property
+    def room(self):
+        return self.cascade.room
+
+    @property
+    def load(self):
+        return self.subscribers
+
+    def start(self):
+        # should only be called from a green thread.
+        janus_session = JanusSession(backend=self.backend)
+        config = self.room.config
+        try:
+            janus_handle = VideoroomPluginHandle(janus_session, event_handler=self._handle_janus_event)
+            try:
+                janus_handle.message(janus.VideoroomCreate(room=self.room.id, videocodec=config.video_codec, bitrate=config.max_bitrate, publishers=config.max_publishers))
+            except JanusError as e:
+                if e.code != 427:  # 427 means room already exists
+                    raise
+        except Exception:
+            janus_session.destroy()
+            raise
+        self.janus_session = janus_session
+        self.janus_handle = janus_handle
+
+    def stop(self):
+        self.publishers.clear()
+        self._pending.clear()
+        if self.janus_session is not None:
+            janus_session = self.janus_session
+            self.backend.set_event_handler(self.janus_handle.id, None)
+            deferred = self.janus_handle.message(janus.VideoroomDestroy(room=self.room.id), _async=True)
+            deferred.addBoth(lambda result: janus_session.destroy())  # this automatically detaches the plugin handle
+            self.janus_session = self.janus_handle = None
+
+    def forward(self, publisher, streams):
+        publisher_id = publisher.publisher_id
+        if self.janus_handle is None or publisher_id in self.publishers or publisher_id in self._pending:
+            return
+        self._pending.add(publisher_id)
+        deferred = self.janus_handle.add_remote_publisher(self.room.id, publisher_id, publisher.account.display_name or None, streams, _async=True)
+        deferred.addCallback(self._remote_publisher_added, publisher_id)
+        deferred.addCallback(self._forwarding_started, publisher_id)
+        deferred.addErrback(self._forwarding_failed, publisher_id)
+
+    def discard(self, publisher):
+        publisher_id = publisher.publisher_id
+        self._pending.discard(publisher_id)
+        if publisher_id in self.publishers:
+            self.publishers.discard(publisher_id)
+            self.cascade.janus_handle.unpublish_remotely(self.room.id, publisher_id, self.remote_id, _async=True).addErrback(self._log_error)
+            self.janus_handle.remove_remote_publisher(self.room.id, publisher_id, _async=True).addErrback(self._log_error)
+
+    def _remote_publisher_added(self, response, publisher_id):
+        if publisher_id not in self._pending or self.cascade.janus_handle is None:
+            return None
+        data = response.plugindata.data  # type: janus.VideoroomSuccess
+        host = data.ip or urlparse(self.backend.url).hostname
+        return self.cascade.janus_handle.publish_remotely(self.room.id, publisher_id, self.remote_id, host, data.port, data.rtcp_port, _async=True)
+
+    def _forwarding_started(self, response, publisher_id):
+        if response is not None and publisher_id in self._pending:
+            self._pending.discard(publisher_id)
+            self.publishers.add(publisher_id)
+            self.room.log.debug('forwarding publisher {} to {}'.format(publisher_id, self.backend.url))
+
+    def _forwarding_failed(self, failure, publisher_id):
+        self._pending.discard(publisher_id)
+        self.room.log.warning('could not forward publisher {} to {}: {}'.format(publisher_id, self.backend.url, failure.getErrorMessage()))
+
+    def _log_error(self, failure):
+        self.room.log.warning('cascading request to {} failed: {}'.format(self.backend.url, failure.getErrorMessage()))
+
+    def _handle_janus_event(self, event):
+        log.debug('janus event for replica of room {} on {}: {}'.format(self.room.uri, self.backend.url, event.__data__))
+
+    def __repr__(self):
+        return '<{0.__class__.__name__}: url={0.backend.url!r} subscribers={0.subscribers!r} publishers={1!r}>'.format(self, len(self.publishers))
+
+
+class VideoroomCascade(object):
+    """
+    Spreads the subscribers of a large videoroom over multiple Janus instances.
+
+    Publishers always join the room on the primary Janus instance. For rooms
+    with cascading enabled, replicas of the room are created on the secondary
+    instances as the number of subscribers grows, and the publishers are
+    forwarded to them using RTP forwarders (Janus remote publishers). New
+    subscribers are attached to the least loaded instance which already
+    receives the publisher they subscribe to.
+    """
+
+    def __init__(self, room):
+        self.room = room
+        self.replicas = []
+        self.subscribers = 0  # subscribers served by the primary instance
+        self.janus_session = None
+        self.janus_handle = None
+        self._publishers = {}  # publisher session -> streams
+
+    @property
+    def enabled(self):
+        return self.room.config.cascade and bool(JanusReplicaBackends().backends)
+
+    def add_publisher(self, publisher, streams):
+        if not self.enabled or not streams or publisher in self._publishers:
+            return
+        self._publishers[publisher] = streams
+        for replica in self.replicas:
+            replica.forward(publisher, streams)
+
+    def discard_publisher(self, publisher):
+        if self._publishers.pop(publisher, None) is not None:
+            for replica in self.replicas:
+                replica.discard(publisher)
+
+    def select_replica(self, publisher):
+        """Return the replica a new subscriber to publisher should use, None for the primary instance"""
+        # should only be called from a green thread.
+        if not self.enabled:
+            return None
+        candidates = [(self.subscribers, None)] + [(replica.load, replica) for replica in self.replicas if publisher.publisher_id in replica.publishers]
+        load, replica = min(candidates, key=lambda item: item[0])
+        if load >= JanusConfig.cascade_subscribers_per_instance:
+            self._add_replica()  # the new replica is used once the publishers are forwarded to it
+        return replica
+
+    def attach(self, replica):
+        if replica is None:
+            self.subscribers += 1
+        else:
+            replica.subscribers += 1
+
+    def release(self, replica):
+        if replica is None:
+            self.subscribers = max(self.subscribers - 1, 0)
+        else:
+            replica.subscribers = max(replica.subscribers - 1, 0)
+
+    def stop(self):
+        for replica in self.replicas:
+            replica.stop()
+        self.replicas = []
+        self._publishers.clear()
+        if self.janus_session is not None:
+            self.janus_session.backend.set_event_handler(self.janus_handle.id, None)
+            self.janus_session.destroy()  # this automatically detaches the plugin handle
+            self.janus_session = self.janus_handle = None
+
+    def _add_replica(self):
+        used_backends = {replica.backend for replica in self.replicas}
+        available_backends = [backend for backend in JanusReplicaBackends().ready if backend not in used_backends]
+        if not available_backends:
+            return
+        replica = VideoroomReplica(self, available_backends[0])
+        try:
+            if self.janus_handle is None:
+                self.janus_session = JanusSession()
+                self.janus_handle = VideoroomPluginHandle(self.janus_session, event_handler=self._handle_janus_event)
+            replica.start()
+        except Exception as e:
+            self.room.log.warning('could not extend room to {}: {}'.format(replica.backend.url, e))
+            return
+        self.replicas.append(replica)
+        self.room.log.info('extended room to {} ({} instances)'.format(replica.backend.url, len(self.replicas) + 1))
+        for publisher, streams in self._publishers.items():
+            replica.forward(publisher, streams)
+
+    def _handle_janus_event(self, event):
+        log.debug('janus event for cascading of room {}: {}'.format(self.room.uri, event.__data__))
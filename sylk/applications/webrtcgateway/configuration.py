@@ -2,14 +2,16 @@
 import os
 import re
 
+from application import log
 from application.configuration import ConfigFile, ConfigSection, ConfigSetting
 from application.configuration.datatypes import NetworkAddress, StringList, HostnameList
 
+from sylk.acl import AccessPolicy, DomainSuffix
 from sylk.configuration import ServerConfig
 from sylk.configuration.datatypes import Path, SIPProxyAddress, VideoBitrate, VideoCodec
 
 
-__all__ = 'GeneralConfig', 'JanusConfig', 'get_room_config', 'ExternalAuthConfig', 'get_auth_config', 'CassandraConfig'
+__all__ = 'GeneralConfig', 'JanusConfig', 'get_room_config', 'ExternalAuthConfig', 'get_auth_config', 'reload_configuration', 'CassandraConfig'
 
 
 # Datatypes
@@ -55,6 +57,8 @@ class PolicyItem(object):
             return 'all'
         elif '@' in item:
             return SIPAddress(item)
+        elif item.startswith(('*.', '.')):
+            return DomainSuffix(item)
         else:
             return Domain(item)
 
@@ -131,6 +135,8 @@ class GeneralConfig(ConfigSection):
     sylk_push_url = ConfigSetting(type=str, value=None)
     local_sip_messages = False
     filetransfer_expire_days = 15
+    filetransfer_expire_rate = 100
+    config_reload_interval = 60
 
 
 class JanusConfig(ConfigSection):
@@ -143,6 +149,8 @@ class JanusConfig(ConfigSection):
     max_bitrate = ConfigSetting(type=VideoBitrate, value=VideoBitrate(2016000))  # ~2 MBits/s
     video_codec = ConfigSetting(type=VideoCodec, value=VideoCodec('vp9'))
     decline_code = 486
+    cascade_api_urls = ConfigSetting(type=StringList, value=[])
+    cascade_subscribers_per_instance = 100
 
 
 class CassandraConfig(ConfigSection):
@@ -166,35 +174,102 @@ class RoomConfig(ConfigSection):
     video_disabled = False
     invite_participants = ConfigSetting(type=SIPAddressList, value=[])
     persistent = False
+    max_publishers = 10
+    cascade = False
 
 
-class VideoroomConfiguration(object):
+class ImmutableConfiguration(object):
+    def __init__(self, data):
+        self.__dict__.update(data)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('{0.__class__.__name__} objects are read-only'.format(self))
+
+    def __delattr__(self, name):
+        raise AttributeError('{0.__class__.__name__} objects are read-only'.format(self))
+
+
+class VideoroomConfiguration(ImmutableConfiguration):
     video_codec = 'vp9'
     max_bitrate = 2016000
+    max_publishers = 10
     record = False
     recording_dir = None
     filesharing_dir = None
 
-    def __init__(self, data):
-        self.__dict__.update(data)
-
     @property
     def janus_data(self):
-        return dict(videocodec=self.video_codec, bitrate=self.max_bitrate, record=self.record, rec_dir=self.recording_dir)
+        return dict(videocodec=self.video_codec, bitrate=self.max_bitrate, publishers=self.max_publishers, record=self.record, rec_dir=self.recording_dir)
+
+
+class ConfigurationSnapshot(object):
+    """
+    The sections of a parsed configuration file. Sections are converted into
+    configuration objects the first time they are requested and then reused,
+    without modifying the ConfigSection which describes them.
+    """
+
+    def __init__(self, config_file, config_section, factory):
+        self.config_file = config_file
+        self.config_section = config_section
+        self.factory = factory
+        self.defaults = dict(config_section)
+        self.objects = {}
+
+    def get(self, name):
+        try:
+            return self.objects[name]
+        except KeyError:
+            return self.objects.setdefault(name, self.factory(name, self._parse_section(name)))
+
+    def _parse_section(self, name):
+        data = self.defaults.copy()
+        settings = self.config_section.__settings__
+        for setting, value in self.config_file.get_section(name, filter=settings, default=[]):
+            try:
+                data[setting] = settings[setting].type(value)
+            except Exception as e:
+                log.warning('ignoring invalid config value: %s.%s=%s (%s).' % (name, setting, value, e))
+        return data
+
+
+class ConfigurationCache(object):
+    """
+    Keeps a snapshot of a configuration file which is only replaced when
+    the file changes on disk. Lookups never touch the file system once the
+    snapshot was loaded, reloading is done by calling reload().
+    """
+
+    def __init__(self, config_section, factory):
+        self.config_section = config_section
+        self.factory = factory
+        self._snapshot = None
+
+    def get(self, name):
+        snapshot = self._snapshot or self.reload()
+        return snapshot.get(name)
+
+    def reload(self):
+        snapshot = self._snapshot
+        config_file = ConfigFile(self.config_section.__cfgfile__)  # this returns the same object unless the files were modified
+        if snapshot is None or snapshot.config_file is not config_file:
+            if snapshot is not None:
+                log.info('Reloaded configuration from %s' % ', '.join(config_file.files or [self.config_section.__cfgfile__]))
+            snapshot = self._snapshot = ConfigurationSnapshot(config_file, self.config_section, self.factory)
+        return snapshot
+
+
+def _create_room_config(room, data):
+    data.update(recording_dir=os.path.join(GeneralConfig.recording_dir, room), filesharing_dir=os.path.join(GeneralConfig.filesharing_dir, room))
+    data.update(access=AccessPolicy(data['access_policy'], data['allow'], data['deny']))
+    return VideoroomConfiguration(data)
+
+
+_room_configs = ConfigurationCache(RoomConfig, _create_room_config)
 
 
 def get_room_config(room):
-    config_file = ConfigFile(RoomConfig.__cfgfile__)
-    section = config_file.get_section(room)
-    if section is not None:
-        RoomConfig.read(section=room)
-        config = VideoroomConfiguration(dict(RoomConfig))
-        RoomConfig.reset()
-    else:
-        config = VideoroomConfiguration(dict(RoomConfig))  # use room defaults
-    config.recording_dir = os.path.join(GeneralConfig.recording_dir, room)
-    config.filesharing_dir = os.path.join(GeneralConfig.filesharing_dir, room)
-    return config
+    return _room_configs.get(room)
 
 
 class ExternalAuthConfig(ConfigSection):
@@ -204,6 +279,9 @@ class ExternalAuthConfig(ConfigSection):
     enable = False
     # this can't be per-server due to limitations in imaplib
     imap_ca_cert_file = ConfigSetting(type=str, value='/etc/ssl/certs/ca-certificates.crt')
+    imap_timeout = 10
+    credential_cache_ttl = 300
+    credential_cache_negative_ttl = 30
 
 
 class AuthConfig(ConfigSection):
@@ -213,20 +291,18 @@ class AuthConfig(ConfigSection):
     imap_server = ConfigSetting(type=str, value='')
 
 
-class AuthConfiguration(object):
+class AuthConfiguration(ImmutableConfiguration):
     auth_type = AuthType('SIP')
 
-    def __init__(self, data):
-        self.__dict__.update(data)
+
+_auth_configs = ConfigurationCache(AuthConfig, lambda domain, data: AuthConfiguration(data))
 
 
 def get_auth_config(domain):
-    config_file = ConfigFile(AuthConfig.__cfgfile__)
-    section = config_file.get_section(domain)
-    if section is not None:
-        AuthConfig.read(section=domain)
-        config = AuthConfiguration(dict(AuthConfig))
-        AuthConfig.reset()
-    else:
-        config = AuthConfiguration(dict(AuthConfig))  # use auth defaults
-    return config
+    return _auth_configs.get(domain)
+
+
+def reload_configuration():
+    """Reload the room and authentication configuration if the files changed"""
+    _room_configs.reload()
+    _auth_configs.reload()
@@ -8,7 +8,7 @@ import time
 import uuid
 
 from application.notification import IObserver, NotificationCenter, NotificationData
-from application.python import Null, limit
+from application.python import Null
 from application.python.weakref import defaultweakobjectmap
 from application.system import makedirs, unlink
 from collections import deque
@@ -20,10 +20,10 @@ from sipsimple.lookup import DNSLookup, DNSLookupError
 from sipsimple.payloads.imdn import IMDNDocument, DeliveryNotification, DisplayNotification
 from sipsimple.streams import MediaStreamRegistry
 from sipsimple.streams.msrp.chat import CPIMPayload, CPIMParserError, ChatIdentity, CPIMHeader, CPIMNamespace
-from sipsimple.threading import run_in_thread, run_in_twisted_thread
+from sipsimple.threading import run_in_twisted_thread
 from sipsimple.threading.green import call_in_green_thread, run_in_green_thread
 from sipsimple.util import ISOTimestamp
-from shutil import copyfileobj, rmtree
+from shutil import rmtree
 from twisted.internet import reactor, defer
 from typing import Generic, Container, Iterable, Sized, TypeVar, Dict, Set, Optional, Union
 from werkzeug.exceptions import InternalServerError
@@ -32,6 +32,7 @@ from zope.interface import implementer
 from sylk.accounts import DefaultAccount
 from sylk.configuration import SIPConfig
 from sylk.session import Session
+from sylk.threadpool import run_in_pool
 from . import push
 from .configuration import GeneralConfig, get_room_config, ExternalAuthConfig, JanusConfig
 from .janus import JanusBackend, JanusError, JanusSession, SIPPluginHandle, VideoroomPluginHandle
@@ -39,6 +40,8 @@ from .logger import ConnectionLogger, VideoroomLogger
 from .models import sylkrtc, janus
 from .storage import TokenStorage, MessageStorage
 from .auth import AuthHandler
+from .bitrate import BitrateController
+from .cascade import VideoroomCascade
 
 
 
@@ -156,6 +159,9 @@ class VideoroomSessionInfo(object):
         self.bitrate = None
         self.parent_session = None        # type: Optional[VideoroomSessionInfo]  # for subscribers this is their main session (the one used to join), for publishers is None
         self.publisher_id = None          # janus publisher ID for publishers / publisher session ID for subscribers
+        self.viewport = None              # (width, height) the subscriber renders the feed at, if declared
+        self.video_layers = None          # simulcast / SVC layer options last requested for subscribers
+        self.replica = None               # type: Optional[VideoroomReplica]  # for subscribers the replica serving the feed, None for the primary janus
         self.slow_download = False
         self.slow_upload = False
         self.feeds = PublisherFeedContainer()  # keeps references to all the other participant's publisher feeds that we subscribed to
@@ -185,13 +191,15 @@ class PublisherFeedContainer(object):
 
     def __init__(self):
         self._publishers = set()
-        self._id_map = {}  # map publisher.id -> publisher and publisher.publisher_id -> publisher
+        self._id_map = {}    # map publisher.id -> publisher and publisher.publisher_id -> publisher
+        self._replicas = {}  # map publisher -> replica serving the feed (None for the primary janus)
 
-    def add(self, session):
+    def add(self, session, replica=None):
         assert session not in self._publishers
         assert session.id not in self._id_map and session.publisher_id not in self._id_map
         self._publishers.add(session)
         self._id_map[session.id] = self._id_map[session.publisher_id] = session
+        self._replicas[session] = replica
 
     def discard(self, item):  # item can be any of session, session.id or session.publisher_id
         session = self._id_map[item] if item in self._id_map else item if item in self._publishers else None
@@ -199,23 +207,31 @@ class PublisherFeedContainer(object):
             self._publishers.discard(session)
             self._id_map.pop(session.id, None)
             self._id_map.pop(session.publisher_id, None)
+            self._replicas.pop(session, None)
 
     def remove(self, item):  # item can be any of session, session.id or session.publisher_id
         session = self._id_map[item] if item in self._id_map else item
         self._publishers.remove(session)
         self._id_map.pop(session.id)
         self._id_map.pop(session.publisher_id)
+        self._replicas.pop(session)
 
     def pop(self, item):  # item can be any of session, session.id or session.publisher_id
         session = self._id_map[item] if item in self._id_map else item
         self._publishers.remove(session)
         self._id_map.pop(session.id)
         self._id_map.pop(session.publisher_id)
+        self._replicas.pop(session)
         return session
 
+    def replica(self, item):  # item can be any of session, session.id or session.publisher_id
+        session = self._id_map[item] if item in self._id_map else item
+        return self._replicas[session]
+
     def clear(self):
         self._publishers.clear()
         self._id_map.clear()
+        self._replicas.clear()
 
     def __len__(self):
         return len(self._publishers)
@@ -238,6 +254,8 @@ class Videoroom(object):
         self.video = video
         self.config = get_room_config(uri)
         self.log = VideoroomLogger(self)
+        self.bitrate_controller = BitrateController(self)
+        self.cascade = VideoroomCascade(self)
         self._active_participants = []
         self._sessions = set()  # type: Set[VideoroomSessionInfo]
         self._id_map = {}       # type: Dict[Union[str, int], VideoroomSessionInfo]  # map session.id -> session and session.publisher_id -> session
@@ -307,6 +325,7 @@ class Videoroom(object):
             self._sessions.discard(session)
             self._id_map.pop(session.id, None)
             self._id_map.pop(session.publisher_id, None)
+            self.cascade.discard_publisher(session)
             self.log.info('{session.account.id} has left'.format(session=session))
             if session.id in self._active_participants:
                 self._active_participants.remove(session.id)
@@ -320,6 +339,7 @@ class Videoroom(object):
         self._sessions.remove(session)
         self._id_map.pop(session.id)
         self._id_map.pop(session.publisher_id)
+        self.cascade.discard_publisher(session)
         self.log.info('{session.account.id} has left'.format(session=session))
         if session.id in self._active_participants:
             self._active_participants.remove(session.id)
@@ -337,11 +357,7 @@ class Videoroom(object):
         self._id_map.clear()
 
     def allow_uri(self, uri):
-        config = self.config
-        if config.access_policy == 'allow,deny':
-            return config.allow.match(uri) and not config.deny.match(uri)
-        else:
-            return not config.deny.match(uri) or config.allow.match(uri)
+        return self.config.access.allows(uri)
 
     def add_file(self, upload_request):
         self._write_file(upload_request)
@@ -361,18 +377,19 @@ class Videoroom(object):
             if not os.path.exists(path) and not os.path.islink(path):
                 return path
 
-    @run_in_thread('file-io')
+    @run_in_pool('uploads', key=lambda self, upload_request: self.uri)
     def _write_file(self, upload_request):
         makedirs(self.config.filesharing_dir)
         path = self._fix_path(os.path.join(self.config.filesharing_dir, upload_request.shared_file.filename))
         upload_request.shared_file.filename = os.path.basename(path)
         meta_path = os.path.join(self.config.filesharing_dir, f'meta-{upload_request.shared_file.filename}')
         try:
-            with open(path, 'wb') as output_file:
-                copyfileobj(upload_request.content, output_file)
+            upload_request.content.save_sync(path)
+            digest = upload_request.content.hash.hexdigest().upper()
+            upload_request.shared_file.hash = 'sha-1:' + ':'.join(digest[i:i+2] for i in range(0, len(digest), 2))
             with open(meta_path, 'w+') as output_file:
                 output_file.write(json.dumps(upload_request.shared_file.__data__))
-        except (OSError, IOError):
+        except (OSError, IOError, ValueError):
             upload_request.had_error = True
             unlink(path)
         self._write_file_done(upload_request)
@@ -387,7 +404,7 @@ class Videoroom(object):
                 session.owner.send(sylkrtc.VideoroomFileSharingEvent(session=session.id, files=[upload_request.shared_file]))
             upload_request.deferred.callback('OK')
 
-    @run_in_thread('file-io')
+    @run_in_pool('uploads', key=lambda self: self.uri)
     def read_files_from_disk(self):
         with os.scandir(self.config.filesharing_dir) as file_list:
             for entry in file_list:
@@ -405,35 +422,17 @@ class Videoroom(object):
                     self._shared_files.append(shared_file)
 
     def cleanup(self):
+        self.bitrate_controller.stop()
+        self.cascade.stop()
         if not self.config.persistent:
             self._remove_files()
 
-    @run_in_thread('file-io')
+    @run_in_pool('housekeeping')
     def _remove_files(self):
         rmtree(self.config.filesharing_dir, ignore_errors=True)
 
     def _update_bitrate(self):
-        if self._sessions:
-            if self._active_participants:
-                # todo: should we use max_bitrate / 2 or max_bitrate for each active participant if there are 2 active participants?
-                active_participant_bitrate = self.config.max_bitrate // len(self._active_participants)
-                other_participant_bitrate = 100000
-                self.log.debug('participant bitrate is {} (active) / {} (others)'.format(active_participant_bitrate, other_participant_bitrate))
-                for session in self._sessions:
-                    if session.id in self._active_participants:
-                        bitrate = active_participant_bitrate
-                    else:
-                        bitrate = other_participant_bitrate
-                    if session.bitrate != bitrate:
-                        session.bitrate = bitrate
-                        session.janus_handle.message(janus.VideoroomUpdatePublisher(bitrate=bitrate), _async=True)
-            else:
-                bitrate = self.config.max_bitrate // limit(len(self._sessions) - 1, min=1)
-                self.log.debug('participant bitrate is {}'.format(bitrate))
-                for session in self._sessions:
-                    if session.bitrate != bitrate:
-                        session.bitrate = bitrate
-                        session.janus_handle.message(janus.VideoroomUpdatePublisher(bitrate=bitrate), _async=True)
+        self.bitrate_controller.schedule_update()
 
     # todo: make Videoroom be a context manager that is retained/released on enter/exit and implement __nonzero__ to be different from __len__
     # todo: so that a videoroom is not accidentally released by the last participant leaving while a new participant waits to join
@@ -558,6 +557,7 @@ class ConnectionHandler(object):
         self.protocol = protocol
         self.device_id = base64.b64encode(hashlib.md5(protocol.peer.encode('utf-8')).digest()).rstrip(b'=\n').decode('utf-8')
         self.janus_session = None      # type: Optional[JanusSession]
+        self.janus_replica_sessions = {}  # type: Dict[JanusReplicaBackend, JanusSession]  # sessions for subscribers of cascaded rooms
         self.accounts_map = {}         # account ID -> account
         self.devices_map = {}          # device ID -> account
         self.connections_map = {}      # peer connection -> account
@@ -617,7 +617,9 @@ class ConnectionHandler(object):
                     self.janus.set_event_handler(session.janus_handle.id, None)
             for session in self.videoroom_sessions:
                 if session.janus_handle is not None:
-                    self.janus.set_event_handler(session.janus_handle.id, None)
+                    session.janus_handle.backend.set_event_handler(session.janus_handle.id, None)
+                if session.type == 'subscriber':
+                    session.room.cascade.release(session.replica)
                 if session.chat_handler is not None:
                     notification_center = NotificationCenter()
                     notification_center.remove_observer(self, sender=session.chat_handler)
@@ -629,6 +631,8 @@ class ConnectionHandler(object):
                 session.room.discard(session)
                 session.feeds.clear()
             self.janus_session.destroy()  # this automatically detaches all plugin handles associated with it, no need to manually do it
+            for janus_session in self.janus_replica_sessions.values():
+                janus_session.destroy()
         # cleanup
         self.ready_event.clear()
         self.accounts_map.clear()
@@ -638,6 +642,7 @@ class ConnectionHandler(object):
         self.sip_sessions.clear()
         self.videoroom_sessions.clear()
         self.janus_session = None
+        self.janus_replica_sessions.clear()
         self.protocol = None
         self.state = 'stopped'
 
@@ -694,8 +699,18 @@ class ConnectionHandler(object):
                 self._maybe_destroy_videoroom(session.room)
             else:
                 session.parent_session.feeds.discard(session.publisher_id)
+                session.room.bitrate_controller.discard_subscriber(session)
+                session.room.cascade.release(session.replica)
                 session.janus_handle.detach()
 
+    def _get_replica_session(self, backend):
+        # should only be called from a green thread.
+        try:
+            return self.janus_replica_sessions[backend]
+        except KeyError:
+            janus_session = self.janus_replica_sessions[backend] = JanusSession(backend=backend)
+            return janus_session
+
     def _maybe_destroy_videoroom(self, videoroom):
         # should only be called from a green thread.
 
@@ -1299,7 +1314,7 @@ class ConnectionHandler(object):
 
             try:
                 try:
-                    videoroom_handle.create(room=videoroom.id, config=videoroom.config, publishers=10)
+                    videoroom_handle.create(room=videoroom.id, config=videoroom.config)
                 except JanusError as e:
                     if e.code != 427:  # 427 means room already exists
                         raise
@@ -1371,18 +1386,24 @@ class ConnectionHandler(object):
         if publisher_session.publisher_id is None:
             raise APIError('Video room session {session.id} does not have a publisher ID'.format(session=publisher_session))
 
-        videoroom_handle = VideoroomPluginHandle(self.janus_session, event_handler=self._handle_janus_videoroom_event)
+        room = base_session.room
+        replica = room.cascade.select_replica(publisher_session)
+        janus_session = self.janus_session if replica is None else self._get_replica_session(replica.backend)
+        videoroom_handle = VideoroomPluginHandle(janus_session, event_handler=self._handle_janus_videoroom_event)
 
         try:
-            videoroom_handle.feed_attach(room=base_session.room.id, feed=publisher_session.publisher_id, offer_audio=base_session.room.audio, offer_video=base_session.room.video)
+            videoroom_handle.feed_attach(room=room.id, feed=publisher_session.publisher_id, offer_audio=room.audio, offer_video=room.video)
         except Exception:
             videoroom_handle.detach()
             raise
 
         videoroom_session = VideoroomSessionInfo(request.feed, owner=self, janus_handle=videoroom_handle)
         videoroom_session.init_subscriber(publisher_session, parent_session=base_session)
+        videoroom_session.replica = replica
         self.videoroom_sessions.add(videoroom_session)
-        base_session.feeds.add(publisher_session)
+        base_session.feeds.add(publisher_session, replica)
+        room.cascade.attach(replica)
+        room.bitrate_controller.add_subscriber(videoroom_session)
         self.log.debug('subscribe to {account} in room {session.room.uri} {feeds}'.format(account=publisher_session.account.id, session=videoroom_session, feeds=len(base_session.feeds)))
 
     def _RH_videoroom_feed_answer(self, request):
@@ -1418,6 +1439,23 @@ class ConnectionHandler(object):
         self.log.debug('unsubscribe from {account} in room {session.room.uri}'.format(account=videoroom_session.room[videoroom_session.publisher_id].account.id, session=videoroom_session))
         reactor.callLater(2, call_in_green_thread, self._cleanup_videoroom_session, videoroom_session)
 
+    def _RH_videoroom_feed_update(self, request):
+        try:
+            videoroom_session = self.videoroom_sessions[request.feed]
+        except KeyError:
+            raise APIError('Unknown room session to update: {request.feed}'.format(request=request))
+        if videoroom_session.parent_session.id != request.session:
+            raise APIError('{request.feed} is not an attached feed of {request.session}'.format(request=request))
+        options = request.options
+        if options.width is not None and options.height is not None:
+            videoroom_session.viewport = options.width, options.height
+        elif 'width' in options.__data__ or 'height' in options.__data__:
+            videoroom_session.viewport = None  # the client went back to not declaring a viewport
+        media_options = {key: value for key, value in options.__data__.items() if key in ('audio', 'video')}
+        if media_options:
+            videoroom_session.janus_handle.feed_update(media_options)
+        videoroom_session.room.bitrate_controller.schedule_update()
+
     def _RH_videoroom_invite(self, request):
         try:
             base_session = self.videoroom_sessions[request.session]
@@ -1885,6 +1923,8 @@ class ConnectionHandler(object):
             if not videoroom_session.slow_upload:
                 self.log.debug('poor upload connectivity to room {session.room.uri} with session {session.id}'.format(session=videoroom_session))
             videoroom_session.slow_upload = True
+        if event.media == 'video':
+            videoroom_session.room.bitrate_controller.report_slowlink(videoroom_session, event.lost)
 
     def _EH_janus_videoroom_media(self, event):
         pass
@@ -1925,6 +1965,7 @@ class ConnectionHandler(object):
                 self.log.warning('could not find matching session for publisher {publisher.id} during joined event'.format(publisher=publisher))
             else:
                 publishers.append(dict(id=publisher_session.id, uri=publisher_session.account.id, display_name=publisher.display or ''))
+                room.cascade.add_publisher(publisher_session, publisher.streams)
         self.send(sylkrtc.VideoroomInitialPublishersEvent(session=videoroom_session.id, publishers=publishers))
         room.add(videoroom_session)  # adding the session to the room might also trigger sending an event with the active participants which must be sent last
 
@@ -1974,6 +2015,7 @@ class ConnectionHandler(object):
                 self.log.warning('could not find matching session for publisher {publisher.id} during publishers event'.format(publisher=publisher))
                 continue
             publishers.append(dict(id=publisher_session.id, uri=publisher_session.account.id, display_name=publisher.display or ''))
+            room.cascade.add_publisher(publisher_session, publisher.streams)
         self.send(sylkrtc.VideoroomPublishersJoinedEvent(session=videoroom_session.id, publishers=publishers))
 
     def _EH_janus_videoroom_event_leaving(self, event):
@@ -1994,6 +2036,7 @@ class ConnectionHandler(object):
             publisher_session = base_session.feeds.pop(publisher_id)
         except KeyError:
             return
+        base_session.room.bitrate_controller.schedule_update()
         self.send(sylkrtc.VideoroomPublishersLeftEvent(session=base_session.id, publishers=[publisher_session.id]))
 
     def _EH_janus_videoroom_event_left(self, event):
@@ -2011,6 +2054,25 @@ class ConnectionHandler(object):
     def _EH_janus_videoroom_event_started(self, event):
         pass
 
+    def _EH_janus_videoroom_event_substream(self, event):
+        self._log_video_layer_change(event, 'substream', event.plugindata.data.substream)
+
+    def _EH_janus_videoroom_event_temporal(self, event):
+        self._log_video_layer_change(event, 'temporal layer', event.plugindata.data.temporal)
+
+    def _EH_janus_videoroom_event_spatial_layer(self, event):
+        self._log_video_layer_change(event, 'spatial layer', event.plugindata.data.spatial_layer)
+
+    def _EH_janus_videoroom_event_temporal_layer(self, event):
+        self._log_video_layer_change(event, 'temporal layer', event.plugindata.data.temporal_layer)
+
+    def _log_video_layer_change(self, event, layer_type, layer):
+        try:
+            videoroom_session = self.videoroom_sessions[event.sender]
+        except KeyError:
+            return
+        self.log.debug('receiving {layer_type} {layer} for feed {session.id} in room {session.room.uri}'.format(layer_type=layer_type, layer=layer, session=videoroom_session))
+
     def _EH_janus_videoroom_event_unpublished(self, event):
         pass
 
@@ -0,0 +1,204 @@
+
+import heapq
+import json
+import os
+import time
+
+from application.python.types import Singleton
+from application.system import makedirs, unlink
+from sipsimple.configuration.settings import SIPSimpleSettings
+from twisted.internet import reactor
+
+from sylk.threadpool import run_in_pool
+
+from .configuration import GeneralConfig
+from .logger import log
+
+
+__all__ = 'FileTransferHousekeeper',
+
+
+class FileTransferHousekeeper(object, metaclass=Singleton):
+    """
+    Removes expired file transfers. Every stored file is added to an index
+    sorted by expiry time, so a cleanup run only touches the files that are
+    due instead of walking the whole file transfer directory. The index is
+    kept in a journal file next to the transfers, one JSON entry per line, which
+    is compacted when it grows much larger than the index. If the journal does
+    not exist it is rebuilt by scanning the directory once.
+    """
+
+    big_file_size = 1024 * 1024 * 50
+    max_interval = 3600
+
+    def __init__(self):
+        self._index = []  # heap of (expire_time, path), entries of files which were added again are stale
+        self._expiry = {}  # path -> current expire_time
+        self._journal = None
+        self._journal_entries = 0
+        self._timer = None
+        self._stopped = True
+
+    @property
+    def directory(self):
+        return SIPSimpleSettings().file_transfer.directory.normalized
+
+    @property
+    def journal_path(self):
+        return os.path.join(self.directory, '.expiry-index')
+
+    def start(self):
+        self._stopped = False
+        self._load()
+
+    def stop(self):
+        self._stopped = True
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        self._shutdown()
+
+    @run_in_pool('housekeeping', key='self')
+    def _shutdown(self):
+        self._close()
+
+    @classmethod
+    def expire_time(cls, size, timestamp=None):
+        timestamp = timestamp if timestamp is not None else time.time()
+        expire_days = GeneralConfig.filetransfer_expire_days
+        if size >= cls.big_file_size:
+            return timestamp + 86400 * expire_days
+        return timestamp + 86400 * 2 * expire_days
+
+    @run_in_pool('housekeeping', key='self')
+    def add(self, path, size):
+        entry = (int(self.expire_time(size)), path)
+        self._expiry[path] = entry[0]
+        heapq.heappush(self._index, entry)
+        self._write_entries([entry])
+
+    @run_in_pool('housekeeping', key='self')
+    def _load(self):
+        makedirs(self.directory)
+        try:
+            with open(self.journal_path, 'r') as f:
+                entries = [self._parse_entry(line) for line in f]
+        except (OSError, IOError):
+            log.info('[housekeeper] Rebuilding file transfer expiry index')
+            entries = self._scan()
+        self._expiry = {path: expire_time for expire_time, path in entries if path is not None}  # keep the last entry for every file
+        self._compact()
+        log.info('[housekeeper] %d file transfers scheduled for removal' % len(self._expiry))
+        self._expire()
+
+    @staticmethod
+    def _parse_entry(line):
+        try:
+            expire_time, path = json.loads(line)
+            return int(expire_time), path or None
+        except (TypeError, ValueError):
+            return 0, None
+
+    def _scan(self):
+        entries = []
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                if name.startswith('meta-') or name.startswith('.'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    statinfo = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((int(self.expire_time(statinfo.st_size, statinfo.st_mtime)), path))
+        return entries
+
+    def _compact(self):
+        self._close()
+        self._index = [(expire_time, path) for path, expire_time in self._expiry.items()]
+        heapq.heapify(self._index)
+        temp_path = self.journal_path + '.tmp'
+        try:
+            with open(temp_path, 'w') as f:
+                f.writelines(self._format_entry(entry) for entry in self._index)
+            os.replace(temp_path, self.journal_path)
+        except (OSError, IOError) as e:
+            log.warning('[housekeeper] Could not save file transfer expiry index: %s' % e)
+        self._journal_entries = len(self._index)
+
+    def _write_entries(self, entries):
+        try:
+            if self._journal is None:
+                self._journal = open(self.journal_path, 'a')
+            self._journal.writelines(self._format_entry(entry) for entry in entries)
+            self._journal.flush()
+            self._journal_entries += len(entries)
+        except (OSError, IOError) as e:
+            log.warning('[housekeeper] Could not update file transfer expiry index: %s' % e)
+
+    @staticmethod
+    def _format_entry(entry):
+        return json.dumps(entry) + '\n'  # paths are escaped, so they can contain any character
+
+    def _close(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    @run_in_pool('housekeeping', key='self')
+    def _expire(self):
+        if self._stopped:
+            return
+        max_removals = GeneralConfig.filetransfer_expire_rate
+        current_time = time.time()
+        removed_files = removed_dirs = 0
+        while self._index and self._index[0][0] <= current_time and removed_files < max_removals:
+            expire_time, path = heapq.heappop(self._index)
+            if self._expiry.get(path) != expire_time:
+                continue  # the file was added again with a later expire time
+            del self._expiry[path]
+            directory, name = os.path.split(path)
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                log.warning(f'[housekeeper] Could not remove expired file transfer file {path}: {e}')
+                continue
+            log.info(f'[housekeeper] Removing expired file transfer file: {path}')
+            removed_files += 1
+            unlink(os.path.join(directory, f'meta-{name}'))
+            removed_dirs += self._remove_empty_directories(directory)
+        if removed_files:
+            log.info(f'[housekeeper] Removed {removed_files} files, {removed_dirs} directories')
+        if self._journal_entries > 2 * len(self._expiry) + 1000:  # this also drops the stale entries of the index
+            self._compact()
+        if self._index and self._index[0][0] <= current_time:
+            delay = 1  # more files are due, continue after a pause to limit the removal rate
+        elif self._index:
+            delay = min(self._index[0][0] - current_time, self.max_interval)
+        else:
+            delay = self.max_interval
+        self._schedule(delay)
+
+    def _remove_empty_directories(self, directory):
+        removed = 0
+        top = self.directory
+        while directory != top and directory.startswith(top):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                break
+            removed += 1
+            directory = os.path.dirname(directory)
+        return removed
+
+    def _schedule(self, delay):
+        reactor.callFromThread(self._schedule_in_reactor, delay)
+
+    def _schedule_in_reactor(self, delay):
+        if self._stopped:
+            return
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = reactor.callLater(delay, self._expire)
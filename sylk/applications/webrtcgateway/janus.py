@@ -164,10 +164,11 @@ class JanusClientFactory(ReconnectingClientFactory, WebSocketClientFactory):
 
 
 @implementer(IObserver)
-class JanusBackend(object, metaclass=Singleton):
+class JanusBackendBase(object):
 
-    def __init__(self):
-        self.factory = JanusClientFactory(url=JanusConfig.api_url, protocols=['janus-protocol'], useragent='SylkServer/%s' % __version__)
+    def __init__(self, url):
+        self.url = url
+        self.factory = JanusClientFactory(url=url, protocols=['janus-protocol'], useragent='SylkServer/%s' % __version__)
         self.connector = None
         self.protocol = Null
         self._stopped = False
@@ -224,24 +225,59 @@ class JanusBackend(object, metaclass=Singleton):
     # Notification handling
 
     def handle_notification(self, notification):
+        if notification.sender.factory is not self.factory:  # the notification is for another backend
+            return
         handler = getattr(self, '_NH_%s' % notification.name, Null)
         handler(notification)
 
     def _NH_JanusBackendConnected(self, notification):
         assert self.protocol is Null
         self.protocol = notification.sender
-        log.info('Janus backend connection up')
+        log.info('Janus backend connection up: %s' % self.url)
         self.factory.resetDelay()
 
     def _NH_JanusBackendDisconnected(self, notification):
-        log.info('Janus backend connection down: %s' % notification.data.reason)
+        log.info('Janus backend connection down: %s: %s' % (self.url, notification.data.reason))
         self.protocol = Null
 
+    def __repr__(self):
+        return '<{0.__class__.__name__}: url={0.url!r}>'.format(self)
+
+
+class JanusBackend(JanusBackendBase, metaclass=Singleton):
+    """The primary Janus instance, used for everything except cascaded videoroom subscribers"""
+
+    def __init__(self):
+        super(JanusBackend, self).__init__(JanusConfig.api_url)
+
+
+class JanusReplicaBackend(JanusBackendBase):
+    """A secondary Janus instance, which receives forwarded publishers of cascaded videorooms"""
+
+
+class JanusReplicaBackends(object, metaclass=Singleton):
+    def __init__(self):
+        self.backends = [JanusReplicaBackend(url) for url in JanusConfig.cascade_api_urls]
+
+    @property
+    def ready(self):
+        return [backend for backend in self.backends if backend.ready]
+
+    def start(self):
+        for backend in self.backends:
+            backend.start()
+
+    def stop(self):
+        for backend in self.backends:
+            backend.stop()
+
 
 class JanusSession(object):
     backend = JanusBackend()
 
-    def __init__(self):
+    def __init__(self, backend=None):
+        if backend is not None:
+            self.backend = backend
         response = block_on(self.backend.create_session())  # type: janus.SuccessResponse
         self.id = response.data.id
 
@@ -256,6 +292,7 @@ class JanusPluginHandle(object):
     def __init__(self, session, event_handler):
         if self.plugin is None:
             raise TypeError('Cannot instantiate {0.__class__.__name__} with no associated plugin'.format(self))
+        self.backend = session.backend
         response = block_on(self.backend.attach_plugin(session.id, self.plugin))  # type: janus.SuccessResponse
         self.id = response.data.id
         self.session = session
@@ -326,8 +363,8 @@ class SIPPluginHandle(JanusPluginHandle):
 class VideoroomPluginHandle(JanusPluginHandle):
     plugin = 'janus.plugin.videoroom'
 
-    def create(self, room, config, publishers=10):
-        self.message(janus.VideoroomCreate(room=room, publishers=publishers, **config.janus_data))
+    def create(self, room, config):
+        self.message(janus.VideoroomCreate(room=room, **config.janus_data))
 
     def destroy(self, room):
         try:
@@ -364,3 +401,17 @@ class VideoroomPluginHandle(JanusPluginHandle):
 
     def feed_update(self, options):
         self.message(janus.VideoroomFeedUpdate(**options))
+
+    # Cascading (requires Janus 1.2 or newer)
+
+    def add_remote_publisher(self, room, publisher_id, display_name, streams, _async=False):
+        return self.message(janus.VideoroomAddRemotePublisher(room=room, id=publisher_id, display=display_name, streams=streams), _async=_async)
+
+    def remove_remote_publisher(self, room, publisher_id, _async=False):
+        return self.message(janus.VideoroomRemoveRemotePublisher(room=room, id=publisher_id), _async=_async)
+
+    def publish_remotely(self, room, publisher_id, remote_id, host, port, rtcp_port=None, _async=False):
+        return self.message(janus.VideoroomPublishRemotely(room=room, publisher_id=publisher_id, remote_id=remote_id, host=host, port=port, rtcp_port=rtcp_port), _async=_async)
+
+    def unpublish_remotely(self, room, publisher_id, remote_id, _async=False):
+        return self.message(janus.VideoroomUnpublishRemotely(room=room, publisher_id=publisher_id, remote_id=remote_id), _async=_async)
@@ -112,12 +112,27 @@ class JSEP(JSONObject):
     sdp = StringProperty()
 
 
+class VideoroomPublisherStream(JSONObject):
+    type = StringProperty()
+    mindex = IntegerProperty()
+    mid = StringProperty()
+    codec = StringProperty(optional=True)
+    disabled = BooleanProperty(optional=True)
+    simulcast = BooleanProperty(optional=True)
+    svc = BooleanProperty(optional=True)
+
+
+class VideoroomPublisherStreams(JSONArray):
+    item_type = VideoroomPublisherStream
+
+
 class VideoroomPublisher(JSONObject):
     id = IntegerProperty()
     display = StringProperty(optional=True)
     audio_codec = StringProperty(optional=True)
     video_codec = StringProperty(optional=True)
     talking = BooleanProperty(optional=True)
+    streams = ArrayProperty(VideoroomPublisherStreams, optional=True)  # only available in multistream janus versions
 
 
 class VideoroomPublishers(JSONArray):
@@ -347,6 +362,37 @@ class VideoroomFeedUpdate(JSONObject):
     temporal_layer = IntegerProperty(optional=True)  # for VP9 SVC
 
 
+class VideoroomAddRemotePublisher(JSONObject):
+    request = FixedValueProperty('add_remote_publisher')
+    room = IntegerProperty()
+    id = IntegerProperty()
+    display = StringProperty(optional=True)
+    streams = ArrayProperty(VideoroomPublisherStreams)
+
+
+class VideoroomRemoveRemotePublisher(JSONObject):
+    request = FixedValueProperty('remove_remote_publisher')
+    room = IntegerProperty()
+    id = IntegerProperty()
+
+
+class VideoroomPublishRemotely(JSONObject):
+    request = FixedValueProperty('publish_remotely')
+    room = IntegerProperty()
+    publisher_id = IntegerProperty()
+    remote_id = StringProperty()
+    host = StringProperty()
+    port = IntegerProperty()
+    rtcp_port = IntegerProperty(optional=True)
+
+
+class VideoroomUnpublishRemotely(JSONObject):
+    request = FixedValueProperty('unpublish_remotely')
+    room = IntegerProperty()
+    publisher_id = IntegerProperty()
+    remote_id = StringProperty()
+
+
 # Janus core messages
 
 class AckResponse(CoreResponse):
@@ -717,6 +763,15 @@ class VideoroomAttached(VideoroomPluginData):
     display = StringProperty(optional=True)
 
 
+class VideoroomSuccess(VideoroomPluginData):  # response to the cascading requests
+    videoroom = FixedValueProperty('success')
+    room = IntegerProperty(optional=True)
+    id = IntegerProperty(optional=True)
+    ip = StringProperty(optional=True)
+    port = IntegerProperty(optional=True)
+    rtcp_port = IntegerProperty(optional=True)
+
+
 class VideoroomSlowLink(VideoroomPluginData):
     videoroom = FixedValueProperty('slow_link')
     # current_bitrate = IntegerProperty()  # this is actually defined as 'current-bitrate' in JSON, so we cannot map it to an attribute name. also not used.
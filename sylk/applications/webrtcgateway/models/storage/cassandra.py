@@ -1,4 +1,6 @@
 
+import uuid
+
 from cassandra.cqlengine import columns
 from cassandra.cqlengine.models import Model
 
@@ -52,3 +54,12 @@ class ChatAccount(Model):
     account          = columns.Text(partition_key=True)
     api_token        = columns.Text()
     last_login       = columns.DateTime()
+
+
+class ConferenceMessage(Model):
+    __table_name__  = 'conference_messages'
+    __options__     = {'default_time_to_live': '2592000',
+                       'gc_grace_seconds': '345600'}
+    room            = columns.Text(partition_key=True)
+    created_at      = columns.TimeUUID(primary_key=True, clustering_order='DESC', default=uuid.uuid1)
+    record          = columns.Text()
@@ -107,6 +107,13 @@ class VideoroomSessionOptions(JSONObject):
     bitrate = IntegerProperty(optional=True)
 
 
+class VideoroomFeedOptions(JSONObject):
+    audio = BooleanProperty(optional=True)
+    video = BooleanProperty(optional=True)
+    width = IntegerProperty(optional=True)   # the size at which the feed is rendered, used to select the simulcast / SVC layer
+    height = IntegerProperty(optional=True)
+
+
 class VideoroomRaisedHands(StringArray):
     list_validator = UniqueItemsValidator()
 
@@ -116,6 +123,7 @@ class SharedFile(JSONObject):
     filesize = IntegerProperty()
     uploader = ObjectProperty(SIPIdentity)  # type: SIPIdentity
     session = StringProperty()
+    hash = StringProperty(optional=True)
 
 
 class SharedFiles(JSONArray):
@@ -589,6 +597,12 @@ class VideoroomFeedDetachRequest(VideoroomRequestBase):
     feed = StringProperty()
 
 
+class VideoroomFeedUpdateRequest(VideoroomRequestBase):
+    sylkrtc = FixedValueProperty('videoroom-feed-update')
+    feed = StringProperty()
+    options = ObjectProperty(VideoroomFeedOptions)  # type: VideoroomFeedOptions
+
+
 class VideoroomInviteRequest(VideoroomRequestBase):
     sylkrtc = FixedValueProperty('videoroom-invite')
     participants = ArrayProperty(AORList)              # type: AORList
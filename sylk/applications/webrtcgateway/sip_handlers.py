@@ -24,6 +24,7 @@ from sylk.web import server
 
 from . import push
 from .configuration import GeneralConfig
+from .housekeeper import FileTransferHousekeeper
 from .logger import log
 from .models import sylkrtc
 from .storage import MessageStorage
@@ -454,6 +455,7 @@ class FileTransferHandler(object):
                     log.warning('Could not save metadata %s' % meta_filepath)
 
                 log.info('File transfer finished, saved to %s' % transfer_data.full_path)
+                FileTransferHousekeeper().add(transfer_data.full_path, transfer_data.filesize)
 
                 payload = transfer_data.message_payload
                 message_handler = MessageHandler()
@@ -10,10 +10,12 @@ from collections import defaultdict
 from sipsimple.threading import run_in_thread
 from sipsimple.util import ISOTimestamp
 from shutil import rmtree
+from threading import Lock
 from twisted.internet import defer
 from types import SimpleNamespace
 
 from sylk.configuration import ServerConfig
+from sylk.threadpool import run_in_pool
 
 from .configuration import CassandraConfig
 from .datatypes import FileTransferData
@@ -53,12 +55,12 @@ class FileTokenStorage(object):
     def __init__(self):
         self._tokens = defaultdict()
 
-    @run_in_thread('file-io')
+    @run_in_pool('storage', key='self')
     def _save(self):
         with open(os.path.join(ServerConfig.spool_dir, 'webrtc_device_tokens'), 'wb+') as f:
             pickle.dump(self._tokens, f)
 
-    @run_in_thread('file-io')
+    @run_in_pool('storage', key='self')
     def load(self):
         try:
             tokens = pickle.load(open(os.path.join(ServerConfig.spool_dir, 'webrtc_device_tokens'), 'rb'))
@@ -202,17 +204,26 @@ class FileMessageStorage(object):
         self._public_keys = defaultdict()
         self._accounts = defaultdict()
         self._storage_path = os.path.join(ServerConfig.spool_dir, 'conversations')
+        self._save_lock = Lock()
 
     def _json_dateconverter(self, o):
         if isinstance(o, datetime.datetime):
             return o.__str__()
 
-    @run_in_thread('file-io')
     def _save(self):
+        # the tables are changed by workers running for other accounts, so they are copied by the caller
+        # and the copies are written in the order they were taken
+        with self._save_lock:
+            accounts = {account: dict(data) for account, data in dict(self._accounts).items()}
+            public_keys = {account: dict(data) for account, data in dict(self._public_keys).items()}
+            self._write(accounts, public_keys)
+
+    @run_in_pool('storage', key='self')
+    def _write(self, accounts, public_keys):
         with open(os.path.join(self._storage_path, 'accounts.json'), 'w+') as f:
-            json.dump(self._accounts, f, default=self._json_dateconverter)
+            json.dump(accounts, f, default=self._json_dateconverter)
         with open(os.path.join(self._storage_path, 'public_keys.json'), 'w+') as f:
-            json.dump(self._public_keys, f, default=self._json_dateconverter)
+            json.dump(public_keys, f, default=self._json_dateconverter)
 
     def _save_messages(self, account, messages):
         with open(os.path.join(self._storage_path, account[0], f'{account}_messages.json'), 'w+') as f:
@@ -222,7 +233,7 @@ class FileMessageStorage(object):
         with open(os.path.join(self._storage_path, account[0], f'{account}_id_timestamp.json'), 'w+') as f:
             json.dump(ids, f, default=self._json_dateconverter)
 
-    @run_in_thread('file-io')
+    @run_in_pool('storage', key='self')
     def load(self):
         makedirs(self._storage_path)
         try:
@@ -257,7 +268,7 @@ class FileMessageStorage(object):
     def __getitem__(self, key):
         deferred = defer.Deferred()
 
-        @run_in_thread('file-io')
+        @run_in_pool('storage', key='account')
         def query(account, message_id):
             messages = []
             timestamp = None
@@ -345,7 +356,7 @@ class FileMessageStorage(object):
         self._accounts[account]['token_expire'] = timestamp + datetime.timedelta(seconds=26784000)
         self._save()
 
-    @run_in_thread('file-io')
+    @run_in_pool('storage', key='account')
     def mark_conversation_read(self, account, contact):
         try:
             messages = self._load_messages(account)
@@ -358,7 +369,7 @@ class FileMessageStorage(object):
                     messages[idx] = message
             self._save_messages(account, messages)
 
-    @run_in_thread('file-io')
+    @run_in_pool('storage', key='account')
     def update(self, account, state, message_id):
         try:
             messages = self._load_messages(account)
@@ -390,7 +401,7 @@ class FileMessageStorage(object):
                         self._save_messages(account, messages)
                         break
 
-    @run_in_thread('file-io')
+    @run_in_pool('storage', key='account')
     def add(self, account, contact, direction, content, content_type, timestamp, disposition_notification, message_id, state=None):
         try:
             msg_timestamp = datetime.datetime.fromisoformat(timestamp)
@@ -459,7 +470,7 @@ class FileMessageStorage(object):
 
         self._save_id_by_timestamp(account, id_by_timestamp)
 
-    @run_in_thread('file-io')
+    @run_in_pool('storage', key='account')
     def removeChat(self, account, contact):
         try:
             messages = self._load_messages(account)
@@ -470,7 +481,7 @@ class FileMessageStorage(object):
 
             self._save_messages(account, messages)
 
-    @run_in_thread('file-io')
+    @run_in_pool('storage', key='account')
     def removeMessage(self, account, message_id):
         try:
             id_by_timestamp = self._load_id_by_timestamp(account)
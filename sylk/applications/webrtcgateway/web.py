@@ -2,9 +2,7 @@
 import json
 import os
 
-import hashlib
-from shutil import copyfileobj
-from application.system import makedirs
+from functools import lru_cache
 from sipsimple.streams.msrp.filetransfer import FileSelector
 
 from application.python.types import Singleton
@@ -13,17 +11,21 @@ from sipsimple.configuration.settings import SIPSimpleSettings
 from twisted.internet import defer, reactor
 from twisted.python.failure import Failure
 from twisted.web.server import Site
-from werkzeug.exceptions import Forbidden, NotFound
+from werkzeug.exceptions import BadRequest, Forbidden, NotFound
 from werkzeug.utils import secure_filename
 
 from sylk import __version__ as sylk_version
+from sylk.applications import ApplicationRegistry, IncomingRequestHandler
 from sylk.resources import Resources
-from sylk.web import File, Klein, StaticFileResource, server
+from sylk.threadpool import WorkerPoolManager, run_in_pool
+from sylk.web import DownloadResource, Klein, StaticFileResource, UploadContent, server
 
+from .auth import CredentialCache
 from .configuration import GeneralConfig, JanusConfig
 from .datatypes import FileTransferData
 from .factory import SylkWebSocketServerFactory
-from .janus import JanusBackend
+from .housekeeper import FileTransferHousekeeper
+from .janus import JanusBackend, JanusReplicaBackends
 from .logger import log
 from .models import sylkrtc
 from .protocol import SYLK_WS_PROTOCOL
@@ -45,6 +47,39 @@ class FileUploadRequest(object):
 class ApiTokenAuthError(Exception): pass
 
 
+@lru_cache(maxsize=4096)
+def _load_file_etag(path, mtime, size):
+    """Get the ETag for a file from the hash in its metadata file, raises LookupError if the hash is not known yet"""
+    # exceptions are not cached, so the metadata file is read again until it has been written
+    directory, filename = os.path.split(path)
+    try:
+        with open(os.path.join(directory, f'meta-{filename}'), 'r') as f:
+            file_hash = json.load(f).get('hash')
+    except (OSError, IOError, ValueError, AttributeError):
+        file_hash = None
+    if not file_hash:
+        raise LookupError('file hash is not known')
+    return '"{}"'.format(file_hash.partition(':')[2].replace(':', '').lower()).encode()
+
+
+def _get_file_etag(path, mtime, size):
+    """Get the ETag for a file, or build a weak one if its hash is not known"""
+    try:
+        return _load_file_etag(path, mtime, size)
+    except LookupError:
+        return 'W/"{:x}-{:x}"'.format(size, mtime).encode()
+
+
+def file_download(path):
+    """Build the resource used to download a file, raises LookupError if the file does not exist"""
+    try:
+        stat_result = os.stat(path)
+    except OSError:
+        raise LookupError('file does not exist')
+    etag = _get_file_etag(path, stat_result.st_mtime_ns, stat_result.st_size)
+    return DownloadResource(path, etag=etag, stat_result=stat_result)
+
+
 class WebRTCGatewayWeb(object, metaclass=Singleton):
     app = Klein()
 
@@ -76,6 +111,9 @@ class WebRTCGatewayWeb(object, metaclass=Singleton):
                 method = request.method.upper().decode()
                 session = videoroom[session_id]
                 if method == 'POST':
+                    if not isinstance(request.content, UploadContent):
+                        raise BadRequest()
+
                     def log_result(result):
                         if isinstance(result, Failure):
                             videoroom.log.warning('{file.uploader.uri} failed to upload {file.filename}: {error}'.format(file=upload_request.shared_file, error=result.value))
@@ -95,14 +133,14 @@ class WebRTCGatewayWeb(object, metaclass=Singleton):
                     filename = secure_filename(filename)
                     session.owner.log.info('wants to download file {filename} from video room {conference_uri} with session {session_id}'.format(filename=filename, conference_uri=conference_uri, session_id=session_id))
                     try:
-                        path = videoroom.get_file(filename)
+                        resource = file_download(videoroom.get_file(filename))
                     except LookupError as e:
                         videoroom.log.warning('{session.account.id} failed to download {filename}: {error}'.format(session=session, filename=filename, error=e))
                         raise NotFound()
                     else:
                         videoroom.log.info('{session.account.id} is downloading {filename}'.format(session=session, filename=filename))
                         request.setHeader('Content-Disposition', 'attachment;filename=%s' % filename)
-                        return File(path)
+                        return resource
                 else:
                     return 'OK'
         raise Forbidden()
@@ -119,6 +157,8 @@ class WebRTCGatewayWeb(object, metaclass=Singleton):
             sender_connection = next((connection_handler for connection_handler in connection_handlers if sender in connection_handler.accounts_map), False)
             if not sender_connection:
                 raise Forbidden
+            if not isinstance(request.content, UploadContent):
+                raise BadRequest
 
             # TODO: Form support to support extra metadata?
             filename = secure_filename(filename)
@@ -141,17 +181,18 @@ class WebRTCGatewayWeb(object, metaclass=Singleton):
             folder = os.path.join(settings.file_transfer.directory.normalized, sender[:1], sender, receiver, transfer_id)
             path = f'{folder}/{filename}'
             log_path = os.path.join(sender, receiver, transfer_id, filename)
-            if os.path.exists(path):
-                file_size = os.path.getsize(path)
+            try:
+                resource = file_download(path)
+            except LookupError:
+                log.warning('Download failed, file not found: %s' % (log_path))
+                raise NotFound()
+            else:
                 split_tup = os.path.splitext(path)
                 file_extension = split_tup[1]
                 render_type = 'inline' if file_extension and file_extension.lower() in ('.jpg', '.png', '.jpeg', '.gif') else 'attachment'
                 request.setHeader('Content-Disposition', '%s;filename=%s' % (render_type, filename))
-                log.info('Web %s file download %s (%s)' % (render_type, log_path, FileTransferData.format_file_size(file_size)))
-                return File(path)
-            else:
-                log.warning('Download failed, file not found: %s' % (log_path))
-                raise NotFound()
+                log.info('Web %s file download %s (%s)' % (render_type, log_path, FileTransferData.format_file_size(resource.getsize())))
+                return resource
         else:
             return 'OK'
 
@@ -178,33 +219,29 @@ class WebRTCGatewayWeb(object, metaclass=Singleton):
         raise NotFound()
 
     def _accept_upload(self, transfer_data, connection):
-        makedirs(transfer_data.path)
-        with open(os.path.join(transfer_data.path, transfer_data.filename), 'wb') as output_file:
-            copyfileobj(transfer_data.content, output_file)
-
-        part_size = 64 * 1024
-        sha1 = hashlib.sha1()
-
-        with open(os.path.join(transfer_data.path, transfer_data.filename), 'rb') as f:
-            while True:
-                data = f.read(part_size)
-                if not data:
-                    break
-                sha1.update(data)
-
-        file_selector = FileSelector.for_file(os.path.join(transfer_data.path, transfer_data.filename))
-        file_selector.hash = sha1
-
-        metadata = sylkrtc.TransferredFile(**transfer_data.__dict__, hash=file_selector.hash)
-
-        meta_filepath = os.path.join(transfer_data.path, f'meta-{metadata.filename}')
+        deferred = transfer_data.content.save(transfer_data.full_path)
+        deferred.addCallback(lambda result: self._upload_saved(transfer_data))
+        return deferred
 
+    @run_in_pool('uploads', key='path')
+    def _save_metadata(self, path, metadata):
+        meta_filepath = os.path.join(path, f'meta-{metadata.filename}')
         try:
             with open(meta_filepath, 'w+') as output_file:
                 output_file.write(json.dumps(metadata.__data__))
         except (OSError, IOError):
             log.warning('Could not save metadata %s' % meta_filepath)
 
+    def _upload_saved(self, transfer_data):
+        content = transfer_data.content
+        # the content was hashed while it was received, so there is no need to read the file again
+        file_selector = FileSelector(name=transfer_data.full_path, type=transfer_data.filetype, size=content.size, hash=content.hash)
+        transfer_data.filesize = content.size
+
+        metadata = sylkrtc.TransferredFile(**transfer_data.__dict__, hash=file_selector.hash)
+        self._save_metadata(transfer_data.path, metadata)
+        FileTransferHousekeeper().add(transfer_data.full_path, content.size)
+
         payload = transfer_data.cpim_message_payload(metadata)
 
         message_handler = MessageHandler()
@@ -270,6 +307,7 @@ class WebRTCGatewayWeb(object, metaclass=Singleton):
 class WebHandler(object):
     def __init__(self):
         self.backend = None
+        self.replica_backends = None
         self.factory = None
         self.resource = None
         self.web = None
@@ -292,6 +330,10 @@ class WebHandler(object):
 
         self.backend = JanusBackend()
         self.backend.start()
+        self.replica_backends = JanusReplicaBackends()
+        self.replica_backends.start()
+        if self.replica_backends.backends:
+            log.info('Using Janus API for cascaded rooms: %s' % ', '.join(JanusConfig.cascade_api_urls))
 
     def stop(self):
         if self.factory is not None:
@@ -301,6 +343,9 @@ class WebHandler(object):
         if self.backend is not None:
             self.backend.stop()
             self.backend = None
+        if self.replica_backends is not None:
+            self.replica_backends.stop()
+            self.replica_backends = None
 
 
 # TODO: This implementation is a prototype.  Moving forward it probably makes sense to provide admin API
@@ -357,6 +402,38 @@ class AdminWebHandler(object, metaclass=Singleton):
         else:
             return json.dumps({'tokens': tokens})
 
+    @app.route('/threadpools')
+    def get_thread_pools(self, request):
+        self._check_auth(request)
+        request.setHeader('Content-Type', 'application/json')
+        return json.dumps({'pools': WorkerPoolManager().statistics})
+
+    @app.route('/auth')
+    def get_auth_statistics(self, request):
+        self._check_auth(request)
+        request.setHeader('Content-Type', 'application/json')
+        return json.dumps({'credential_cache': CredentialCache().statistics})
+
+    @app.route('/routing')
+    def get_routing_statistics(self, request):
+        self._check_auth(request)
+        request.setHeader('Content-Type', 'application/json')
+        return json.dumps({'routing': IncomingRequestHandler().router.statistics})
+
+    @app.route('/admission')
+    def get_admission_statistics(self, request):
+        self._check_auth(request)
+        request.setHeader('Content-Type', 'application/json')
+        admission_controller = getattr(ApplicationRegistry().get('conference'), 'admission_controller', None)
+        return json.dumps({'admission': admission_controller.statistics if admission_controller is not None else None})
+
+    @app.route('/rooms')
+    def get_room_statistics(self, request):
+        self._check_auth(request)
+        request.setHeader('Content-Type', 'application/json')
+        conference = ApplicationRegistry().get('conference')
+        return json.dumps({'rooms': conference.room_statistics if conference is not None else None})
+
     @app.route('/tokens/<string:account>/<string:device_token>', methods=['DELETE'])
     def process_token(self, request, account, device_token):
         self._check_auth(request)
@@ -0,0 +1,119 @@
+
+"""Shared cache of the audio files played by the applications"""
+
+import hashlib
+import os
+import wave
+
+from application import log
+from application.python.types import Singleton
+from application.system import makedirs, unlink
+from collections import OrderedDict
+from eventlib import coros
+from eventlib.twistedutil import block_on
+
+from sylk.configuration import ServerConfig
+from sylk.threadpool import defer_to_pool, run_in_pool
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+__all__ = 'AudioFileCache',
+
+
+class AudioFileCache(object, metaclass=Singleton):
+    """
+    Process-wide cache of the audio files (prompts) converted to 16 bit mono
+    at the sample rate of the mixer which plays them, so every file is decoded
+    and resampled once instead of by every player. The converted files are
+    kept in the spool directory and the least recently used ones are removed
+    when their total size exceeds audio_cache_size MB. Converting files needs
+    numpy, without it the files are played as they are and the players
+    resample them.
+    """
+
+    def __init__(self):
+        self._files = OrderedDict()  # (filename, sample_rate) -> (converted filename, size), least recently used first
+        self._size = 0
+        self._pending = {}  # (filename, sample_rate) -> event sent when the conversion finishes
+
+    @property
+    def directory(self):
+        return os.path.join(ServerConfig.spool_dir.normalized, 'audio-cache')
+
+    def get(self, filename, sample_rate):
+        """Return a file with the audio of filename at sample_rate, or filename itself if it does not need (or cannot be) converted"""
+        # should only be called from a green thread.
+        key = filename, sample_rate
+        if key in self._pending:
+            return self._pending[key].wait()
+        try:
+            self._files.move_to_end(key)
+        except KeyError:
+            pass
+        else:
+            return self._files[key][0]
+        if numpy is None:
+            return filename
+        event = self._pending[key] = coros.event()
+        path = filename
+        try:
+            try:
+                path, size = block_on(defer_to_pool('audio', self._convert, filename, sample_rate))
+            except Exception as e:
+                log.warning('Could not convert audio file %s to %dHz: %s' % (filename, sample_rate, e))
+                size = 0
+            self._files[key] = path, size
+            self._size += size
+            self._evict()
+        finally:
+            # waiters must be released even if this green thread is killed while the file is converted
+            del self._pending[key]
+            event.send(path)
+        return path
+
+    def _evict(self):
+        # the most recently used file is always kept
+        while self._size > ServerConfig.audio_cache_size * 1024 * 1024 and len(self._files) > 1:
+            key, (path, size) = self._files.popitem(last=False)
+            self._size -= size
+            if size:
+                self._remove(path)
+
+    @run_in_pool('housekeeping')
+    def _remove(self, path):
+        unlink(path)
+
+    def _convert(self, filename, sample_rate):
+        with wave.open(filename, 'rb') as source:
+            channels, width, rate = source.getnchannels(), source.getsampwidth(), source.getframerate()
+            if (channels, width, rate) == (1, 2, sample_rate):
+                return filename, 0
+            if width != 2:
+                raise ValueError('unsupported sample width: %d bytes' % width)
+            stat = os.stat(filename)
+            name = hashlib.sha1(('%s:%d:%d' % (filename, stat.st_size, stat.st_mtime)).encode()).hexdigest()
+            path = os.path.join(self.directory, '%s-%d.wav' % (name, sample_rate))
+            if os.path.exists(path):  # converted by a previous run
+                return path, os.path.getsize(path)
+            data = source.readframes(source.getnframes())
+        if channels not in (1, 2):
+            raise ValueError('unsupported number of channels: %d' % channels)
+        samples = numpy.frombuffer(data, dtype='<i2').reshape(-1, channels).mean(axis=1)
+        if rate != sample_rate:
+            # linear interpolation, prompts are short and mostly speech
+            count = int(len(samples) * sample_rate / rate)
+            samples = numpy.interp(numpy.arange(count) * (rate / sample_rate), numpy.arange(len(samples)), samples)
+        data = numpy.clip(numpy.round(samples), -32768, 32767).astype('<i2').tobytes()
+        makedirs(self.directory)
+        temp_path = path + '.tmp'
+        with wave.open(temp_path, 'wb') as destination:
+            destination.setnchannels(1)
+            destination.setsampwidth(2)
+            destination.setframerate(sample_rate)
+            destination.writeframes(data)
+        os.replace(temp_path, path)
+        return path, os.path.getsize(path)
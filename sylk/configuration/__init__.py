@@ -29,6 +29,7 @@ class ServerConfig(ConfigSection):
     trace_notifications = False
     log_level = ConfigSetting(type=LogLevel, value=LogLevel('info'))
     spool_dir = ConfigSetting(type=Path, value=Path(VarResources.get('spool/sylkserver')))
+    audio_cache_size = 64
 
 
 class SIPConfig(ConfigSection):
@@ -73,6 +74,19 @@ class WebServerConfig(ConfigSection):
     certificate = ConfigSetting(type=Path, value=None)
     certificate_chain = ConfigSetting(type=Path, value=None)
     log_dir = ConfigSetting(type=Path, value=Path(VarResources.get('log/sylkserver')))
+    max_upload_size = ConfigSetting(type=NonNegativeInteger, value=0)
+
+
+class ThreadPoolConfig(ConfigSection):
+    __cfgfile__ = 'config.ini'
+    __section__ = 'ThreadPools'
+
+    storage = 4
+    uploads = 4
+    housekeeping = 1
+    screenshots = 2
+    authentication = 4
+    audio = 2
 
 
 class ThorNodeConfig(ConfigSection):
@@ -1,4 +1,6 @@
 
+import json
+
 from application import log
 from application.notification import NotificationCenter, NotificationData
 from application.python.types import Singleton
@@ -18,7 +20,7 @@ __all__ = 'ConferenceNode',
 
 
 class ConferenceNode(EventServiceClient, metaclass=Singleton):
-    topics = ["Thor.Members"]
+    topics = ["Thor.Members", "Thor.ConferenceRooms"]
 
     def __init__(self):
         pass
@@ -50,6 +52,10 @@ class ConferenceNode(EventServiceClient, metaclass=Singleton):
         # Needs to be called from a green thread
         self._shutdown()
 
+    def publish_rooms(self, rooms):
+        """Let the other nodes know the conference rooms hosted here which the hash ring places elsewhere"""
+        self._publish(ThorEvent('Thor.ConferenceRooms', json.dumps({'node': SIPConfig.local_ip.normalized, 'rooms': sorted(rooms)})))
+
     def _monitor_event_servers(self):
         def wrapped_func():
             servers = self._get_event_servers()
@@ -77,6 +83,9 @@ class ConferenceNode(EventServiceClient, metaclass=Singleton):
 
     def handle_event(self, event):
         #print "Received event: %s" % event
+        if event.name == 'Thor.ConferenceRooms':
+            self._handle_rooms_event(event)
+            return
         networks = self.networks
         role_map = ThorEntitiesRoleMap(event.message) # mapping between role names and lists of nodes with that role
         updated = False
@@ -106,3 +115,12 @@ class ConferenceNode(EventServiceClient, metaclass=Singleton):
         if updated:
             NotificationCenter().post_notification('ThorNetworkGotUpdate', sender=self, data=NotificationData(networks=self.networks))
 
+    def _handle_rooms_event(self, event):
+        try:
+            data = json.loads(event.message)
+            node, rooms = data['node'], data['rooms']
+        except (TypeError, ValueError, KeyError):
+            log.warning('Received invalid conference rooms event')
+            return
+        if node != SIPConfig.local_ip.normalized:
+            NotificationCenter().post_notification('ThorNetworkGotConferenceRooms', sender=self, data=NotificationData(node=node, rooms=set(rooms)))
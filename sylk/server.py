@@ -33,6 +33,7 @@ from sylk.configuration import ServerConfig, SIPConfig, ThorNodeConfig
 from sylk.configuration.settings import AccountExtension, BonjourAccountExtension, SylkServerSettingsExtension
 from sylk.log import TraceLogManager
 from sylk.session import SessionManager
+from sylk.threadpool import WorkerPoolManager
 from sylk.web import WebServer
 
 
@@ -224,6 +225,7 @@ class SylkServer(SIPApplication):
         # stop threads
         thread_manager = ThreadManager()
         thread_manager.stop()
+        WorkerPoolManager().stop()
 
         # stop the reactor
         reactor.stop()
@@ -15,6 +15,7 @@ from sipsimple.core import ContactHeader, RouteHeader, FromHeader, ToHeader, Rea
 from sipsimple.core import SIPURI, SDPConnection, SDPSession, SDPMediaStream
 from sipsimple.lookup import DNSLookup, DNSLookupError
 from sipsimple.payloads import ParserError
+from sipsimple.payloads import conference
 from sipsimple.payloads.conference import ConferenceDocument
 from sipsimple.streams import MediaStreamRegistry, InvalidStreamError, UnknownStreamError
 from sipsimple.threading import run_in_twisted_thread
@@ -47,6 +48,30 @@ class MediaStreamDidFailError(Exception):
         self.data = data
 
 
+def merge_conference_info(current, update):
+    """Apply a conference-info document (RFC 4575) to the current one and return the full document"""
+    if update.state != 'partial' or current is None:
+        return update
+    if update.version is not None and current.version is not None and update.version <= current.version:
+        return current
+    current.version = update.version
+    if update.conference_description is not None:
+        current.conference_description = update.conference_description
+    if update.conference_state is not None:
+        current.conference_state = update.conference_state
+    if update.users is not None:
+        users = {user.entity: user for user in current.users or ()}
+        for user in update.users:
+            if user.state == 'deleted':
+                users.pop(user.entity, None)
+            else:
+                users[user.entity] = user
+        current.users = conference.Users()
+        for user in users.values():
+            current.users.add(user)
+    return current
+
+
 class SubscriptionError(Exception):
     def __init__(self, error, timeout, **attributes):
         self.error = error
@@ -257,6 +282,7 @@ class ConferenceHandler(object):
                 timeout = random.uniform(60, 180)
                 raise SubscriptionError(error='No more routes to try', timeout=timeout)
             # At this point it is subscribed. Handle notifications and ending/failures.
+            current_conference_info = None
             try:
                 while True:
                     notification = self._data_channel.wait()
@@ -269,7 +295,9 @@ class ConferenceHandler(object):
                             except ParserError:
                                 pass
                             else:
-                                notification_center.post_notification('SIPSessionGotConferenceInfo', sender=self.session, data=NotificationData(conference_info=conference_info))
+                                # observers always get the full state of the conference
+                                current_conference_info = merge_conference_info(current_conference_info, conference_info)
+                                notification_center.post_notification('SIPSessionGotConferenceInfo', sender=self.session, data=NotificationData(conference_info=current_conference_info))
                     elif notification.name == 'SIPSubscriptionDidEnd':
                         break
             except SIPSubscriptionDidFail:
@@ -879,12 +907,12 @@ class Session(object):
 
     @transition_state('incoming', 'terminating')
     @run_in_green_thread
-    def reject(self, code=603, reason=None):
+    def reject(self, code=603, reason=None, contact_header=None):
         self.greenlet = api.getcurrent()
         notification_center = NotificationCenter()
 
         try:
-            self._invitation.send_response(code, reason)
+            self._invitation.send_response(code, reason, contact_header=contact_header)
             with api.timeout(1):
                 while True:
                     notification = self._channel.wait()
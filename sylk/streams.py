@@ -74,6 +74,33 @@ def MSRPStreamBase_initialize(self, session, direction):
 _MSRPStreamBase.initialize = MSRPStreamBase_initialize
 
 
+class EncodedMessage(object):
+    """
+    A chat message encoded as a CPIM payload, which can be sent to any
+    number of chat streams without encoding it again for each of them.
+    """
+
+    __slots__ = 'content', 'content_type'
+
+    def __init__(self, content, content_type='text/plain', sender=None, recipients=None, timestamp=None, additional_headers=None):
+        if isinstance(content, str):
+            content = content.encode('utf8')
+            charset = 'utf8'
+        else:
+            charset = None
+        payload = CPIMPayload(content, content_type, charset=charset, sender=sender, recipients=recipients, timestamp=timestamp or ISOTimestamp.now(), additional_headers=additional_headers)
+        self.content, self.content_type = payload.encode()
+
+
+class QueuedEncodedMessage(object):
+    __slots__ = 'id', 'message', 'notify_progress'
+
+    def __init__(self, message, id=None, notify_progress=True):
+        self.id = id or '%x' % random.getrandbits(64)
+        self.message = message
+        self.notify_progress = notify_progress
+
+
 class ChatStream(_MSRPStreamBase):
     type = 'chat'
     priority = _ChatStream.priority + 1
@@ -275,23 +302,26 @@ class ChatStream(_MSRPStreamBase):
                         data = NotificationData(message_id=message.id, message=None, code=0, reason='Stream ended')
                         notification_center.post_notification('ChatStreamDidNotDeliverMessage', sender=self, data=data)
                     break
-                try:
-                    if isinstance(message.content, str):
-                        message.content = message.content.encode('utf8')
-                        charset = 'utf8'
-                    else:
-                        charset = None
-                    message.sender = message.sender or self.local_identity
-                    message.recipients = message.recipients or [self.remote_identity]
-                    message.timestamp = message.timestamp or ISOTimestamp.now()
-                    payload = CPIMPayload(charset=charset, **{name: getattr(message, name) for name in Message.__slots__})
-                except ChatStreamError as e:
-                    if message.notify_progress:
-                        data = NotificationData(message_id=message.id, message=None, code=0, reason=e.args[0])
-                        notification_center.post_notification('ChatStreamDidNotDeliverMessage', sender=self, data=data)
-                    continue
+                if isinstance(message, QueuedEncodedMessage):
+                    content, content_type = message.message.content, message.message.content_type
                 else:
-                    content, content_type = payload.encode()
+                    try:
+                        if isinstance(message.content, str):
+                            message.content = message.content.encode('utf8')
+                            charset = 'utf8'
+                        else:
+                            charset = None
+                        message.sender = message.sender or self.local_identity
+                        message.recipients = message.recipients or [self.remote_identity]
+                        message.timestamp = message.timestamp or ISOTimestamp.now()
+                        payload = CPIMPayload(charset=charset, **{name: getattr(message, name) for name in Message.__slots__})
+                    except ChatStreamError as e:
+                        if message.notify_progress:
+                            data = NotificationData(message_id=message.id, message=None, code=0, reason=e.args[0])
+                            notification_center.post_notification('ChatStreamDidNotDeliverMessage', sender=self, data=data)
+                        continue
+                    else:
+                        content, content_type = payload.encode()
 
                 message_id = message.id
                 notify_progress = message.notify_progress
@@ -361,6 +391,12 @@ class ChatStream(_MSRPStreamBase):
         self._enqueue_message(message)
         return message.id
 
+    def send_encoded_message(self, message, message_id=None, notify_progress=True):
+        """Send an EncodedMessage, the CPIM payload is sent as is"""
+        message = QueuedEncodedMessage(message, message_id, notify_progress)
+        self._enqueue_message(message)
+        return message.id
+
     def send_composing_indication(self, state, refresh=None, last_active=None, sender=None, recipients=None, message_id=None, notify_progress=False):
         content = IsComposingDocument.create(state=State(state), refresh=Refresh(refresh) if refresh is not None else None, last_active=LastActive(last_active) if last_active is not None else None, content_type=ContentType('text'))
         message = QueuedMessage(content, IsComposingDocument.content_type, sender=sender, recipients=recipients, id=message_id, notify_progress=notify_progress)
@@ -0,0 +1,184 @@
+
+"""Named worker pools used to run blocking I/O outside of the reactor thread"""
+
+import time
+
+from application import log
+from application.python.types import Singleton
+from functools import wraps
+from inspect import signature
+from queue import Queue
+from threading import Lock, Thread
+from twisted.internet import defer, reactor
+from twisted.python.failure import Failure
+
+from sylk.configuration import ThreadPoolConfig
+
+
+__all__ = 'WorkerPool', 'WorkerPoolManager', 'run_in_pool', 'defer_to_pool'
+
+
+class _StopWorker(object):
+    pass
+
+
+class PoolStatistics(object):
+    def __init__(self):
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.max_queue_depth = 0
+        self.total_wait_time = 0.0
+
+    @property
+    def average_wait_time(self):
+        return self.total_wait_time / self.completed if self.completed else 0.0
+
+
+class WorkerPool(object):
+    """
+    A fixed size pool of worker threads. Every worker has its own queue, calls
+    which share an ordering key always go to the same worker, so they are
+    executed in the order they were submitted. Calls without a key go to the
+    least loaded worker.
+    """
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = max(size, 1)
+        self.statistics = PoolStatistics()
+        self._lock = Lock()
+        self._queues = [Queue() for _ in range(self.size)]
+        self._threads = [Thread(target=self._run, args=(queue,), name='%s-%d' % (name, index), daemon=True) for index, queue in enumerate(self._queues)]
+        for thread in self._threads:
+            thread.start()
+
+    @property
+    def queue_depth(self):
+        return sum(queue.qsize() for queue in self._queues)
+
+    def submit(self, key, func, *args, **kw):
+        """Run func in the pool, calls with the same key (unless None) are executed in order"""
+        if key is None:
+            queue = min(self._queues, key=Queue.qsize)
+        else:
+            queue = self._queues[hash(key) % self.size]
+        queue.put((time.monotonic(), func, args, kw))
+        with self._lock:
+            self.statistics.submitted += 1
+            self.statistics.max_queue_depth = max(self.statistics.max_queue_depth, self.queue_depth)
+
+    def stop(self):
+        """Stop the workers once they ran the calls which are already queued"""
+        for queue in self._queues:
+            queue.put(_StopWorker)
+
+    def join(self, timeout=None):
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        for thread in self._threads:
+            thread.join(max(deadline - time.monotonic(), 0) if deadline is not None else None)
+            if thread.is_alive():
+                log.warning('%s worker pool did not finish its queued calls in time' % self.name)
+                break
+
+    def _run(self, queue):
+        while True:
+            item = queue.get()
+            if item is _StopWorker:
+                break
+            submit_time, func, args, kw = item
+            wait_time = time.monotonic() - submit_time
+            try:
+                func(*args, **kw)
+            except Exception:
+                failed = True
+                log.exception('Unhandled exception in %s worker pool' % self.name)
+            else:
+                failed = False
+            with self._lock:
+                self.statistics.completed += 1
+                self.statistics.failed += failed
+                self.statistics.total_wait_time += wait_time
+
+    def __repr__(self):
+        return '<{0.__class__.__name__}: name={0.name!r} size={0.size!r} queue_depth={0.queue_depth!r}>'.format(self)
+
+
+class WorkerPoolManager(object, metaclass=Singleton):
+    def __init__(self):
+        self._pools = {}
+        self._lock = Lock()
+
+    def get_pool(self, name):
+        with self._lock:
+            try:
+                return self._pools[name]
+            except KeyError:
+                pool = self._pools[name] = WorkerPool(name, getattr(ThreadPoolConfig, name, 1))
+                return pool
+
+    def stop(self, timeout=10):
+        """Stop all pools, waiting at most timeout seconds for the calls which are already queued"""
+        with self._lock:
+            pools = list(self._pools.values())
+            self._pools.clear()
+        for pool in pools:
+            pool.stop()
+        deadline = time.monotonic() + timeout
+        for pool in pools:
+            pool.join(max(deadline - time.monotonic(), 0))
+
+    @property
+    def statistics(self):
+        with self._lock:
+            pools = list(self._pools.values())
+        return {pool.name: dict(size=pool.size,
+                                queue_depth=pool.queue_depth,
+                                max_queue_depth=pool.statistics.max_queue_depth,
+                                submitted=pool.statistics.submitted,
+                                completed=pool.statistics.completed,
+                                failed=pool.statistics.failed,
+                                average_wait_time=round(pool.statistics.average_wait_time, 6)) for pool in pools}
+
+
+def run_in_pool(name, key=None):
+    """
+    Decorator which runs the function in the named worker pool.
+
+    The key defines the ordering: calls with the same key are executed in the
+    order they were made. It can be the name of one of the function arguments,
+    whose value is used as key, or a callable which receives the function
+    arguments and returns the key. Without a key no ordering is guaranteed.
+    """
+
+    def decorator(func):
+        if isinstance(key, str):
+            parameters = signature(func)
+
+            def get_key(*args, **kw):
+                return parameters.bind(*args, **kw).arguments[key]
+        else:
+            get_key = key
+
+        @wraps(func)
+        def wrapper(*args, **kw):
+            ordering_key = get_key(*args, **kw) if get_key is not None else None
+            WorkerPoolManager().get_pool(name).submit(ordering_key, func, *args, **kw)
+        return wrapper
+    return decorator
+
+
+def defer_to_pool(name, func, *args, **kw):
+    """Run func in the named worker pool and return a Deferred which fires in the reactor thread with its result"""
+    deferred = defer.Deferred()
+
+    def run():
+        try:
+            result = func(*args, **kw)
+        except Exception:
+            reactor.callFromThread(deferred.errback, Failure())
+        else:
+            reactor.callFromThread(deferred.callback, result)
+
+    WorkerPoolManager().get_pool(name).submit(None, run)
+    return deferred
@@ -1,22 +1,30 @@
+import errno
+import hashlib
 import mimetypes
+import tempfile
 
 from application import log
 from application.python.types import Singleton
+from application.system import makedirs, unlink
 from klein import Klein
-from twisted.internet import reactor
+from shutil import move
+from threading import Event
+from twisted.internet import defer, reactor
 from twisted.internet.ssl import DefaultOpenSSLContextFactory
+from twisted.web import http
 from twisted.web.resource import Resource, NoResource
-from twisted.web.server import Site
+from twisted.web.server import Request, Site
 from twisted.web.static import File
 
 from sylk import __version__
-from sylk.configuration import WebServerConfig
+from sylk.configuration import ServerConfig, WebServerConfig
+from sylk.threadpool import run_in_pool
 
 import os
 import twisted.web.server
 
 
-__all__ = 'Klein', 'StaticFileResource', 'WebServer', 'server'
+__all__ = 'Klein', 'StaticFileResource', 'DownloadResource', 'UploadContent', 'WebServer', 'etag_matches', 'server'
 
 
 # Set the 'Server' header string which Twisted Web will use
@@ -57,7 +65,28 @@ def loadMimeTypes(mimetype_locations='mime.types', init=mimetypes.init):
         }
     )
     return mimetypes.types_map
-    
+
+
+def etag_matches(request, etag):
+    """Check if the If-None-Match header of a request matches etag, using the weak comparison of RFC 7232"""
+    header = request.getHeader(b'if-none-match')
+    if not header:
+        return False
+    header = header.decode('latin-1').strip()
+    if header == '*':
+        return True
+    if isinstance(etag, bytes):
+        etag = etag.decode('latin-1')
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
 
 class StaticFileResource(File):
     contentTypes = loadMimeTypes()
@@ -65,6 +94,292 @@ class StaticFileResource(File):
         return NoResource('Directory listing not available')
 
 
+class DownloadResource(File):
+    """
+    A file download which supports conditional requests. If an ETag is given,
+    requests with a matching If-None-Match header are answered with 304 without
+    opening the file. Byte ranges are handled by File, which streams the file to
+    the client using a producer instead of reading it in memory.
+    """
+
+    contentTypes = StaticFileResource.contentTypes
+    cache_control = b'private, max-age=604800'
+
+    def __init__(self, path, etag=None, stat_result=None, cache_control=None):
+        super(DownloadResource, self).__init__(path)
+        self.etag = etag
+        if cache_control is not None:
+            self.cache_control = cache_control
+        if stat_result is not None:
+            self._statinfo = stat_result  # avoid stat-ing the file again if the caller already did it
+
+    def restat(self, reraise=True):
+        if self._statinfo is None:
+            super(DownloadResource, self).restat(reraise)
+
+    def directoryListing(self):
+        return NoResource('Directory listing not available')
+
+    def render_GET(self, request):
+        request.setHeader(b'cache-control', self.cache_control)
+        request.setHeader(b'accept-ranges', b'bytes')
+        if self.etag is not None:
+            request.setHeader(b'etag', self.etag)
+            if etag_matches(request, self.etag):
+                request.setResponseCode(http.NOT_MODIFIED)
+                return b''
+        return super(DownloadResource, self).render_GET(request)
+
+    render_HEAD = render_GET
+
+
+class UploadContent(object):
+    """
+    Request body which is hashed as it arrives. Small bodies are kept in memory,
+    bigger ones are spooled to a temporary file from the uploads pool, so the
+    reactor never blocks on disk I/O. Once the request was received the content
+    can be moved to its final location with save().
+    """
+
+    chunk_size = 256 * 1024
+
+    def __init__(self):
+        self.directory = os.path.join(ServerConfig.spool_dir.normalized, 'uploads')
+        self.hash = hashlib.sha1()
+        self.size = 0
+        self.error = None
+        self._buffer = []
+        self._buffered = 0
+        self._file = None
+        self._temp_path = None
+        self._saved = False
+        self._spooled = False
+        self._ended = False
+        self._done = Event()
+        self._waiters = []
+        self._position = 0
+
+    @property
+    def ended(self):
+        return self._ended
+
+    def wait(self):
+        """Return a Deferred which fires with the content in the reactor thread once it was completely written"""
+        if self._done.is_set():
+            return defer.succeed(self)
+        deferred = defer.Deferred()
+        self._waiters.append(deferred)
+        return deferred
+
+    def write(self, data):
+        if self._ended:
+            raise ValueError('cannot write to an upload that has ended')
+        self._buffer.append(data)
+        self._buffered += len(data)
+        self.size += len(data)
+        if self._buffered >= self.chunk_size:
+            self._flush()
+
+    def end(self):
+        """Called when the whole body was received"""
+        if not self._ended:
+            self._ended = True
+            if self._spooled:
+                self._flush()
+                self._finish()
+            else:
+                data = b''.join(self._buffer)
+                self._buffer = [data]
+                self.hash.update(data)
+                self._done.set()
+                self._notify_waiters()
+
+    def save(self, path):
+        """Move the content to path, returns a Deferred which fires when done"""
+        deferred = defer.Deferred()
+        self._save(path, deferred)
+        return deferred
+
+    def save_sync(self, path):
+        """Move the content to path, must be called from a worker thread"""
+        self._done.wait()
+        if self.error is not None:
+            raise self.error
+        if self._saved:
+            raise ValueError('upload was already saved')
+        makedirs(os.path.dirname(path))
+        if self._temp_path is not None:
+            try:
+                os.replace(self._temp_path, path)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                move(self._temp_path, path)
+            self._temp_path = None
+        else:
+            temp_path = path + '.tmp'
+            with open(temp_path, 'wb') as f:
+                f.write(b''.join(self._buffer))
+            os.replace(temp_path, path)
+        self._saved = True
+
+    @run_in_pool('uploads', key='self')
+    def discard(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._temp_path is not None:
+            unlink(self._temp_path)
+            self._temp_path = None
+        self._buffer = []
+
+    # file like interface, used by code which expects the body to be a file (ie: twisted form parsing)
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            self._position = offset
+        elif whence == 1:
+            self._position += offset
+        else:
+            self._position = self.size + offset
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def read(self, size=-1):
+        if not self._done.is_set():
+            raise IOError('upload is still being written')  # use wait() instead of blocking the reactor
+        if self._temp_path is not None:
+            with open(self._temp_path, 'rb') as f:
+                f.seek(self._position)
+                data = f.read(size)
+        else:
+            content = b''.join(self._buffer)
+            end = None if size is None or size < 0 else self._position + size
+            data = content[self._position:end]
+        self._position += len(data)
+        return data
+
+    def close(self):
+        self.discard()
+
+    def _flush(self):
+        self._spooled = True
+        data = b''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        self._write_chunk(data)
+
+    @run_in_pool('uploads', key='self')
+    def _write_chunk(self, data):
+        if self.error is not None:
+            return
+        try:
+            if self._file is None:
+                makedirs(self.directory)
+                fd, self._temp_path = tempfile.mkstemp(prefix='.upload-', dir=self.directory)
+                self._file = os.fdopen(fd, 'wb')
+            self._file.write(data)
+        except (OSError, IOError) as e:
+            log.error('Could not spool upload to disk: %s' % e)
+            self.error = e
+        self.hash.update(data)
+
+    @run_in_pool('uploads', key='self')
+    def _finish(self):
+        if self._file is not None:
+            try:
+                self._file.close()
+            except (OSError, IOError) as e:
+                self.error = e
+            self._file = None
+        self._done.set()
+        reactor.callFromThread(self._notify_waiters)
+
+    def _notify_waiters(self):
+        waiters, self._waiters = self._waiters, []
+        for deferred in waiters:
+            deferred.callback(self)
+
+    @run_in_pool('uploads', key='self')
+    def _save(self, path, deferred):
+        try:
+            self.save_sync(path)
+        except Exception as e:
+            reactor.callFromThread(deferred.errback, e)
+        else:
+            reactor.callFromThread(deferred.callback, path)
+
+
+class UploadRequest(Request):
+    """Request which streams the body through UploadContent and enforces the maximum upload size"""
+
+    form_content_types = (b'application/x-www-form-urlencoded', b'multipart/form-data')
+
+    connection_lost = False
+
+    def gotLength(self, length):
+        self.received_size = 0  # chunked bodies have no length, so the limit is also checked as they arrive
+        max_size = WebServerConfig.max_upload_size
+        if max_size and length is not None and length > max_size:
+            self._reject_too_large()
+            return
+        content_type = (self.requestHeaders.getRawHeaders(b'content-type') or [b''])[0]
+        if content_type.split(b';', 1)[0].strip().lower() in self.form_content_types:
+            super(UploadRequest, self).gotLength(length)
+        else:
+            self.content = UploadContent()
+
+    def handleContentChunk(self, data):
+        max_size = WebServerConfig.max_upload_size
+        if self.content is None:
+            return
+        self.received_size += len(data)
+        if max_size and self.received_size > max_size:
+            self._reject_too_large()
+            return
+        self.content.write(data)
+
+    def requestReceived(self, command, path, version):
+        if self.content is None:  # the upload was rejected
+            return
+        if isinstance(self.content, UploadContent):
+            # the request is only handled once the content was written, so the handlers never wait for the upload threads
+            self.content.end()
+            self.content.wait().addCallback(lambda content: self._content_received(command, path, version))
+        else:
+            super(UploadRequest, self).requestReceived(command, path, version)
+
+    def _content_received(self, command, path, version):
+        if self.connection_lost:
+            self.content.discard()
+        else:
+            super(UploadRequest, self).requestReceived(command, path, version)
+
+    def connectionLost(self, reason):
+        self.connection_lost = True
+        content = getattr(self, 'content', None)
+        if isinstance(content, UploadContent) and not content.ended:
+            content.discard()
+        super(UploadRequest, self).connectionLost(reason)
+
+    def _reject_too_large(self):
+        if isinstance(self.content, UploadContent):
+            self.content.discard()
+        self.content = None
+        # the body was not received yet, so requestReceived did not set the request line, which is needed to respond and log the request
+        channel = self.channel
+        self.method = getattr(channel, '_command', b'POST')
+        self.uri = getattr(channel, '_path', b'/')
+        self.path = self.uri.split(b'?', 1)[0]
+        self.clientproto = getattr(channel, '_version', b'HTTP/1.1')
+        self.setResponseCode(http.REQUEST_ENTITY_TOO_LARGE)
+        self.setHeader(b'connection', b'close')
+        self.finish()
+        channel.loseConnection()  # stop reading the rest of the body, the response is written first
+
+
 class RootResource(Resource):
     isLeaf = True
 
@@ -78,6 +393,7 @@ class WebServer(object, metaclass=Singleton):
         self.base = Resource()
         self.base.putChild(b'', RootResource())
         self.site = Site(self.base, logPath=os.devnull)
+        self.site.requestFactory = UploadRequest
         self.site.noisy = False
         self.listener = None
 